@@ -9,6 +9,18 @@ The docstring of rjgtoys/cas/__init__.py
 
 .. automodule:: rjgtoys.cas._base
 .. automodule:: rjgtoys.cas._files
+.. automodule:: rjgtoys.cas._ignore
+.. automodule:: rjgtoys.cas._volume
+.. automodule:: rjgtoys.cas._xattr
+.. automodule:: rjgtoys.cas._cache
+.. automodule:: rjgtoys.cas._journal
+.. automodule:: rjgtoys.cas._sqlite
+.. automodule:: rjgtoys.cas._packed
+.. automodule:: rjgtoys.cas._cmdconvert
+.. automodule:: rjgtoys.cas._workers
+.. automodule:: rjgtoys.cas._chunks
+.. automodule:: rjgtoys.cas._watch
+.. automodule:: rjgtoys.cas._cmdbench
 
 End of rjgtoys/cas/__init__.py
 
@@ -16,6 +16,8 @@ used the name 'cid' for CAS content ids.
 
 
 .. autoclass:: CasItemBuilder
+.. autofunction:: cas_string_to_id
+.. autofunction:: cas_strings_to_ids
 
 """
 
@@ -24,14 +26,29 @@ from _expiry import expired
 
 import hashlib
 import base64
+import binascii
+import string
 import os
 import time
 import mmap
 import json
+import io
+import threading
+import Queue
+import collections
+import ctypes
+import ctypes.util
+import struct
+import fcntl
+import array
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
 
 # Size of block we'll read from a file
 
-BLOCKSIZE=1024*1024*128
+BLOCKSIZE=1024*1024
 
 __doc__ +="""
 
@@ -64,7 +81,7 @@ __doc__+="""
 Each content id starts with a character that identifies the kind
 of content id.
 
-There are currently three kinds defined:
+These kinds are currently defined:
 
 +------------------+-------------+------------------------------------------------------------------+
 | Name             | Starts with | Description                                                      |
@@ -73,14 +90,139 @@ There are currently three kinds defined:
 +------------------+-------------+------------------------------------------------------------------+
 | `CAS_ID_SHA512`  | `I`         | This id is a base64-encoded SHA512 hash of the data              |
 +------------------+-------------+------------------------------------------------------------------+
+| `CAS_ID_SHA256`  | `S`         | This id is a base64-encoded SHA256 hash of the data              |
++------------------+-------------+------------------------------------------------------------------+
+| `CAS_ID_BLAKE2B` | `B`         | This id is a base64-encoded BLAKE2b hash of the data (only       |
+|                  |             | available if :mod:`hashlib` or :mod:`pyblake2` provide BLAKE2b)  |
++------------------+-------------+------------------------------------------------------------------+
 | `CAS_ID_EMPTY`   | `Z`         | The data was zero length; the id for that is simply `Z`          |
 +------------------+-------------+------------------------------------------------------------------+
+| `CAS_ID_CHUNKED` | `C`         | The data was split into chunks, and this is a hash of the list   |
+|                  |             | of chunk ids (see :mod:`rjgtoys.cas._chunks`); the next character|
+|                  |             | is the prefix of the hash algorithm used                         |
++------------------+-------------+------------------------------------------------------------------+
+| `CAS_ID_TREE`    | `T`         | This id is a tree hash of the data (see :class:`CasTreeBuilder`);|
+|                  |             | the next character is the prefix of the hash algorithm used      |
++------------------+-------------+------------------------------------------------------------------+
+| `CAS_ID_DIR`     | `D`         | This id is a hash of a directory listing, including the ids of   |
+|                  |             | its entries; the next character is the prefix of the hash        |
+|                  |             | algorithm used                                                   |
++------------------+-------------+------------------------------------------------------------------+
+
+Literal and empty ids don't depend on a hash algorithm, so the same data
+always has the same literal or empty id.   Longer data has a different id
+for each algorithm.
 
 """
 
 CAS_ID_LITERAL='L'  # Prefix for literal ids
 CAS_ID_SHA512='I'   # Prefix for sha512 ids
+CAS_ID_SHA256='S'   # Prefix for sha256 ids
+CAS_ID_BLAKE2B='B'  # Prefix for blake2b ids
 CAS_ID_EMPTY='Z'    # (Prefix for) the id for theempty string
+CAS_ID_CHUNKED='C'  # Prefix for ids of chunk manifests
+CAS_ID_TREE='T'     # Prefix for tree hash ids
+CAS_ID_DIR='D'      # Prefix for directory ids
+
+# Prefixes of ids that are not simply a hash of the data
+
+CAS_ID_RESERVED=[CAS_ID_LITERAL,CAS_ID_EMPTY,CAS_ID_CHUNKED,CAS_ID_TREE,CAS_ID_DIR]
+
+# ... and those that are followed by the prefix of the algorithm used
+
+CAS_ID_QUALIFIED=[CAS_ID_CHUNKED,CAS_ID_TREE,CAS_ID_DIR]
+
+__doc__+="""
+
+Hash algorithms
+---------------
+
+Each hash algorithm is registered with the prefix used for the ids it
+produces.   Ids made by any registered algorithm are accepted everywhere;
+a store chooses which algorithm to use for the new ids it makes.
+
+.. autoclass:: CasAlgorithm
+.. autofunction:: cas_register_algorithm
+.. autofunction:: cas_algorithm
+.. autofunction:: cas_id_algorithm
+.. autoexception:: UnknownAlgorithmError
+
+"""
+
+class UnknownAlgorithmError(CasErrorXC):
+    """Raised on an attempt to use a hash algorithm that has not been
+    registered."""
+
+    params=('algorithm',)
+    oneline = "Unknown hash algorithm '{algorithm}'"
+
+class CasAlgorithm(object):
+    """
+    A hash algorithm that can be used to make content ids: `factory`
+    returns a new :mod:`hashlib`-style hash object, and the ids made
+    with it start with `prefix`.
+    """
+
+    def __init__(self,name,prefix,factory):
+        self.name = name
+        self.prefix = prefix
+        self.factory = factory
+
+    def new(self):
+        return self.factory()
+
+CAS_ALGORITHMS = {}     # Registered algorithms, by name
+CAS_PREFIXES = {}       # ... and by prefix
+
+def cas_register_algorithm(name,prefix,factory):
+    """Registers a hash algorithm, and returns its :class:`CasAlgorithm`"""
+
+    if prefix in CAS_ID_RESERVED or CAS_PREFIXES.get(prefix,name) != name:
+        raise ValueError("Prefix '%s' is already in use" % (prefix))
+
+    a = CasAlgorithm(name,prefix,factory)
+    CAS_ALGORITHMS[name] = a
+    CAS_PREFIXES[prefix] = a
+    return a
+
+def cas_algorithm(a=None):
+    """Coerces `a` (a name, a :class:`CasAlgorithm` or None, meaning
+    the default) to a :class:`CasAlgorithm`.
+    """
+
+    if a is None:
+        a = DEFAULT_ALGORITHM
+
+    if isinstance(a,CasAlgorithm):
+        return a
+
+    try:
+        return CAS_ALGORITHMS[a]
+    except KeyError:
+        raise UnknownAlgorithmError(algorithm=a)
+
+def cas_id_algorithm(cid):
+    """Returns the :class:`CasAlgorithm` that made content id `cid`,
+    or None if it wasn't made by a hash algorithm.
+    """
+
+    if not cid:
+        return None
+    if cid[0] in CAS_ID_QUALIFIED:
+        cid = cid[1:]
+    return CAS_PREFIXES.get(cid[:1],None)
+
+try:
+    from pyblake2 import blake2b
+except ImportError:
+    blake2b = getattr(hashlib,'blake2b',None)
+
+cas_register_algorithm('sha512',CAS_ID_SHA512,hashlib.sha512)
+cas_register_algorithm('sha256',CAS_ID_SHA256,hashlib.sha256)
+if blake2b is not None:
+    cas_register_algorithm('blake2b',CAS_ID_BLAKE2B,blake2b)
+
+DEFAULT_ALGORITHM='sha512'
 
 class CasItemBuilder(object):
     
@@ -93,6 +235,13 @@ class CasItemBuilder(object):
     A :class:`CasItemBuilder` may be reused by calling its :meth:`reset`
     before starting each new item.
 
+    Content may be a string or any object that supports the buffer
+    protocol (a :class:`bytearray`, :class:`buffer`, :class:`memoryview`
+    or :class:`mmap.mmap`, say), and is hashed in place; only content
+    short enough to need a literal id is ever copied.
+
+    Ids are made with the hash `algorithm` (see :func:`cas_algorithm`).
+
     .. automethod:: reset
     .. automethod:: add
     .. autoattribute:: size
@@ -100,8 +249,9 @@ class CasItemBuilder(object):
     
     """
 
-    def __init__(self,content=None):
+    def __init__(self,content=None,algorithm=None):
         
+        self.algorithm = cas_algorithm(algorithm)
         self.reset()
         if content is not None:
             self.add(content)
@@ -111,9 +261,9 @@ class CasItemBuilder(object):
         can be used to generate the cid and size of another data string.
         """
         
-        self.h = hashlib.sha512()
+        self.h = self.algorithm.new()
         self.bc = 0
-        self.content = ''
+        self.content = bytearray()
         
     def add(self,content):
         """Adds more content to the item being examined; changes the
@@ -121,9 +271,9 @@ class CasItemBuilder(object):
         """
 
         self.h.update(content)
-        self.bc += len(content)
+        self.bc += _size(content)
         if self.bc < LITERALSIZE:
-            self.content += str(content[:LITERALSIZE])
+            self.content += _bytes(content)
             
     @property
     def size(self):
@@ -141,17 +291,235 @@ class CasItemBuilder(object):
         if self.bc == 0:
             return CAS_ID_EMPTY
         if self.bc < LITERALSIZE:
-            return CAS_ID_LITERAL+base64.b64encode(self.content,'._')
+            return CAS_ID_LITERAL+_b64(self.content)
+
+        return self.algorithm.prefix+_b64(self.h.digest())
+
+def _size(content):
+    """The size in bytes of a string or buffer, which may hold items
+    bigger than a byte (an :class:`array.array`, say)"""
+
+    if isinstance(content,memoryview):
+        return len(content)*content.itemsize
+    if isinstance(content,(str,bytearray,unicode)):
+        return len(content)
+    return len(buffer(content))
+
+def _bytes(content):
+    """A copy of a (short) string or buffer, as something that can
+    be added to a :class:`bytearray`"""
+
+    if isinstance(content,memoryview):
+        return content.tobytes()
+    if isinstance(content,(bytearray,str)):
+        return content
+    if isinstance(content,unicode):
+        return str(content)
+    return bytes(buffer(content))
+
+# Base64 with the alphabet used in ids
+
+_B64ALT = string.maketrans('+/','._')
+
+def _b64(data):
+    """Equivalent to ``base64.b64encode(data,'._')``, but without making
+    a new translation table each time"""
+
+    return binascii.b2a_base64(data)[:-1].translate(_B64ALT)
+
+__doc__+="""
+
+Tree hashes
+-----------
+
+A hash like SHA512 has to be computed from start to finish, so however
+many cores are available, hashing one big file takes as long as one core
+takes to get through it.   A tree hash splits the data into segments of
+`SEGMENTSIZE` bytes, hashes each segment separately, and then combines
+the segment hashes pairwise, up a binary tree, to a single root hash.
+The segments can be hashed in any order, or all at once.
+
+The tree has the same shape as the Merkle trees of RFC 6962: each leaf
+hash is of a zero byte followed by the segment, and each node hash is of
+a one byte followed by the hashes of its two children; when the number of
+leaves isn't a power of two, the left subtree is the largest power of two.
+So the same data always gives the same root, whatever the order the
+segments were hashed in, and a reader streaming the data can check it
+against the id using a :class:`CasTreeBuilder`.
+
+Tree ids are `CAS_ID_TREE` followed by the prefix of the hash algorithm
+used, so they can never be mistaken for a plain hash of the data.   Data
+short enough for a literal id (and empty data) gets the usual literal
+(or empty) id.
+
+.. autoclass:: CasTreeBuilder
+
+"""
+
+# Size of each segment of a tree hash.   Ids depend on it, so don't change it.
+
+SEGMENTSIZE=1024*1024
+
+TREE_LEAF='\x00'
+TREE_NODE='\x01'
+
+def _slice(content,offset,length):
+    """ A slice of content that doesn't copy it """
+
+    if isinstance(content,memoryview):
+        if content.itemsize != 1:
+            return buffer(content.tobytes(),offset,length)
+        return content[offset:offset+length]
+    return buffer(content,offset,length)
+
+class CasTreeBuilder(object):
+    """
+    Constructs the tree hash content id of a string.   Used in the same
+    way as a :class:`CasItemBuilder`; content can also be supplied as
+    already-computed segment hashes, in order, using :meth:`add_leaf`.
+
+    .. automethod:: reset
+    .. automethod:: add
+    .. automethod:: add_leaf
+    .. autoattribute:: size
+    .. autoattribute:: cid
+    """
+
+    def __init__(self,content=None,algorithm=None):
+
+        self.algorithm = cas_algorithm(algorithm)
+        self.reset()
+        if content is not None:
+            self.add(content)
+
+    def reset(self):
+        """Prepares to construct the id of another data string"""
+
+        self.bc = 0
+        self.content = bytearray()
+        self._stack = []        # (level, hash) of complete subtrees
+        self._leaf = None       # hash of the current segment, so far
+        self._fill = 0          # and how much of it has been seen
+
+    def leaf(self,segment):
+        """Returns the leaf hash of one segment"""
+
+        h = self.algorithm.new()
+        h.update(TREE_LEAF)
+        h.update(segment)
+        return h.digest()
+
+    def _node(self,left,right):
+        h = self.algorithm.new()
+        h.update(TREE_NODE)
+        h.update(left)
+        h.update(right)
+        return h.digest()
+
+    def _push(self,d):
+        level = 0
+        while self._stack and self._stack[-1][0] == level:
+            (_,left) = self._stack.pop()
+            d = self._node(left,d)
+            level += 1
+        self._stack.append((level,d))
+
+    def add(self,content):
+        """Adds more content to the item being examined"""
+
+        total = _size(content)
+
+        self.bc += total
+        if self.bc < LITERALSIZE:
+            self.content += _bytes(content)
+
+        pos = 0
+        while pos < total:
+            if self._leaf is None:
+                self._leaf = self.algorithm.new()
+                self._leaf.update(TREE_LEAF)
+                self._fill = 0
+            n = min(SEGMENTSIZE-self._fill,total-pos)
+            self._leaf.update(_slice(content,pos,n))
+            self._fill += n
+            pos += n
+            if self._fill == SEGMENTSIZE:
+                self._push(self._leaf.digest())
+                self._leaf = None
+
+    def add_leaf(self,digest,size=SEGMENTSIZE):
+        """Adds the hash of the next segment (of `size` bytes, which must
+        be `SEGMENTSIZE` for all but the last segment)
+        """
+
+        assert self._leaf is None
+        self.bc += size
+        self._push(digest)
+
+    @property
+    def size(self):
+        """The number of bytes scanned so far (Readonly)"""
 
-        return CAS_ID_SHA512+base64.b64encode(self.h.digest(),'._')
+        return self.bc
+
+    @property
+    def root(self):
+        """The root hash of the data examined so far (Readonly)"""
 
+        hashes = [d for (_,d) in self._stack]
+        if self._leaf is not None:
+            hashes.append(self._leaf.copy().digest())
+        if not hashes:
+            return self.leaf('')
 
-def cas_string_to_id(s):
+        d = hashes.pop()
+        while hashes:
+            d = self._node(hashes.pop(),d)
+        return d
+
+    @property
+    def cid(self):
+        """The content id of the data examined so far (Readonly)"""
+
+        if self.bc == 0:
+            return CAS_ID_EMPTY
+        if self.bc < LITERALSIZE:
+            return CAS_ID_LITERAL+_b64(self.content)
+
+        return CAS_ID_TREE+self.algorithm.prefix+_b64(self.root)
+
+def cas_string_to_id(s,algorithm=None):
     """ Convenience function that returns the content id of a string """
     
-    return CasItemBuilder(s).cid
+    for cid in cas_strings_to_ids((s,),algorithm):
+        return cid
 
-def cas_link_to_id(p,bc=None):
+def cas_strings_to_ids(seq,algorithm=None):
+    """ Generates the content ids of a sequence of strings (or buffers),
+    in order.
+
+    This is much quicker than calling :func:`cas_string_to_id` for each one
+    when there are a lot of small items: the algorithm is only looked up
+    once, each hash object is copied from a fresh one rather than being
+    constructed, and short items are never hashed at all.
+    """
+
+    algorithm = cas_algorithm(algorithm)
+    prefix = algorithm.prefix
+    fresh = algorithm.new()
+
+    for s in seq:
+        n = _size(s)
+        if n == 0:
+            yield CAS_ID_EMPTY
+        elif n < LITERALSIZE:
+            yield CAS_ID_LITERAL+_b64(s)
+        else:
+            h = fresh.copy()
+            h.update(s)
+            yield prefix+_b64(h.digest())
+
+def cas_link_to_id(p,bc=None,algorithm=None):
     """ Convenience function that returns the content id of the destination
     of a symbolic link.   If `os.readlink('foo') returns 'bar' then
     `cas_link_to_id('foo') will return `cas_string_to_id('bar')`
@@ -164,11 +532,15 @@ def cas_link_to_id(p,bc=None):
     if bc is not None and len(d) != bc:
         return None
     
-    return cas_string_to_id(d)
+    return cas_string_to_id(d,algorithm)
     
-def cas_file_to_id(p,bc=None):
+def cas_file_to_id(p,bc=None,hasher=None,algorithm=None,tree=False):
     """
     Return the content id of a file specified by path.
+
+    The file is read by `hasher` (a :class:`CasFileHasher`) if one is
+    given, otherwise by a default one, and its content id is made using
+    hash `algorithm`.   If `tree` is set, the id is a tree hash.
     """
 
     if bc == 0:
@@ -180,32 +552,447 @@ def cas_file_to_id(p,bc=None):
         return None
     
     try:
-        return cas_fileno_to_id(f,bc)
+        return cas_fileno_to_id(f,bc,hasher,algorithm,tree)
     finally:
         os.close(f)
 
-def cas_fileno_to_id(f,bc=None):
+def cas_fileno_to_id(f,bc=None,hasher=None,algorithm=None,tree=False):
 
     if bc == 0:
         return CAS_ID_EMPTY
+
+    if hasher is None:
+        hasher = DEFAULT_HASHER
+
+    return hasher.fileno_to_id(f,bc,algorithm,tree)
+
+__doc__ += """
+
+Reading files
+-------------
+
+There is more than one way to feed a file to a :class:`CasItemBuilder`
+and the best one depends on the file and the host:
+
++---------------+--------------------------------------------------------------------+
+| Method        | Description                                                        |
++===============+====================================================================+
+| `READ_MMAP`   | Map the whole file and hash the mapping in one go.  Fast for small |
+|               | and medium files, but needs address space for the whole file.      |
++---------------+--------------------------------------------------------------------+
+| `READ_STREAM` | Read the file a block at a time into a buffer that is reused for   |
+|               | every block (and every file).  Memory use is bounded by the block  |
+|               | size, whatever the size of the file.                               |
++---------------+--------------------------------------------------------------------+
+| `READ_PIPE`   | Like `READ_STREAM`, but one thread reads ahead into a ring of      |
+|               | buffers while the caller hashes, so reading and hashing overlap.   |
++---------------+--------------------------------------------------------------------+
+| `READ_AUTO`   | Map files up to `MMAP_LIMIT` bytes, pipeline anything bigger.      |
++---------------+--------------------------------------------------------------------+
+
+.. autoclass:: CasFileHasher
+
+"""
+
+READ_MMAP='mmap'
+READ_STREAM='read'
+READ_PIPE='pipeline'
+READ_AUTO='auto'
+
+READ_METHODS=(READ_AUTO,READ_MMAP,READ_STREAM,READ_PIPE)
+
+# Number of buffers used by READ_PIPE
+
+PIPE_DEPTH=4
+
+MMAP_LIMIT=64*BLOCKSIZE
+
+# posix_fadvise() advice values (these are the Linux ones, used if
+# the os module can't tell us)
+
+POSIX_FADV_SEQUENTIAL=getattr(os,'POSIX_FADV_SEQUENTIAL',2)
+POSIX_FADV_DONTNEED=getattr(os,'POSIX_FADV_DONTNEED',4)
+
+def _libc_fadvise():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        f = libc.posix_fadvise64
+    except Exception:
+        return None
+    f.argtypes = (ctypes.c_int,ctypes.c_int64,ctypes.c_int64,ctypes.c_int)
+    f.restype = ctypes.c_int
+    return f
+
+_fadvise = getattr(os,'posix_fadvise',None) or _libc_fadvise()
+
+def fadvise(fd,offset,length,advice):
+    """Passes advice about the use of a file to the kernel, if it's able to
+    take advice.   Advice is only a hint, so failure is ignored.
+    """
+
+    if _fadvise is None:
+        return
+    try:
+        _fadvise(fd,offset,length,advice)
+    except Exception:
+        pass
+
+# The FIEMAP ioctl, from <linux/fs.h> and <linux/fiemap.h>; ioctl()
+# wants the request as a C int
+
+FS_IOC_FIEMAP=struct.unpack('i',struct.pack('I',0xC020660B))[0]
+FIEMAP_MAX_OFFSET=(1<<64)-1
+
+_FIEMAP=struct.Struct('=QQIIII')                # struct fiemap, without its extents
+_FIEMAP_EXTENT=struct.Struct('=QQQQQIIII')      # struct fiemap_extent
+
+def physical_offset(fd):
+    """Returns where on its device the data of open file `fd` starts, in
+    bytes, or None if the filesystem can't say.   A file with no data
+    on the device at all (it's empty, say) starts at 0.
+    """
+
+    buf = array.array('B',[0]*(_FIEMAP.size+_FIEMAP_EXTENT.size))
+    _FIEMAP.pack_into(buf,0,0,FIEMAP_MAX_OFFSET,0,0,1,0)
+    try:
+        fcntl.ioctl(fd,FS_IOC_FIEMAP,buf,True)
+    except (IOError,OSError):
+        return None
+
+    (start,length,flags,mapped,count,reserved) = _FIEMAP.unpack_from(buf,0)
+    if not mapped:
+        return 0
+    return _FIEMAP_EXTENT.unpack_from(buf,_FIEMAP.size)[1]
+
+def _unchanged(a,b):
+    """True if stat results `a` and `b` are for the same, unchanged, file"""
+
+    return (a.st_dev,a.st_ino,a.st_size,a.st_mtime,a.st_ctime) == (b.st_dev,b.st_ino,b.st_size,b.st_mtime,b.st_ctime)
+
+class CasFileHasher(object):
+    """
+    Computes the content ids of files, using one of the methods above.
+
+    `blocksize` is the size of the buffer used by `READ_STREAM`, and of
+    each of the `depth` buffers used by `READ_PIPE`.   If
+    `fadvise` is set, the kernel is told that the file will be read
+    sequentially and, as each block is hashed, that it won't be needed
+    again, so that hashing a big tree doesn't push everything else out
+    of the page cache.
+
+    Each thread using a hasher gets its own buffer.
+
+    When making tree hash ids of big files, a hasher with `jobs` more
+    than 1 hashes that many segments at once, in a pool of threads that
+    it keeps for the purpose until it is closed (see :meth:`close`).
+    The segments are those of the mapped file, unless the file can't be
+    mapped or the hasher has been told to read files (`READ_STREAM` or
+    `READ_PIPE`); then they are read one after another.
+
+    A hasher with a `cache` (a :class:`CasHashCache`) looks files up in
+    it before reading them, and adds the ids it computes.
+
+    .. automethod:: fileno_to_id
+    .. automethod:: close
+    """
+
+    def __init__(self,method=READ_AUTO,blocksize=BLOCKSIZE,fadvise=False,depth=PIPE_DEPTH,jobs=1,cache=None):
+
+        if method not in READ_METHODS:
+            raise ValueError("Unknown read method '%s'" % (method))
+
+        self.method = method
+        self.blocksize = blocksize
+        self.fadvise = fadvise
+        self.depth = depth
+        self.jobs = jobs
+        self.cache = cache
+        self._local = threading.local()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return dict(method=self.method,blocksize=self.blocksize,fadvise=self.fadvise,depth=self.depth,jobs=self.jobs,cache=self.cache)
+
+    def __setstate__(self,state):
+        self.__init__(**state)
+
+    def close(self):
+        """Stops the threads used to make tree hash ids, if there are
+        any; they are started again if they are needed.   Also writes
+        what the cache, if any, has yet to record."""
+
+        with self._lock:
+            (pool,self._pool) = (self._pool,None)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if self.cache is not None:
+            self.cache.flush()
+
+    def _workers(self):
+        with self._lock:
+            if self._pool is None:
+                from _workers import worker_pool
+                self._pool = worker_pool(self.jobs)
+            return self._pool
+
+    def fileno_to_id(self,f,bc=None,algorithm=None,tree=False):
+        """Returns the content id of the content of open file `f`, made
+        using hash `algorithm`, and as a tree hash if `tree` is set."""
+
+        algorithm = cas_algorithm(algorithm)
+        if self.cache is None:
+            return self._fileno_to_id(f,algorithm,tree)
+
+        # Only keep an id if the file didn't change while it was read
+
+        kind = algorithm.name+('.tree' if tree else '')
+        s = os.fstat(f)
+        cid = self.cache.get(f,s,kind)
+        if cid is not None:
+            return cid
+
+        cid = self._fileno_to_id(f,algorithm,tree)
+        if cid is not None and _unchanged(s,os.fstat(f)):
+            self.cache.put(f,s,kind,cid)
+        return cid
+
+    def _fileno_to_id(self,f,algorithm,tree):
+        builder = CasTreeBuilder if tree else CasItemBuilder
+
+        method = self.method
+        if method == READ_AUTO or (tree and self.jobs > 1):
+            size = os.fstat(f).st_size
+            if size == 0:
+                return CAS_ID_EMPTY
+            if tree and self.jobs > 1 and size > 2*SEGMENTSIZE:
+                return self._segments_to_id(f,algorithm)
+            if method == READ_AUTO:
+                method = READ_MMAP if size <= MMAP_LIMIT else READ_PIPE
+
+        b = builder(algorithm=algorithm)
+        if method == READ_MMAP:
+            return self._mmap_to_id(f,b)
+        if method == READ_PIPE:
+            return self._pipe_to_id(f,b)
+        return self._stream_to_id(f,b)
+
+    def _mmap_to_id(self,f,b):
+        try:
+            d = mmap.mmap(f,0,mmap.MAP_SHARED,mmap.PROT_READ)
+        except Exception,e:
+            log.warning("Failed to map: %s - reading instead" % (e))
+            return self._stream_to_id(f,b)
         
+        try:
+            b.add(d)
+            return b.cid
+        finally:
+            d.close()
+
+    def _segments_to_id(self,f,algorithm):
+        """ Makes a tree hash id by hashing segments in parallel """
+
+        pool = self._workers()
+        b = CasTreeBuilder(algorithm=algorithm)
+
+        if self.method in (READ_AUTO,READ_MMAP):
+            try:
+                d = mmap.mmap(f,0,mmap.MAP_SHARED,mmap.PROT_READ)
+            except Exception,e:
+                log.warning("Failed to map: %s - reading instead" % (e))
+            else:
+                try:
+                    size = len(d)
+                    segments = ((b,d,offset,min(SEGMENTSIZE,size-offset)) for offset in xrange(0,size,SEGMENTSIZE))
+                    for (digest,n) in pool.imap(_segment_leaf,segments):
+                        b.add_leaf(digest,n)
+                    return b.cid
+                finally:
+                    d.close()
+
+        return self._read_segments(f,b,pool)
+
+    def _read_segments(self,f,b,pool):
+        """ Reads segments one after another, hashing each of them in
+        `pool`, with no more than twice as many in memory as there are
+        workers """
+
+        r = io.FileIO(f,'r',closefd=False)
+        if self.fadvise:
+            fadvise(f,0,0,POSIX_FADV_SEQUENTIAL)
+
+        running = collections.deque()
+        offset = 0
+        try:
+            while True:
+                data = r.read(SEGMENTSIZE)
+                while data and len(data) < SEGMENTSIZE:
+                    more = r.read(SEGMENTSIZE-len(data))
+                    if not more:
+                        break
+                    data += more
+
+                if data:
+                    running.append(pool.apply_async(_segment_leaf,((b,data,0,len(data)),)))
+                    if self.fadvise:
+                        fadvise(f,offset,len(data),POSIX_FADV_DONTNEED)
+                    offset += len(data)
+
+                while running and (not data or len(running) > 2*self.jobs):
+                    (digest,n) = running.popleft().get()
+                    b.add_leaf(digest,n)
+
+                if not data:
+                    return b.cid
+        except Exception,e:
+            log.warning("Failed to read: %s" % (e))
+            return None
+
+    def _buffer(self):
+        buf = getattr(self._local,'buf',None)
+        if buf is None or len(buf) != self.blocksize:
+            buf = self._local.buf = bytearray(self.blocksize)
+        return buf
+
+    def _stream_to_id(self,f,b):
+
+        buf = self._buffer()
+        r = io.FileIO(f,'r',closefd=False)
+        if self.fadvise:
+            fadvise(f,0,0,POSIX_FADV_SEQUENTIAL)
+
+        try:
+            while True:
+                n = r.readinto(buf)
+                if not n:
+                    break
+                b.add(buffer(buf,0,n))
+                if self.fadvise:
+                    fadvise(f,b.size-n,n,POSIX_FADV_DONTNEED)
+        except Exception,e:
+            log.warning("Failed to read: %s" % (e))
+            return None
+
+        return b.cid
+
+    def _ring(self):
+        ring = getattr(self._local,'ring',None)
+        if ring is None or len(ring) != self.depth or len(ring[0]) != self.blocksize:
+            ring = self._local.ring = [bytearray(self.blocksize) for _ in range(0,self.depth)]
+        return ring
+
+    def _pipe_to_id(self,f,b):
+
+        free = Queue.Queue()
+        full = Queue.Queue()
+        for buf in self._ring():
+            free.put(buf)
+
+        if self.fadvise:
+            fadvise(f,0,0,POSIX_FADV_SEQUENTIAL)
+
+        reader = threading.Thread(target=_read_ahead,args=(f,free,full))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            while True:
+                (buf,n) = full.get()
+                if buf is None:
+                    log.warning("Failed to read: %s" % (n))
+                    return None
+                if not n:
+                    break
+                b.add(memoryview(buf)[:n])
+                free.put(buf)
+                if self.fadvise:
+                    fadvise(f,b.size-n,n,POSIX_FADV_DONTNEED)
+        finally:
+            free.put(None)      # in case the reader is still going
+            reader.join()
+
+        return b.cid
+
+def _segment_leaf(job):
+    """ Hashes one segment of a mapped file for :meth:`CasFileHasher._segments_to_id` """
+
+    (b,d,offset,n) = job
+    return (b.leaf(buffer(d,offset,n)),n)
+
+def _read_ahead(f,free,full):
+    """Reads open file `f` into buffers taken from queue `free`, passing
+    each one on to queue `full` as a (buffer,length) pair.   A length of
+    zero marks the end of the file; a buffer of None means the read
+    failed, and is accompanied by the exception.   Stops early if it
+    takes None from `free`.
+    """
+
+    r = io.FileIO(f,'r',closefd=False)
     try:
-        d = mmap.mmap(f,0,mmap.MAP_SHARED,mmap.PROT_READ)
+        while True:
+            buf = free.get()
+            if buf is None:
+                return
+            n = r.readinto(buf)
+            full.put((buf,n))
+            if not n:
+                return
     except Exception,e:
-        print "Failed to map: %s" % (e)
+        full.put((None,e))
+
+DEFAULT_HASHER=CasFileHasher()
+
+__doc__ += """
+
+Partial ids
+-----------
+
+A partial id is a cheap fingerprint of a file, made from its size and
+its first and last `PARTIALSIZE` bytes.   It is *not* a content id:
+files with different partial ids certainly differ, but files with the
+same partial id only probably match, and need their full content ids
+computing to be sure.
+
+.. autofunction:: cas_file_to_partial_id
+
+"""
+
+PARTIALSIZE=4096
+
+def cas_file_to_partial_id(p,size=None):
+    """
+    Return the partial id of a file specified by path, or None if
+    the file can't be read.
+    """
+
+    try:
+        f = os.open(p,os.O_RDONLY)
+    except:
         return None
-    
+
     try:
-        return cas_bytes_to_id(d,bc=None)
+        if size is None:
+            size = os.fstat(f).st_size
+
+        h = hashlib.md5(str(size))
+        h.update(os.read(f,PARTIALSIZE))
+        if size > PARTIALSIZE:
+            os.lseek(f,max(PARTIALSIZE,size-PARTIALSIZE),os.SEEK_SET)
+            h.update(os.read(f,PARTIALSIZE))
+        return h.hexdigest()
+    except:
+        return None
     finally:
-        d.close()
+        os.close(f)
 
-def cas_bytes_to_id(b,bc=None):
+def cas_bytes_to_id(b,bc=None,algorithm=None):
 
     if bc is not None and bc != len(b):
         return None
 
-    return CasItemBuilder(b).cid
+    return CasItemBuilder(b,algorithm).cid
 
 class CasItemId(object):
     """
@@ -241,7 +1028,7 @@ def CasId(ci):
     """
     
     if isinstance(ci,basestring):
-        if ci.startswith('I') or ci.startswith('L'):
+        if ci[:1] in CAS_ID_RESERVED or cas_id_algorithm(ci):
             return ci
     try:
         return ci.cid
@@ -0,0 +1,198 @@
+#
+# a hash cache shared by every store on the host
+#
+
+"""
+
+Hash cache
+----------
+
+Stores that overlap (a project and the archive that holds it), and
+anything else that asks for the content id of a file, each hash the
+same files for themselves.   A :class:`CasHashCache` is an SQLite
+database, shared by every process that uses it, of content ids that
+have already been computed, keyed by the volume (see :func:`volume_id`)
+and inode of the file, and valid for as long as its size, mtime and
+ctime stay the same.
+
+A :class:`CasFileHasher` that has a cache looks each file up before it
+reads it, and adds what it computes, so refreshing a store that covers
+files another store has already hashed costs little more than a scan.
+
+Each kind of id (hash algorithm, and whether it is a tree hash) is kept
+separately.   Once there are more than `limit` ids, those that have gone
+unused longest are dropped.   Looking an id up doesn't write to the
+database: uses are noted in memory, only if the id hasn't been used for
+:data:`CACHE_TOUCH_AGE` seconds, and written :data:`CACHE_TOUCH` at a
+time (or by :meth:`CasHashCache.flush`), so that processes that are only
+reading don't queue for the write lock.
+
+The database is in write-ahead-log mode, so readers don't wait for
+writers, and anything that goes wrong with it just means a file gets
+hashed.
+
+.. autoclass:: CasHashCache
+
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from _volume import volume_id
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+CACHE_LIMIT=1000000     # Ids kept
+CACHE_TIMEOUT=60        # Seconds to wait for other processes
+CACHE_EVICT=1000        # Ids added between checks of the size
+CACHE_TOUCH=1000        # Uses noted between writes of them
+CACHE_TOUCH_AGE=3600    # Seconds an id goes unused before a use is noted
+
+def default_cache_path():
+    """Where the cache lives unless told otherwise"""
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),'.cache')
+    return os.path.join(base,'rjgtoys-cas','hashes.sqlite')
+
+_SCHEMA = """
+create table if not exists hashes (
+    volume text not null,
+    ino integer not null,
+    kind text not null,
+    size integer not null,
+    mtime real not null,
+    ctime real not null,
+    cid text not null,
+    used real not null,
+    primary key (volume,ino,kind)
+);
+create index if not exists hashes_used on hashes (used);
+"""
+
+class CasHashCache(object):
+    """
+    A cache of content ids in the SQLite database at `path` (by default,
+    see :func:`default_cache_path`), holding at most `limit` ids.
+
+    Each thread gets its own connection.
+
+    .. automethod:: get
+    .. automethod:: put
+    .. automethod:: flush
+    .. automethod:: evict
+    """
+
+    def __init__(self,path=None,limit=CACHE_LIMIT):
+        self.path = path or default_cache_path()
+        self.limit = limit
+        self._local = threading.local()
+        self._volumes = {}      # Volume id of each device number
+        self._added = 0
+        self._used = {}         # Time of each use not yet written, by rowid
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return dict(path=self.path,limit=self.limit)
+
+    def __setstate__(self,state):
+        self.__init__(**state)
+
+    def _db(self):
+        db = getattr(self._local,'db',None)
+        if db is None:
+            d = os.path.dirname(self.path)
+            if d and not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    pass        # Someone else got there first
+            db = sqlite3.connect(self.path,timeout=CACHE_TIMEOUT)
+            db.execute("pragma journal_mode=wal")
+            db.execute("pragma synchronous=normal")
+            db.executescript(_SCHEMA)
+            self._local.db = db
+        return db
+
+    def _volume(self,f,dev):
+        vid = self._volumes.get(dev,None)
+        if vid is None:
+            vid = self._volumes[dev] = volume_id(f,dev) or "dev:%d" % (dev)
+        return vid
+
+    def get(self,f,s,kind):
+        """Returns the id of `kind` of open file `f`, whose stat result
+        is `s`, or None if it isn't known"""
+
+        vid = self._volume(f,s.st_dev)
+        try:
+            r = self._db().execute("select cid,rowid,used from hashes where volume=? and ino=? and kind=? and size=? and mtime=? and ctime=?",
+                (vid,s.st_ino,kind,s.st_size,s.st_mtime,s.st_ctime)).fetchone()
+        except sqlite3.Error,e:
+            log.warning("Hash cache %s: %s" % (self.path,e))
+            return None
+
+        if r is None:
+            return None
+
+        (cid,rowid,used) = r
+        now = time.time()
+        if now-used > CACHE_TOUCH_AGE:
+            with self._lock:
+                self._used[rowid] = now
+                full = len(self._used) >= CACHE_TOUCH
+            if full:
+                self.flush()
+        return cid
+
+    def put(self,f,s,kind,cid):
+        """Records that the id of `kind` of open file `f`, whose stat
+        result is `s`, is `cid`"""
+
+        vid = self._volume(f,s.st_dev)
+        try:
+            db = self._db()
+            with db:
+                db.execute("insert or replace into hashes values (?,?,?,?,?,?,?,?)",
+                    (vid,s.st_ino,kind,s.st_size,s.st_mtime,s.st_ctime,cid,time.time()))
+        except sqlite3.Error,e:
+            log.warning("Hash cache %s: %s" % (self.path,e))
+            return
+
+        self._added += 1
+        if self._added >= CACHE_EVICT:
+            self.evict()
+
+    def flush(self):
+        """Writes the uses of ids that :meth:`get` has noted"""
+
+        with self._lock:
+            (used,self._used) = (self._used,{})
+        if not used:
+            return
+
+        try:
+            db = self._db()
+            with db:
+                db.executemany("update hashes set used=? where rowid=?",((t,rowid) for (rowid,t) in used.iteritems()))
+        except sqlite3.Error,e:
+            log.warning("Hash cache %s: %s" % (self.path,e))
+
+    def evict(self):
+        """Drops the ids that have gone unused longest, until there
+        are no more than `limit`"""
+
+        self.flush()
+        self._added = 0
+        try:
+            db = self._db()
+            with db:
+                (n,) = db.execute("select count(*) from hashes").fetchone()
+                if n > self.limit:
+                    db.execute("delete from hashes where rowid in (select rowid from hashes order by used limit ?)",(n-self.limit,))
+                    log.verbose("Dropped %d ids from hash cache %s" % (n-self.limit,self.path))
+        except sqlite3.Error,e:
+            log.warning("Hash cache %s: %s" % (self.path,e))
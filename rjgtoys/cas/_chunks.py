@@ -0,0 +1,256 @@
+#
+# content-defined chunking
+#
+
+"""
+
+Chunked content
+---------------
+
+A big file that changes a little at a time is better described as a
+list of chunks than by a single content id: when it changes, only the
+chunks around the change get new ids, so only those need storing or
+transferring, and chunks that appear in more than one file (or more than
+one version of a file) are only stored once.
+
+The chunk boundaries are found from the content itself, using the
+'gear' rolling hash and the normalised chunking of FastCDC (see
+https://www.usenix.org/conference/atc16/technical-sessions/presentation/xia),
+so that an insertion or deletion only moves the boundaries near it.
+
+The content id of a chunked file is made from its manifest: the list of
+the (content id, size) pairs of its chunks.   It starts with
+`CAS_ID_CHUNKED` so it is never confused with the id of the plain data,
+followed by the prefix of the hash algorithm used.
+
+The boundaries are found a block at a time with :mod:`numpy`, if it is
+available: the gear hash only depends on the last 64 bytes, so the hash
+at every position of a block can be computed at once, by doubling.
+Without :mod:`numpy`, a loop over each byte finds the same boundaries,
+but is a great deal slower than simply hashing the data.   Either way,
+only files that have changed since they were last chunked are read.
+
+.. autoclass:: CasChunker
+.. autofunction:: cas_manifest_to_id
+.. autofunction:: cas_manifest_offsets
+
+"""
+
+import os
+import io
+import base64
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from _base import BLOCKSIZE, CAS_ID_CHUNKED, CAS_ID_EMPTY, cas_algorithm, cas_string_to_id
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+# Default chunk sizes
+
+CHUNK_MIN=256*1024
+CHUNK_AVG=1024*1024
+CHUNK_MAX=4*1024*1024
+
+# Files smaller than this are not worth chunking
+
+CHUNK_THRESHOLD=16*1024*1024
+
+M64=(1<<64)-1
+
+# The gear table must never change: chunk boundaries, and therefore
+# ids, depend on it.
+
+GEAR=[int(hashlib.md5(chr(i)).hexdigest()[:16],16) for i in range(0,256)]
+
+# Bytes searched for a boundary at a time, when that's done with numpy
+
+CUT_BLOCK=256*1024
+
+if numpy is not None:
+    _GEAR = numpy.array(GEAR,dtype=numpy.uint64)
+    _SHIFTS = [(k,numpy.uint64(k)) for k in (1,2,4,8,16,32)]
+
+def _mask(bits):
+    """ A mask of the top `bits` bits of a 64 bit hash: with a gear
+    hash the high bits depend on the most bytes.
+    """
+
+    return ((1<<bits)-1) << (64-bits)
+
+class CasChunker(object):
+    """
+    Splits content into chunks of between `minsize` and `maxsize` bytes,
+    averaging roughly `avgsize`.   Only files of at least `threshold`
+    bytes are chunked.
+
+    .. automethod:: cut
+    .. automethod:: chunks
+    .. automethod:: file_to_chunks
+    """
+
+    def __init__(self,minsize=CHUNK_MIN,avgsize=CHUNK_AVG,maxsize=CHUNK_MAX,threshold=CHUNK_THRESHOLD):
+
+        if not (0 < minsize <= avgsize <= maxsize):
+            raise ValueError("Chunk sizes must satisfy 0 < min <= avg <= max")
+
+        self.minsize = minsize
+        self.avgsize = avgsize
+        self.maxsize = maxsize
+        self.threshold = threshold
+
+        bits = max(avgsize.bit_length()-1,2)
+        self._hard = _mask(bits+1)      # Used below the average size
+        self._easy = _mask(bits-1)      # ... and above it
+
+    def __getstate__(self):
+        return dict(minsize=self.minsize,avgsize=self.avgsize,maxsize=self.maxsize,threshold=self.threshold)
+
+    def __setstate__(self,state):
+        self.__init__(**state)
+
+    def __eq__(self,other):
+        return isinstance(other,CasChunker) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self,other):
+        return not self == other
+
+    def wants(self,size):
+        """ Returns True if a file of `size` bytes should be chunked """
+
+        return size is not None and size >= self.threshold
+
+    def cut(self,data,n):
+        """ Returns the length of the first chunk of the first `n` bytes
+        of bytearray `data`, assuming there is no more data after them.
+        """
+
+        if n <= self.minsize:
+            return n
+        if n > self.maxsize:
+            n = self.maxsize
+
+        normal = min(self.avgsize,n)
+        if numpy is not None:
+            return self._cut_blocks(data,n,normal)
+
+        gear = GEAR
+        h = 0
+        i = self.minsize
+
+        mask = self._hard
+        while i < normal:
+            h = ((h << 1) + gear[data[i]]) & M64
+            i += 1
+            if not h & mask:
+                return i
+
+        mask = self._easy
+        while i < n:
+            h = ((h << 1) + gear[data[i]]) & M64
+            i += 1
+            if not h & mask:
+                return i
+
+        return n
+
+    def _cut_blocks(self,data,n,normal):
+        """ Does what the loops in :meth:`cut` do, a block at a time """
+
+        b = numpy.frombuffer(data,dtype=numpy.uint8,count=n)
+        hard = numpy.uint64(self._hard)
+        easy = numpy.uint64(self._easy)
+
+        i = self.minsize
+        while i < n:
+            end = min(i+CUT_BLOCK,n)
+
+            # The hash after each byte from i to end, computed from
+            # the 63 bytes before i as well (but none before minsize,
+            # where the hash starts)
+
+            start = max(i-63,self.minsize)
+            h = _GEAR[b[start:end]]
+            for (k,shift) in _SHIFTS:
+                h[k:] += h[:-k] << shift
+            h = h[i-start:]
+
+            split = min(max(normal-i,0),len(h))
+            found = numpy.flatnonzero((h[:split] & hard) == 0)
+            if not len(found):
+                found = numpy.flatnonzero((h[split:] & easy) == 0)+split
+            if len(found):
+                return i+int(found[0])+1
+            i = end
+
+        return n
+
+    def chunks(self,f,blocksize=BLOCKSIZE):
+        """ Generates the chunks of the content of open file `f` """
+
+        r = io.FileIO(f,'r',closefd=False)
+        pending = bytearray()
+        eof = False
+
+        while pending or not eof:
+            while not eof and len(pending) < self.maxsize:
+                b = r.read(blocksize)
+                if not b:
+                    eof = True
+                else:
+                    pending += b
+
+            if not pending:
+                break
+
+            n = self.cut(pending,len(pending))
+            yield str(pending[:n])
+            del pending[:n]
+
+    def file_to_chunks(self,p,algorithm=None):
+        """ Returns the manifest of a file specified by path: a list of
+        [content id, size] pairs, one per chunk.   Returns None if the file
+        can't be read.
+        """
+
+        try:
+            f = os.open(p,os.O_RDONLY)
+        except:
+            return None
+
+        try:
+            return [[cas_string_to_id(c,algorithm),len(c)] for c in self.chunks(f)]
+        except Exception,e:
+            log.warning("Failed to read %s: %s" % (p,e))
+            return None
+        finally:
+            os.close(f)
+
+def cas_manifest_to_id(chunks,algorithm=None):
+    """ Returns the content id of a chunk manifest, as returned by
+    :meth:`CasChunker.file_to_chunks`.
+    """
+
+    if not chunks:
+        return CAS_ID_EMPTY
+
+    a = cas_algorithm(algorithm)
+    h = a.new()
+    for (cid,size) in chunks:
+        h.update("%s %d\n" % (cid,size))
+
+    return CAS_ID_CHUNKED+a.prefix+base64.b64encode(h.digest(),'._')
+
+def cas_manifest_offsets(chunks):
+    """ Generates (content id, offset, size) for each chunk in a manifest """
+
+    offset = 0
+    for (cid,size) in chunks:
+        yield (cid,offset,size)
+        offset += size
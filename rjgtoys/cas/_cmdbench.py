@@ -0,0 +1,370 @@
+#
+# hashing throughput benchmarks
+#
+
+"""
+
+Benchmarks
+----------
+
+Computing content ids is where a refresh spends its time, and the best
+way to read files (see :class:`CasFileHasher`) depends on the host: its
+disks, its page cache and its cores.   The `bench` command measures the
+real id path, :func:`cas_file_to_id`, over every combination of
+
+- read method (mmap, streamed with `readinto`, or pipelined),
+- block size,
+- hash algorithm,
+- file size,
+- number of files hashed at once, and
+- a cold or warm page cache.
+
+Each measurement is written as one line of JSON, so that results from
+different hosts or different versions can be compared, and defaults
+picked for each host.
+
+For a cold cache the files are dropped from the page cache with
+`posix_fadvise` before each run, which needs no privileges but only
+drops clean pages; the files are synced when they are created so that
+all of their pages are clean.
+
+Test files are made in a scratch directory, as many of each size as
+the most files to be hashed at once, and are removed afterwards.
+Existing files can be measured instead.
+
+With `--refresh`, the command instead times refreshes of an existing
+tree, starting with no metadata so that every file is hashed, once for each of the orders in which a refresh can hash
+files (see :meth:`CasFileTreeStore.refresh`); that is the way to see
+whether ordering by inode or disk position pays on a particular disk.
+Only the page cache can be dropped, not the kernel's caches of
+directories and inodes, so a cold refresh here is still warmer than
+the first one after a reboot.
+
+.. autoclass:: BenchCommand
+.. autofunction:: bench
+.. autofunction:: bench_refresh
+.. autofunction:: parse_size
+
+"""
+
+import sys
+import os
+import time
+import json
+import socket
+import platform
+import shutil
+import tempfile
+import stat
+from argparse import ArgumentParser
+
+from _base import CasFileHasher, cas_file_to_id, fadvise, POSIX_FADV_DONTNEED
+from _base import BLOCKSIZE, READ_MMAP, READ_STREAM, READ_PIPE, CAS_ALGORITHMS
+from _workers import worker_pool
+from _files import CasFileTreeStore, HASH_ORDERS, statdir
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+CACHE_COLD='cold'
+CACHE_WARM='warm'
+
+# Defaults
+
+BENCH_METHODS=(READ_MMAP,READ_STREAM,READ_PIPE)
+BENCH_BLOCKSIZES=(64*1024,BLOCKSIZE,8*BLOCKSIZE)
+BENCH_SIZES=(100,64*1024,BLOCKSIZE,64*BLOCKSIZE,512*BLOCKSIZE)
+BENCH_THREADS=(1,)
+BENCH_CACHES=(CACHE_WARM,CACHE_COLD)
+
+# Never written, but must not exist
+
+BENCH_METADATA='.casbench'
+
+SIZE_UNITS=dict(K=1<<10,M=1<<20,G=1<<30,T=1<<40)
+
+def parse_size(s):
+    """Parses a size such as '512', '64K', '1M' or '10G' (powers of 1024)"""
+
+    s = s.strip().upper()
+    if s.endswith('B'):
+        s = s[:-1]
+    unit = SIZE_UNITS.get(s[-1:],None)
+    if unit is None:
+        return int(s)
+    return int(float(s[:-1])*unit)
+
+def size_list(s):
+    return [parse_size(x) for x in s.split(',') if x]
+
+def int_list(s):
+    return [int(x) for x in s.split(',') if x]
+
+def str_list(s):
+    return [x for x in s.split(',') if x]
+
+def make_file(p,size):
+    """Creates a file of `size` bytes of data that doesn't compress;
+    the whole file is written, so there are no holes"""
+
+    block = os.urandom(min(size,BLOCKSIZE))
+    with open(p,'wb') as f:
+        left = size
+        while left > 0:
+            f.write(block[:left])
+            left -= len(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+def drop_cache(p):
+    """Asks the kernel to drop file `p` from the page cache"""
+
+    f = os.open(p,os.O_RDONLY)
+    try:
+        fadvise(f,0,0,POSIX_FADV_DONTNEED)
+    finally:
+        os.close(f)
+
+def warm_cache(p):
+    """Reads file `p` so that it is in the page cache"""
+
+    with open(p,'rb') as f:
+        while f.read(BLOCKSIZE):
+            pass
+
+def _hash_one(job):
+    (p,size,hasher,algorithm) = job
+    return cas_file_to_id(p,size,hasher,algorithm)
+
+def bench(files,method,blocksize,algorithm,cache,repeat=1):
+    """
+    Measures the time taken to compute the ids of all of `files` (a list
+    of (path, size) pairs) at once, one thread per file, reading them with
+    a :class:`CasFileHasher` that uses `method` and `blocksize`.
+    Returns the best time of `repeat` runs, in seconds.
+    """
+
+    hasher = CasFileHasher(method=method,blocksize=blocksize)
+    jobs = [(p,size,hasher,algorithm) for (p,size) in files]
+
+    pool = worker_pool(len(files)) if len(files) > 1 else None
+    best = None
+    try:
+        for i in range(0,repeat):
+            for (p,size) in files:
+                if cache == CACHE_COLD:
+                    drop_cache(p)
+                else:
+                    warm_cache(p)
+
+            t0 = time.time()
+            if pool is None:
+                ids = map(_hash_one,jobs)
+            else:
+                ids = pool.map(_hash_one,jobs)
+            t = time.time()-t0
+
+            if None in ids:
+                raise IOError("Failed to read %s" % (files[ids.index(None)][0]))
+
+            if best is None or t < best:
+                best = t
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return best
+
+def bench_refresh(d,order,cache,jobs=1,repeat=1):
+    """
+    Measures the time taken by a full refresh of tree `d`, hashing
+    files in `order` with `jobs` workers.   Returns the best time of
+    `repeat` runs, in seconds, and the number of bytes hashed.
+    """
+
+    files = [os.path.join(d,p) for (p,s) in statdir(d) if stat.S_ISREG(s.st_mode)]
+    total = sum(os.path.getsize(p) for p in files)
+
+    best = None
+    for i in range(0,repeat):
+        # A store with no metadata, so that everything gets hashed
+
+        store = CasFileTreeStore(content=d,metadata=BENCH_METADATA,refresh=False)
+
+        for p in files:
+            if cache == CACHE_COLD:
+                drop_cache(p)
+            else:
+                warm_cache(p)
+
+        t0 = time.time()
+        store.refresh(jobs=jobs,order=order)
+        t = time.time()-t0
+
+        if best is None or t < best:
+            best = t
+
+    return (best,total)
+
+def host_info():
+    """What the results depend on, other than the parameters of each run"""
+
+    return dict(host=socket.gethostname(),platform=platform.platform(),
+        python=platform.python_version(),cpus=_cpu_count())
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+class BenchCommand(object):
+    """
+    Measures hashing throughput; see the module documentation.
+    """
+
+    def __init__(self):
+        pass
+
+    def build_parser(self):
+        p = ArgumentParser()
+
+        log.add_options(p)
+        self.add_options(p)
+
+        return p
+
+    def add_options(self,p):
+
+        p.add_argument('-o','--output',dest='output',help="Append results to this file (default: standard output)",default=None)
+        p.add_argument('--dir',dest='dir',help="Make test files in this directory (default: a temporary directory)",default=None)
+        p.add_argument('--methods',dest='methods',help="Read methods to measure (comma-separated)",
+            type=str_list,default=list(BENCH_METHODS))
+        p.add_argument('--blocksizes',dest='blocksizes',help="Block sizes to measure (comma-separated, e.g. 64K,1M)",
+            type=size_list,default=list(BENCH_BLOCKSIZES))
+        p.add_argument('--algorithms',dest='algorithms',help="Hash algorithms to measure (comma-separated; default all)",
+            type=str_list,default=None)
+        p.add_argument('--sizes',dest='sizes',help="File sizes to measure (comma-separated, e.g. 100,1M,10G)",
+            type=size_list,default=list(BENCH_SIZES))
+        p.add_argument('--threads',dest='threads',help="Numbers of files to hash at once (comma-separated)",
+            type=int_list,default=list(BENCH_THREADS))
+        p.add_argument('--cache',dest='caches',help="Page cache states to measure (comma-separated: warm,cold)",
+            type=str_list,default=list(BENCH_CACHES))
+        p.add_argument('--repeat',dest='repeat',help="Runs of each measurement; the best is reported",default=3,action="store",type=int)
+
+        p.add_argument('--refresh',dest='refresh',help="Time refreshes of this tree instead, in each hash order",default=None)
+        p.add_argument('--orders',dest='orders',help="Hash orders to measure with --refresh (comma-separated)",
+            type=str_list,default=list(HASH_ORDERS))
+
+        p.add_argument('files',metavar='file',nargs='*',help="Measure these files rather than making test files")
+
+    def parse_args(self,argv):
+        p = self.build_parser()
+        opts = p.parse_args(argv)
+        log.handle_options(opts)
+        return opts
+
+    def main(self,argv=None):
+
+        if argv is None:
+            argv = sys.argv[1:]
+
+        opts = self.parse_args(argv)
+
+        return self.run(opts)
+
+    def run(self,opts):
+
+        for m in opts.methods:
+            if m not in BENCH_METHODS:
+                raise ValueError("Unknown read method '%s'" % (m))
+        for c in opts.caches:
+            if c not in BENCH_CACHES:
+                raise ValueError("Unknown cache state '%s'" % (c))
+        for o in opts.orders:
+            if o not in HASH_ORDERS:
+                raise ValueError("Unknown hash order '%s'" % (o))
+
+        algorithms = opts.algorithms or sorted(CAS_ALGORITHMS)
+
+        if opts.output is None:
+            out = sys.stdout
+        else:
+            out = open(opts.output,'a')
+
+        scratch = None
+        try:
+            if opts.refresh is not None:
+                results = self.measure_refresh(opts)
+            else:
+                if opts.files:
+                    groups = [[(p,os.path.getsize(p)) for p in opts.files]]
+                else:
+                    scratch = tempfile.mkdtemp(prefix='casbench',dir=opts.dir)
+                    groups = self.make_files(scratch,opts.sizes,max(opts.threads))
+                results = (r for files in groups for r in self.measure(files,opts,algorithms))
+
+            info = host_info()
+            for result in results:
+                result.update(info)
+                out.write(json.dumps(result,sort_keys=True)+'\n')
+                out.flush()
+        finally:
+            if scratch is not None:
+                shutil.rmtree(scratch,ignore_errors=True)
+            if out is not sys.stdout:
+                out.close()
+
+    def measure_refresh(self,opts):
+        """Generates one result for each order, number of threads and cache state"""
+
+        for threads in opts.threads:
+            for order in opts.orders:
+                for cache in opts.caches:
+                    (t,total) = bench_refresh(opts.refresh,order,cache,threads,opts.repeat)
+                    log.verbose("refresh %s %s: %d bytes in %fs" % (order,cache,total,t))
+                    yield dict(method='refresh',order=order,cache=cache,threads=threads,
+                        bytes=total,seconds=t,mbps=(total/t/(1<<20)) if t else None)
+
+    def make_files(self,d,sizes,n):
+        """Makes `n` test files of each of `sizes` in directory `d`;
+        returns a list of lists of (path, size), one list per size"""
+
+        groups = []
+        for size in sizes:
+            log.verbose("Making %d files of %d bytes" % (n,size))
+            files = []
+            for i in range(0,n):
+                p = os.path.join(d,"%d-%d" % (size,i))
+                make_file(p,size)
+                files.append((p,size))
+            groups.append(files)
+        return groups
+
+    def measure(self,files,opts,algorithms):
+        """Generates one result for each combination of parameters"""
+
+        for threads in opts.threads:
+            if opts.files:
+                batch = files
+            else:
+                batch = files[:threads]
+            total = sum(size for (p,size) in batch)
+            for algorithm in algorithms:
+                for method in opts.methods:
+                    # Mapped files don't use a block size
+                    blocksizes = opts.blocksizes[:1] if method == READ_MMAP else opts.blocksizes
+                    for blocksize in blocksizes:
+                        for cache in opts.caches:
+                            t = bench(batch,method,blocksize,algorithm,cache,opts.repeat)
+                            log.verbose("%s %s %d %s: %d bytes in %fs" % (algorithm,method,blocksize,cache,total,t))
+                            yield dict(method=method,blocksize=blocksize,algorithm=algorithm,
+                                cache=cache,threads=len(batch),size=total/len(batch),
+                                bytes=total,seconds=t,mbps=(total/t/(1<<20)) if t else None)
+
+if __name__ == "__main__":
+    c = BenchCommand()
+    c.main()
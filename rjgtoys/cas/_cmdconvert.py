@@ -0,0 +1,73 @@
+#
+# a command to change the format
+# of the metadata of a store
+#
+
+"""
+
+.. autoclass:: ConvertCommand
+
+"""
+
+import sys
+from argparse import ArgumentParser
+
+from _base import CasStore
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+class ConvertCommand(object):
+    """
+    Loads the metadata of a store from one file and saves all of it to
+    another, whose name decides its format: for example, from ``.cas``
+    (compressed JSON) to ``.cas.sqlite`` (SQLite) or ``.cas.pack``
+    (packed), or back.
+    """
+    
+    def __init__(self):
+        pass
+
+    def build_parser(self):
+        p = ArgumentParser()
+
+        log.add_options(p)
+        self.add_options(p)
+        
+        return p
+        
+    def add_options(self,p):
+
+        p.add_argument('cas',metavar='source',type=str,help="Store to convert")
+        p.add_argument('source',metavar='from',type=str,help="Metadata file to read, relative to the store")
+        p.add_argument('target',metavar='to',type=str,help="Metadata file to write, relative to the store")
+        
+    def parse_args(self,argv):
+        p = self.build_parser()
+        opts = p.parse_args(argv)
+        log.handle_options(opts)
+        return opts
+        
+    def main(self,argv=None):
+        
+        if argv is None:
+            argv = sys.argv[1:]
+        
+        opts = self.parse_args(argv)
+        
+        return self.run(opts)
+
+    def run(self,opts):
+
+        cas = CasStore(opts.cas,refresh=False,metadata=opts.source)
+        if cas.save(opts.target,full=True):
+            log.info("Saved %s as %s" % (opts.source,opts.target))
+            return 0
+
+        log.error("Failed to save %s" % (opts.target))
+        return 1
+
+if __name__ == "__main__":
+    c = ConvertCommand()
+    sys.exit(c.main())
@@ -7,11 +7,29 @@ import sys
 from argparse import ArgumentParser
 
 from _base import CasStore
+from _files import OTYPE_FILE, OTYPE_DIR
 
 from rjgtoys import logs
 
 log = logs.getLogger(__name__)
 
+def groups(items,key):
+    """ Group items by key(item), returning
+    only the groups that have more than one member """
+
+    seen = {}
+    for i in items:
+        k = key(i)
+        if k is None:
+            continue
+
+        try:
+            seen[k].append(i)
+        except:
+            seen[k] = [i]
+
+    return [g for g in seen.itervalues() if len(g) > 1]
+
 class DupsCommand(object):
     
     def __init__(self):
@@ -27,6 +45,8 @@ class DupsCommand(object):
         
     def add_options(self,p):
 
+        p.add_argument('-q','--quick',dest='quick',help="Only hash files that might be duplicates",action="store_true",default=False)
+        p.add_argument('-n','--dryrun',dest='dryrun',help="Dry run: don't write anything back",action="store_true",default=False)
         p.add_argument('cas',metavar='source',type=str,help="Source store")
         
     def parse_args(self,argv):
@@ -47,28 +67,52 @@ class DupsCommand(object):
     def run(self,opts):
         
         cas = CasStore(opts.cas,refresh=False)
-        
-        seen = {}
-        
-        
-        
-        for i in cas:
-            if i.cid is None:
-                continue
 
-            try:
-                seen[i.cid].append(i.path)
-            except:
-                seen[i.cid] = [i.path]
+        if opts.quick:
+            items = self.candidates(cas)
+            if not opts.dryrun:
+                cas.save()
+        else:
+            items = [i for i in cas if i.otype != OTYPE_DIR]
 
-        for i,ps in seen.iteritems():
-            if len(ps) == 1:
-                continue
+        for g in groups(items,lambda i: i.cid):
+            print g[0].cid
+            # Hard links to one file are shown together
 
-            print i
-            for p in sorted(ps):
+            for p in sorted(" = ".join(i.paths) for i in g):
                 print "  ",p
 
+    def candidates(self,cas):
+        """
+        Scan the store without hashing anything, and then narrow down
+        the items that might be duplicates: first by size, then by partial
+        id.   Only the items that survive both get their content ids
+        computed.   Returns those items, except any that couldn't be.
+        """
+
+        cas.refresh(rehash=False)
+
+        bysize = groups((i for i in cas if i.otype != OTYPE_DIR),lambda i: (i.otype,i.size))
+        log.verbose("%d groups of items share a size" % (len(bysize)))
+
+        bypartial = []
+        for g in bysize:
+            if g[0].otype == OTYPE_FILE:
+                bypartial += groups(g,lambda i: i.partial(cas.content))
+            else:
+                bypartial.append(g)
+
+        log.verbose("%d groups of items share a partial id" % (len(bypartial)))
+
+        result = []
+        for g in bypartial:
+            for i in g:
+                if i.stale:
+                    cas.refresh_item(i)
+            result += [i for i in g if not i.stale]
+
+        return result
+
 if __name__ == "__main__":
     c = DupsCommand()
     c.main()
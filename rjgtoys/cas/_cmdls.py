@@ -2,6 +2,7 @@
 # sketch of an ls command
 
 import sys
+import os
 from argparse import ArgumentParser
 
 from _base import CasStore
@@ -25,7 +26,9 @@ class ListCommand(object):
         
     def add_options(self,p):
 
+        p.add_argument('-m','--metadata',dest='metadata',help="Metadata file of the store, relative to it",default=None)
         p.add_argument('cas',metavar='source',type=str,help="Source store")
+        p.add_argument('paths',metavar='path',nargs='*',help="Only list these directories, relative to the store")
         
     def parse_args(self,argv):
         p = self.build_parser()
@@ -44,11 +47,21 @@ class ListCommand(object):
 
     def run(self,opts):
         
-        cas = CasStore(opts.cas,refresh=False)
-        
-        for i in cas:
+        cas = CasStore(opts.cas,refresh=False,metadata=opts.metadata)
+
+        if opts.paths:
+            # Only what's needed is loaded
+            for d in opts.paths:
+                d = d.strip('/')
+                for (name,i) in cas.items_in(d):
+                    print i.printable(os.path.join(d,name))
+            return
+
+        # Nor is everything loaded to list it all
+        for i in cas.items():
             try:
-                print i.printable()
+                for p in i.paths:
+                    print i.printable(p)
             except Exception,e:
                 print >>sys.stderr, "Error: %s" % (e)
                 print >>sys.stderr, type(i.path)
@@ -4,7 +4,11 @@
 import sys
 from argparse import ArgumentParser
 
-from _base import CasStore
+from _base import CasStore, CasFileHasher, READ_AUTO, READ_METHODS, BLOCKSIZE, CAS_ALGORITHMS
+from _workers import POOL_THREADS, POOL_PROCESSES
+from _chunks import CasChunker, CHUNK_THRESHOLD
+from _files import HASH_ORDERS, ORDER_FOUND
+from _cache import CasHashCache, CACHE_LIMIT, default_cache_path
 
 import cas
 
@@ -29,8 +33,36 @@ class RefreshCommand(object):
 
         p.add_argument('-n','--dryrun',dest='dryrun',help="Dry run: don't write anything back",action="store_true",default=False)
         p.add_argument('-f','--force',dest='force',help="Force a full scan",action="store_true",default=False)
+        p.add_argument('--no-resume',dest='resume',help="Forget what an interrupted refresh was asked to do (such as --force), rather than finishing it",
+            action="store_false",default=True)
         p.add_argument('-c','--checkpoint',dest='cp',help="Checkpoint data periodically (seconds)",default=0,action="store",type=int)
+        p.add_argument('-j','--jobs',dest='jobs',help="Number of items to hash in parallel",default=1,action="store",type=int)
+        p.add_argument('--scan-jobs',dest='scan_jobs',help="Number of directories to scan in parallel",default=1,action="store",type=int)
+        p.add_argument('--order',dest='order',help="Order in which to hash files: as found, or by inode or disk position (for spinning disks)",
+            choices=HASH_ORDERS,default=ORDER_FOUND)
+        p.add_argument('--processes',dest='backend',help="Hash in worker processes rather than threads",
+            action="store_const",const=POOL_PROCESSES,default=POOL_THREADS)
+        p.add_argument('--read',dest='read',help="How to read files: map, stream or pipeline them, or decide by size",
+            choices=READ_METHODS,default=READ_AUTO)
+        p.add_argument('--blocksize',dest='blocksize',help="Size of block to use when streaming files (bytes)",default=BLOCKSIZE,action="store",type=int)
+        p.add_argument('--fadvise',dest='fadvise',help="Keep streamed files out of the page cache",action="store_true",default=False)
+        p.add_argument('--algorithm',dest='algorithm',help="Hash algorithm for content ids; changing it rehashes every item",
+            choices=sorted(CAS_ALGORITHMS),default=None)
+        p.add_argument('--tree',dest='tree',help="Give files tree hash ids, so big files can be hashed on many cores",action="store_true",default=None)
+        p.add_argument('--tree-jobs',dest='tree_jobs',help="Number of segments of one big file to hash in parallel",default=1,action="store",type=int)
+        p.add_argument('--hash-cache',dest='hash_cache',metavar='PATH',nargs='?',const=default_cache_path(),default=None,
+            help="Share content ids with other stores through a hash cache (default %s)" % (default_cache_path()))
+        p.add_argument('--hash-cache-limit',dest='hash_cache_limit',help="Number of ids to keep in the hash cache",default=CACHE_LIMIT,action="store",type=int)
+        p.add_argument('--xattrs',dest='xattrs',help="Keep content ids in extended attributes of the files too, and trust those that are still good",
+            action="store_true",default=False)
+        p.add_argument('--chunk',dest='chunk',help="Split big files into content-defined chunks",action="store_true",default=False)
+        p.add_argument('--chunk-threshold',dest='chunk_threshold',help="Smallest file to split into chunks (bytes)",default=CHUNK_THRESHOLD,action="store",type=int)
         
+        p.add_argument('-x','--exclude',dest='exclude',help="Leave out paths matching this pattern, as well as those in .casignore (may be repeated; replaces those given before)",
+            action="append",default=None)
+        p.add_argument('--no-exclude',dest='exclude',help="Forget the patterns given with --exclude before",action="store_const",const=[])
+        p.add_argument('-p','--path',dest='paths',help="Only refresh this part of the tree, relative to the store (may be repeated)",action="append",default=None)
+
         p.add_argument('cas',metavar='source',type=str,help="Source store")
         
     def parse_args(self,argv):
@@ -50,14 +82,20 @@ class RefreshCommand(object):
 
     def run(self,opts):
         
-        cas = CasStore(opts.cas,refresh=False)
+        cache = CasHashCache(opts.hash_cache,opts.hash_cache_limit) if opts.hash_cache else None
+        hasher = CasFileHasher(method=opts.read,blocksize=opts.blocksize,fadvise=opts.fadvise,jobs=opts.tree_jobs,cache=cache)
+        chunker = CasChunker(threshold=opts.chunk_threshold) if opts.chunk else None
+        cas = CasStore(opts.cas,refresh=False,hasher=hasher,algorithm=opts.algorithm,chunker=chunker,tree=opts.tree,exclude=opts.exclude,xattrs=opts.xattrs)
         
         if opts.dryrun:
             opts.cp = 0
         
         log.info("Checkpoint interval %d" % (opts.cp))
         
-        cas.refresh(force=opts.force,checkpoint=opts.cp)
+        try:
+            cas.refresh(force=opts.force,checkpoint=opts.cp,jobs=opts.jobs,backend=opts.backend,scanjobs=opts.scan_jobs,paths=opts.paths,order=opts.order,resume=opts.resume)
+        finally:
+            hasher.close()
         if not opts.dryrun:
             log.verbose("Saving changes")
             cas.save()
@@ -0,0 +1,63 @@
+#
+# a command to keep a store up to date
+# as its content changes
+#
+
+import sys
+from argparse import ArgumentParser
+
+from _base import CasStore
+from _watch import CasWatcher, WATCH_SETTLE, WATCH_INTERVAL
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+class WatchCommand(object):
+    
+    def __init__(self):
+        pass
+
+    def build_parser(self):
+        p = ArgumentParser()
+
+        log.add_options(p)
+        self.add_options(p)
+        
+        return p
+        
+    def add_options(self,p):
+
+        p.add_argument('--settle',dest='settle',help="Seconds a file must be left alone before it is hashed",
+            default=WATCH_SETTLE,action="store",type=float)
+        p.add_argument('-i','--interval',dest='interval',help="Save changes this often (seconds)",
+            default=WATCH_INTERVAL,action="store",type=int)
+        p.add_argument('-p','--path',dest='paths',help="Only watch this part of the tree, relative to the store (may be repeated)",action="append",default=None)
+        p.add_argument('cas',metavar='source',type=str,help="Store to watch")
+        
+    def parse_args(self,argv):
+        p = self.build_parser()
+        opts = p.parse_args(argv)
+        log.handle_options(opts)
+        return opts
+        
+    def main(self,argv=None):
+        
+        if argv is None:
+            argv = sys.argv[1:]
+        
+        opts = self.parse_args(argv)
+        
+        return self.run(opts)
+
+    def run(self,opts):
+
+        cas = CasStore(opts.cas,refresh=False)
+        w = CasWatcher(cas,settle=opts.settle,interval=opts.interval,paths=opts.paths)
+
+        log.info("Watching %s" % (opts.cas))
+        w.run()
+
+if __name__ == "__main__":
+    c = WatchCommand()
+    c.main()
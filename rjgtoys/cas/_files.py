@@ -16,9 +16,24 @@ import pwd
 import grp
 import stat
 import time
+import copy
+import base64
+import heapq
+import Queue
+import collections
+import threading
+import errno
 from gzip import GzipFile
 
-from _base import CasStoreBase, cas_link_to_id, cas_file_to_id, cas_to_json, cas_from_json
+from _base import CasStoreBase, CasFileHasher, physical_offset, DEFAULT_ALGORITHM, CAS_ID_TREE, CAS_ID_DIR, cas_algorithm, cas_id_algorithm, cas_link_to_id, cas_file_to_id, cas_file_to_partial_id, cas_to_json, cas_from_json, CasJson, CasJSONEncoder
+from _workers import worker_pool, Throttle, POOL_THREADS
+from _chunks import CasChunker, cas_manifest_to_id
+from _ignore import CasIgnore, IGNORE_FILE, escape
+from _volume import volume_id
+from _xattr import xattr_name, read_cid, write_cid
+from _journal import CasJournal, replay, JOURNAL_SUFFIX, JOURNAL_MIN, OP_PUT, OP_DEL, OP_STORE
+from _sqlite import CasSqliteMetadata, is_sqlite, SQLITE_SUFFIX
+from _packed import CasPackedMetadata, is_packed, PACKED_SUFFIX
 
 from rjgtoys import logs
 
@@ -28,6 +43,22 @@ log = logs.getLogger(__name__)
 
 DEFAULT_METADATA='.cas'
 
+# Files a store may keep alongside its metadata
+
+METADATA_EXTRAS=('.bak','.tmp',JOURNAL_SUFFIX,JOURNAL_SUFFIX+'.tmp','-wal','-shm','-journal')
+
+# The indexes of a store, which are only loaded from a database when used
+
+INDEXES=('byfileid','bypath','byid','bychunk','bydir')
+
+# Saved metadata is written, and read, this many items at a time
+
+SAVE_BATCH=1000
+
+# ... with each on a line of its own, after a first line that ends with
+
+ITEMS_START='"item": [\n'
+
 # Filesystem object types
 
 OTYPE_FILE = 'F'
@@ -72,58 +103,198 @@ def getgroupbyid(gid):
     except:
         return None
 
-def statdir(d):
-    """ Generate a sequence of (path,stat) pairs
-    for all entries in a directory and below
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def _listdir(d):
+    """ Returns (path, is a directory) for each entry of directory `d`
+    (a unicode string).   Whether an entry is a directory is only known
+    (without a stat) if :func:`scandir` is available; if not, it's None.
     """
-    d = os.path.normpath(unicode(d))
-    q = [d]
-    
-    suffix = len(d)+1
-    
-    while q:
-        d = q.pop()
+
+    if scandir is not None:
+        names = [(e.name,e.is_dir(follow_symlinks=False)) for e in scandir(d)]
+    else:
+        names = [(f,None) for f in os.listdir(d)]
+
+    paths = []
+    for (f,isdir) in names:
+        if isinstance(f,str):
+            f = unicode(f,errors='replace')
+            log.warning("In %s, fudging non-ascii filename '%s'" % (d,f))
 
         try:
-            e = os.listdir(d)
+            paths.append((os.path.join(d,f),isdir))
         except Exception,e:
-            log.error("Failed to list directory %s: %s" % (d,e))
+            log.error("Can't handle name %s / %s: %s" % (d,f,e))
+
+    return paths
+
+def _statdir(d,skip=None):
+    """ Lists and stats the entries of directory `d`; returns a
+    list of (path,stat) pairs, sorted by path.   Entries for which
+    `skip(path,is a directory)` returns True are left out, without
+    being statted if possible.
+    """
+
+    result = []
+    try:
+        paths = _listdir(d)
+    except Exception,e:
+        log.error("Failed to list directory %s: %s" % (d,e))
+        return result
+
+    for (p,isdir) in paths:
+        if skip is not None and isdir is not None and skip(p,isdir):
             continue
-            # FIXME: stat again in case it's changed?
-        
-        for f in e:
-            if isinstance(f,str):
-                f = unicode(f,errors='replace')
-                log.warning("In %s, fudging non-ascii filename '%s'" % (d,f))
+        try:
+            s = os.lstat(p)
+        except Exception,e:
+            log.error("Failed to stat %s: %s" % (p,e))
+            continue
+        if skip is not None and isdir is None and skip(p,stat.S_ISDIR(s.st_mode)):
+            continue
+        result.append((p,s))
 
-            try:
-                p = os.path.join(d,f)
-            except UnicodeDecodeError,e:
-#                f = unicode.decode(f,strict='replace')
-                print type(f)
-                f = unicode(f,errors='replace')
-                log.error("In directory %s:" % (d))
-                log.error("Bad filename %s" % (f))
-                log.error("Can I join them up?  %s / %s"  % (d,f))
-                raise
-            except Exception,e:
-                print type(e)
-                log.error("Can't handle name %s / %s: %s" % (d,f,e))
+    result.sort()
+    return result
+
+def _statdir_job(d,skip=None):
+    """ :func:`_statdir` for a worker pool, which must always get a result """
+
+    try:
+        return (d,_statdir(d,skip))
+    except Exception,e:
+        log.error("Failed to scan directory %s: %s" % (d,e))
+        return (d,[])
+
+def statdir(d,jobs=1,ordered=False,ignore=None,base=''):
+    """ Generate a sequence of (path,stat) pairs
+    for all entries in a directory and below.
+
+    With `jobs` greater than one, that many directories are listed and
+    their entries statted at once, by a pool of threads.   That helps
+    most where each call is a round trip to a server, as with NFS.
+
+    Entries are generated as each directory is finished with, in no
+    particular order, unless `ordered` is set: then they come a directory
+    at a time, breadth first, and sorted by name within each directory.
+    Entries always come after the directory that contains them.
+
+    Entries excluded by `ignore` (a :class:`CasIgnore`) are left out, and
+    excluded directories are not looked inside; `base` is the path of
+    `d` relative to the top of the content, which the rules expect.
+    """
+    d = os.path.normpath(unicode(d))
+    suffix = len(d)+1
+
+    skip = None
+    if ignore:
+        def skip(p,isdir):
+            return ignore.excluded(os.path.join(base,p[suffix:]),isdir)
+
+    if jobs <= 1:
+        q = collections.deque([d])
+        while q:
+            d = q.popleft() if ordered else q.pop()
+            for (p,s) in _statdir(d,skip):
+                yield (p[suffix:],s)
+                if stat.S_ISDIR(s.st_mode):
+                    q.append(p)
+        return
+
+    # Directories are all listed as soon as they are found, but if
+    # the order matters, their entries are held until it is their turn.
+
+    pool = worker_pool(jobs)
+    done = Queue.Queue()
+    limit = jobs*4      # Directories in flight, to bound memory use
+    pending = [d]       # Directories found but not yet listed
+    running = 0
+
+    turn = collections.deque([d])   # When ordered, directories in the order they're due
+    ready = {}                      # ... and their entries, if they're early
+
+    try:
+        while pending or running:
+            while pending and running < limit:
+                p = pending.pop()
+                pool.apply_async(_statdir_job,(p,skip),callback=done.put)
+                running += 1
+
+            (p,entries) = done.get()
+            running -= 1
+
+            pending.extend(e for (e,s) in entries if stat.S_ISDIR(s.st_mode))
+
+            if not ordered:
+                for (e,s) in entries:
+                    yield (e[suffix:],s)
                 continue
 
-            assert isinstance(p,unicode)
+            ready[p] = entries
+            while turn and turn[0] in ready:
+                for (e,s) in ready.pop(turn.popleft()):
+                    yield (e[suffix:],s)
+                    if stat.S_ISDIR(s.st_mode):
+                        turn.append(e)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def statpaths(d,paths,jobs=1,ordered=False,ignore=None):
+    """ Like :func:`statdir`, but only for the entries at each of `paths`
+    (relative to `d`) and below them.   Paths that don't exist, or
+    are excluded by `ignore`, are skipped.
+    """
 
+    for p in paths:
+        full = os.path.join(d,p)
+        if p:
             try:
-                s = os.lstat(p)
-            except Exception,e:
-                log.error("Failed to stat %s: %s" % (p,e))
+                s = os.lstat(full)
+            except OSError,e:
+                if e.errno != errno.ENOENT:
+                    log.error("Failed to stat %s: %s" % (full,e))
+                continue
+            if ignore and ignore.excludes_path(p,stat.S_ISDIR(s.st_mode)):
+                continue
+            yield (p,s)
+            if not stat.S_ISDIR(s.st_mode):
                 continue
 
-            yield (p[suffix:],s)
-            
-            if stat.S_ISDIR(s.st_mode):
-                q.append(p)
+        for (q,s) in statdir(full,jobs,ordered,ignore,p):
+            yield (os.path.join(p,q),s)
+
+def subtrees(d,paths):
+    """ Returns `paths` as a sorted list of distinct paths relative to
+    `d`, leaving out any that are inside another.   Raises
+    :exc:`ValueError` for a path outside `d`.
+    """
 
+    d = os.path.abspath(d)
+    result = []
+    for p in paths:
+        p = os.path.relpath(os.path.join(d,p),d)
+        if p == os.curdir:
+            p = ''
+        if p == os.pardir or p.startswith(os.pardir+os.sep):
+            raise ValueError("Path '%s' is not in %s" % (p,d))
+        result.append(unicode(p))
+
+    result.sort()
+    distinct = []
+    for p in result:
+        if distinct and (distinct[-1] == '' or p == distinct[-1] or p.startswith(distinct[-1]+os.sep)):
+            continue
+        distinct.append(p)
+    return distinct
 
 kiB=1024
 MiB=kiB*1024
@@ -148,6 +319,28 @@ def timestr(t):
     
     return time.strftime("%Y-%m-%d %H:%M:%S",t)
 
+def cas_dir_to_id(entries,algorithm=None):
+    """ Returns the content id of a directory, given a sequence of
+    (name, otype, mode, cid) tuples, one per entry, sorted by name.
+    """
+
+    h = cas_algorithm(algorithm).new()
+    for (name,otype,mode,cid) in entries:
+        if isinstance(name,unicode):
+            name = name.encode('utf-8')
+        h.update("%s\0%s\0%s\0%s\n" % (name,otype,mode,cid or ''))
+
+    return CAS_ID_DIR+cas_algorithm(algorithm).prefix+base64.b64encode(h.digest(),'._')
+
+def parentpath(p):
+    """ The path of the directory containing relative path `p`, which
+    is '' for the root of a store """
+
+    return os.path.dirname(p)
+
+def pathdepth(p):
+    return p.count(os.sep)+1 if p else 0
+
 def gzipread(path):
     log.debug("gzipread %s" % (path))
         
@@ -172,8 +365,14 @@ def gzipwrite(path,data):
     except:
         pass
 
+    if isinstance(data,basestring):
+        data = [data]
+
+    size = 0
     with GzipFile(pathtmp,'wb') as f:
-        f.write(data)
+        for chunk in data:
+            f.write(chunk)
+            size += len(chunk)
         f.flush()
 
     try:
@@ -189,11 +388,96 @@ def gzipwrite(path,data):
     except Exception,e:
         log.error("Failed to rename %s to %s" % (pathtmp,path))
 
+    return size
+
+def gzipdump(path,header,items):
+    """
+    Saves the state of a store, `header` followed by its `items`, to
+    `path`, encoding and compressing :data:`SAVE_BATCH` items at a time;
+    returns the size of the JSON.
+
+    The file holds the same JSON object as ever, but with each item on
+    a line of its own, so that :func:`gzipload` can read it a line at a
+    time.
+    """
+
+    return gzipwrite(path,_dump(header,items))
+
+def _dump(header,items):
+    h = cas_to_json(header)
+    yield h[:-1]+(', ' if header else '')+ITEMS_START
+
+    encoder = CasJSONEncoder()
+    sep = ''
+    batch = []
+    for item in items:
+        batch.append(sep+encoder.encode(item))
+        sep = ',\n'
+        if len(batch) >= SAVE_BATCH:
+            yield ''.join(batch)
+            batch = []
+
+    batch.append('\n]}\n' if sep else ']}\n')
+    yield ''.join(batch)
+
+def gzipload(path):
+    """
+    Reads the state of a store saved by :func:`gzipdump`.   Only the
+    first line is read straight away: the items are read, and decoded,
+    as the `item` of the result is iterated.
+
+    Anything else is read all at once, as saves used to be.
+    """
+
+    log.debug("gzipload %s" % (path))
+
+    f = GzipFile(path,'rb')
+    try:
+        line = f.readline()
+        if line.endswith(ITEMS_START):
+            state = cas_from_json(line[:-len(ITEMS_START)].rstrip(', ')+'}')
+            state.item = _load(f)
+            return state
+        state = cas_from_json(line+f.read())
+    except:
+        f.close()
+        raise
+
+    f.close()
+    return state
+
+def _load(f):
+    with f:
+        for line in f:
+            if line.startswith(']'):
+                return
+            yield cas_from_json(line.rstrip(',\n'))
+
+    raise ValueError("%s is incomplete" % (f.name))
+
+def compact(path,journal):
+    """Folds `journal` into the full save of a store at `path`"""
+
+    try:
+        state = gzipload(path)
+        n = replay(state,journal.read(state.seq or 0))
+        if not n:
+            return
+        items = state.pop('item')
+        gzipdump(path,state,items)
+        journal.truncate(state.seq)
+        log.verbose("Compacted %d changes into %s" % (n,path))
+    except Exception,e:
+        log.error("Failed to compact %s: %s" % (journal.path,e))
+
 class CasFSItem(object):
     """
     A filesystem item: the object contains all you need to know
     to be able to recreate the object, except the (file or link)
     content.
+
+    A file with several hard links is one item, with all of its
+    `paths`; `path` is one of them, and is the one that is read.
     """
     
     version="1"
@@ -207,6 +491,7 @@ class CasFSItem(object):
         
         self.expiry = expiry
         self.path = path
+        self.paths = [path] if path is not None else []
         self.clear()
         if path is not None and stat is not None:
             self.update(path,stat)
@@ -215,20 +500,28 @@ class CasFSItem(object):
         """
         Update the info held here if necessary and
         return True if the content id is likely to have changed
+
+        An item that was already stale stays stale until
+        :meth:`refresh` has been able to compute its content id.
         """
 
         self.path = path
         
-        self.stale = force_stale
+        changed = force_stale
         if self.mtime is None or self.mtime != s.st_mtime:
             self.mtime = s.st_mtime
-            self.stale = True
+            changed = True
         
         fileid = (s.st_dev,s.st_ino)
         if self.fileid is None or self.fileid != fileid:
             self.fileid = fileid
-            self.stale = True
+            changed = True
         
+        if changed:
+            self.pcid = None
+
+        self.stale = changed or self.stale
+
         self.stime = time.time()
             
         self.mode = stat.S_IMODE(s.st_mode)
@@ -249,9 +542,18 @@ class CasFSItem(object):
 
         return self.stale
 
-    def refresh(self,d=None):
+    def refresh(self,d=None,hasher=None,algorithm=None,chunker=None,tree=False,xattrs=False):
         """
-        Update the content id
+        Update the content id, reading files with `hasher`
+        (a :class:`CasFileHasher`) if given, and using hash `algorithm`.
+        If `tree` is set, files get tree hash ids.
+
+        Files that `chunker` (a :class:`CasChunker`) wants to chunk get
+        a list of chunks as well as their content id.
+
+        If `xattrs` is set, the content id of a file that isn't chunked
+        is taken from its extended attributes if it is still good, and
+        written there once it has been computed (see :func:`read_cid`).
         """
 
         assert self.stale
@@ -267,10 +569,18 @@ class CasFSItem(object):
 
             path = os.path.join(d,self.path)
 
-            if self.otype == OTYPE_FILE:
-                self.cid = cas_file_to_id(path,self.size)
+            self.chunks = None
+            kept = None
+            if self.otype == OTYPE_FILE and chunker is not None and chunker.wants(self.size):
+                self.chunks = chunker.file_to_chunks(path,algorithm)
+                self.cid = cas_manifest_to_id(self.chunks,algorithm) if self.chunks is not None else None
+            elif self.otype == OTYPE_FILE:
+                if xattrs:
+                    xattr = xattr_name(cas_algorithm(algorithm).name,tree)
+                    kept = read_cid(path,xattr,self.size,self.mtime,self.ctime)
+                self.cid = kept or cas_file_to_id(path,self.size,hasher,algorithm,tree)
             elif self.otype == OTYPE_LINK:
-                self.cid = cas_link_to_id(path,self.size)
+                self.cid = cas_link_to_id(path,self.size,algorithm)
             else:
                 self.cid = None
         
@@ -281,6 +591,7 @@ class CasFSItem(object):
                 self.clear()
                 return self
                 
+            self.stale = False
             self.update(self.path,s)
             if self.stale:
                 if tries > 3:
@@ -289,9 +600,30 @@ class CasFSItem(object):
                     return self
                     
                 log.warning("File %s changed during reading - retrying" % (path))
+            elif xattrs and self.otype == OTYPE_FILE and self.chunks is None and kept is None and cas_id_algorithm(self.cid):
+                write_cid(path,xattr,self.cid,self.size,self.mtime,self.ctime)
 
         return self
 
+    def entry(self):
+        """ What the directory containing this item needs to know about it """
+
+        return (self.path,self.otype,self.mode,self.cid)
+
+    def partial(self,d=None):
+        """
+        Returns the partial id of a file (see :func:`cas_file_to_partial_id`),
+        which is kept until the file changes.
+        """
+
+        if self.otype != OTYPE_FILE:
+            return None
+
+        if self.pcid is None:
+            self.pcid = cas_file_to_partial_id(os.path.join(d or '',self.path),self.size)
+
+        return self.pcid
+
     def clear(self):
         self.mode = None
         self.uid = None
@@ -304,6 +636,8 @@ class CasFSItem(object):
         # Cas-specifics
         self.fileid = None
         self.cid = None
+        self.pcid = None
+        self.chunks = None
         self.uname = None
         self.gname = None
         self.stale = False
@@ -314,9 +648,9 @@ class CasFSItem(object):
     # mechanism that will deal with items that know less (or more)
     # about items than this one but for now I'll do something simple...
     
-    def printable(self):
+    def printable(self,path=None):
 
-        p = unicode.encode(self.path,errors='replace')
+        p = unicode.encode(path or self.path,errors='replace')
         return "%s %s:%s %s %s %s" % (self.otype,self.uname,self.gname,sizestr(self.size),timestr(self.mtime),p)
 
     @property
@@ -327,30 +661,205 @@ class CasFSItem(object):
         return self.__dict__
         
     def __setstate__(self,state):
-        assert state.version == self.version
+        assert state['version'] == self.version
+        self.clear()    # Defaults for anything older versions didn't save
         self.__dict__.update(state)
-        self.fileid = tuple(self.fileid) # JSON will represent this as a list
+        if self.fileid is not None:
+            self.fileid = tuple(self.fileid) # JSON will represent this as a list
+        if 'paths' not in state:
+            self.paths = [self.path]    # Saved before links were tracked
+
+def _refresh_one(job):
+    """Computes the content id of one item on behalf of
+    :meth:`CasFileTreeStore.refresh`.   When that is running a worker pool,
+    this runs in a worker, and the item it is given is a private copy.
+    """
+
+    (n,item,d,opts) = job
+    try:
+        return (n,item.refresh(d,**opts))
+    except Exception,e:
+        log.error("Failed to refresh %s: %s" % (item.path,e))
+        return (n,None)
+
+# Events seen by the coordinator of a refresh
+
+EV_FOUND='found'        # The walker found an entry
+EV_SCANNED='scanned'    # ... and has found them all
+EV_FAILED='failed'      # ... or gave up
+EV_HASHED='hashed'      # A worker has refreshed an item
+
+# Orders in which a refresh can hash stale items
+
+ORDER_FOUND='found'
+ORDER_INODE='inode'
+ORDER_EXTENT='extent'
+
+HASH_ORDERS=(ORDER_FOUND,ORDER_INODE,ORDER_EXTENT)
+
+# How far each stage of a refresh may get ahead of the next
+
+SCAN_AHEAD=1000     # Entries found but not yet looked at
+HASH_AHEAD=4        # Items being hashed, per worker
+
+def _walk(d,jobs,events,throttle,paths=None,ignore=None):
+    """The walker stage of :meth:`CasFileTreeStore.refresh`; runs in its own
+    thread, passing what it finds to the coordinator as events."""
+
+    if paths is None:
+        found = statdir(d,jobs,ignore=ignore)
+    else:
+        found = statpaths(d,paths,jobs,ignore=ignore)
+    try:
+        for e in throttle.feed(found):
+            events.put((EV_FOUND,e))
+    except Exception,e:
+        log.error("Failed to scan %s: %s" % (d,e))
+        events.put((EV_FAILED,e))
+        return
+    finally:
+        found.close()
+
+    events.put((EV_SCANNED,None))
+
+class RefreshProgress(object):
+    """
+    Counts what each stage of a refresh has done, and reports it
+    every `interval` seconds.
+    """
+
+    def __init__(self,interval=1):
+        self.interval = interval
+        self.start = time.time()
+        self.log_time = self.start
+        self.scanned = None     # When the scan finished
+
+        self.newentries = 0
+        self.newbytes = 0
+        self.origentries = 0
+        self.origbytes = 0
+        self.lostentries = 0
+        self.lostbytes = 0
+
+        self.refentries = 0
+        self.refbytes = 0
+        self.waiting = 0
+        self.running = 0
+
+    @property
+    def staleentries(self):
+        return self.newentries + self.origentries
+
+    @property
+    def stalebytes(self):
+        return self.newbytes + self.origbytes
+
+    def scan_done(self):
+        self.scanned = time.time()
+        log.verbose("Scan found %d/%s new %d/%s changed %d/%s deleted" % (
+                self.newentries, sizestr(self.newbytes),
+                self.origentries, sizestr(self.origbytes),
+                self.lostentries,sizestr(self.lostbytes)))
+
+    def report(self):
+        """Reports progress, if it's time to"""
+
+        t = time.time()
+        if (t-self.log_time) <= self.interval:
+            return
+        self.log_time = t
+
+        if self.scanned is None:
+            log.verbose("Scanning: found %d/%s new %d/%s changed %d/%s deleted; hashing: %d waiting %d running %d/%s done" % (
+                self.newentries,sizestr(self.newbytes),
+                self.origentries,sizestr(self.origbytes),
+                self.lostentries,sizestr(self.lostbytes),
+                self.waiting,self.running,
+                self.refentries,sizestr(self.refbytes)))
+            return
+
+        if not self.refbytes or not self.stalebytes:
+            return
+
+        countpc = int(self.refentries*100./self.staleentries)    # percent done by count
+        bytespc = int(self.refbytes*100./self.stalebytes)        # percent done by bytes
+
+        reftogo = ((t-self.start)*(self.stalebytes-self.refbytes))/self.refbytes
+        eta = time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(t+reftogo))
+
+        log.verbose("Refreshing: done %d/%d=%d%% %s/%s=%d%% in %ds, %ds to go ETA %s" % (
+                    self.refentries, self.staleentries, countpc,
+                    sizestr(self.refbytes),sizestr(self.stalebytes),bytespc,
+                    t-self.start,reftogo,eta))
 
-        
 class CasFileTreeStore(CasStoreBase):
 
     version="1"
     
-    def __init__(self,content=None,metadata=None,refresh=None):
+    def __init__(self,content=None,metadata=None,refresh=None,hasher=None,algorithm=None,chunker=None,tree=None,exclude=None,xattrs=False):
         if content is not None:
             content = os.path.normpath(content)
         self.content = content
         self.metadata = metadata
+        self.hasher = hasher or CasFileHasher()
+
+        # The hash algorithm used for new ids is recorded in the
+        # metadata, unless we've been told to change it
+        
+        self.algorithm = algorithm and cas_algorithm(algorithm).name
+
+        # Likewise whether, and how, big files are chunked
+
+        self.chunker = chunker
+        self._rechunk = False
+
+        # ... and whether files get tree hash ids
+
+        self.tree = tree
+
+        # ... and any exclude patterns, as well as those in IGNORE_FILE
+
+        self.exclude = exclude
+        self.ignore = None
+
+        # Whether content ids are kept in extended attributes too
+
+        self.xattrs = xattrs
         
         self.byfileid = {}  # Locate each by device and inode
         self.bypath = {}    # Locate by file path
         self.byid = {}      # Locate by content id
+        self.bychunk = {}   # Count uses of each chunk id
+        self.bydir = {}     # Entries of each directory, by name
+        self.volumes = {}   # Volume id of each device number
+        self._checked = set()   # ... those checked since loading
+
+        self.rootid = None  # Directory id of the content root
+        self._dirty = set() # Directories whose ids need remaking
+        self._found = {}    # Paths of each item seen by the current scan
+
+        self.journal = None     # Changes since the last full save
+        self._base = None       # ... which was to this path
+        self._seq = 0           # Sequence number of the last change saved
+        self._journaled = 0     # Changes in the journal
+        self._changes = {}      # Items to save, by fileid (None if gone)
+        self._compactor = None  # Thread compacting the journal
+
+        self.pending = None     # What an unfinished refresh was doing
+        self._db = None         # Metadata database or packed file, if there is one
 
         # If we got content but no metadata,
         # force a refresh by default
         
         if not self.load() and refresh is None:
             refresh = True
+
+        if self.algorithm is None:
+            self.algorithm = DEFAULT_ALGORITHM
+        if self.tree is None:
+            self.tree = False
+        if self.exclude is None:
+            self.exclude = []
             
         if refresh:
             self.refresh()
@@ -364,13 +873,29 @@ class CasFileTreeStore(CasStoreBase):
         
         if self.metadata is None:
             self.metadata = DEFAULT_METADATA
+            if not os.path.exists(os.path.join(self.content,DEFAULT_METADATA)):
+                for suffix in (SQLITE_SUFFIX,PACKED_SUFFIX):
+                    if os.path.exists(os.path.join(self.content,DEFAULT_METADATA+suffix)):
+                        self.metadata += suffix
+                        break
             
         path = os.path.join(self.content,self.metadata)
         log.debug("Loading from %s" % (path))
+
+        if is_sqlite(path):
+            return self._load_db(path,CasSqliteMetadata)
+        if is_packed(path):
+            return self._load_db(path,CasPackedMetadata)
         
         try:
-            data = gzipread(path)
-            self.__setstate__(cas_from_json(data))
+            state = gzipload(path)
+            journal = self._journal(path)
+            self._journaled = replay(state,journal.read(state.seq or 0))
+            log.verbose("Replayed %d changes from %s" % (self._journaled,journal.path))
+            self.__setstate__(state)
+            self._base = path
+            self._seq = state.seq or 0
+            self._changes = {}
             return True
         except Exception,e:
             if isinstance(e,IOError) and e.errno == 2:  # Not found
@@ -379,8 +904,89 @@ class CasFileTreeStore(CasStoreBase):
             log.error("Failed to load metadata %s:%s" % (path,e))
 
         return False
+
+    def _load_db(self,path,cls):
+        """Opens the metadata database or packed file at `path` as a
+        `cls`, but only reads the items from it when they are needed
+        (see :meth:`__getattr__`)"""
+
+        if not os.path.exists(path):
+            log.debug("(No metadata found at %s)" % (path))
+            return False
+
+        try:
+            db = cls(path)
+            state = db.header()
+        except Exception,e:
+            log.error("Failed to load metadata %s:%s" % (path,e))
+            return False
+
+        if state is None:
+            return False
+
+        self._set_header(state)
+        for name in INDEXES:
+            self.__dict__.pop(name,None)
+        self._db = db
+        self._base = path
+        self._changes = {}
+        return True
+
+    def __getattr__(self,name):
+        """Loads the indexes from the metadata database or packed file
+        the first time any of them is used"""
+
+        if name in INDEXES and self.__dict__.get('_db',None) is not None:
+            log.verbose("Loading %d items from %s" % (len(self._db),self._db.path))
+            self._add_items(self._db.items())
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _loaded(self):
+        """True if the items are in memory"""
+
+        return 'byfileid' in self.__dict__
+
+    def item_at(self,path):
+        """ Returns the item at `path`, or None """
+
+        if self._loaded():
+            return self.bypath.get(path,None)
+        state = self._db.item_at(path)
+        return state and CasFSItem(saved=state)
+
+    def items_in(self,d):
+        """ Generates (name, item) for each entry of directory `d`,
+        in order of name """
+
+        if self._loaded():
+            return iter(sorted(self.bydir.get(d,{}).iteritems()))
+        return ((name,CasFSItem(saved=state)) for (name,state) in self._db.items_in(d))
+
+    def items_with_id(self,cid):
+        """ Generates the items with content id `cid` """
+
+        if self._loaded():
+            return (i for i in self.byfileid.itervalues() if i.cid == cid)
+        return (CasFSItem(saved=state) for state in self._db.items_with_id(cid))
+
+    def items(self):
+        """ Generates every item, reading them one at a time from the
+        metadata database or packed file if they aren't loaded yet """
+
+        if self._loaded():
+            return self.byfileid.itervalues()
+        return (CasFSItem(saved=state) for state in self._db.items())
         
-    def save(self,metadata=None):
+    def save(self,metadata=None,full=False):
+        """
+        Saves the metadata; returns False if that can't be done.
+
+        Once there has been a full save, only what has changed since
+        is appended to the journal (see :class:`CasJournal`), unless
+        `full` is set or the metadata is being saved somewhere else.
+        """
+
         if self.content is None:
             return False
 
@@ -391,24 +997,138 @@ class CasFileTreeStore(CasStoreBase):
             self.metadata = DEFAULT_METADATA
         
         path = os.path.join(self.content,self.metadata)
-        
 
         try:
-            m = cas_to_json(self)
-            log.verbose("Metadata size %d bytes" % (len(m)))
-
-            gzipwrite(path,m)
-            
-            log.debug("Saved state to %s" % (path))
-
+            if is_sqlite(path):
+                self._save_sqlite(path,full or path != self._base)
+            elif is_packed(path):
+                self._save_packed(path)
+            elif full or path != self._base:
+                self._save_full(path)
+            else:
+                self._save_changes(path)
             return True
         except Exception,e:
             log.warning("Failed to save metadata %s: %s" % (path,e))
         
         return False
+
+    def _save_full(self,path):
+        self.wait_compact()
+
+        changes = self._changes
+        self._changes = {}
+        try:
+            size = gzipdump(path,self._header(),self.byfileid.itervalues())
+            log.verbose("Metadata size %d bytes" % (size))
+        except:
+            changes.update(self._changes)
+            self._changes = changes
+            raise
+
+        self._journal(path).remove()
+        self._base = path
+        self._journaled = 0
+        log.debug("Saved state to %s" % (path))
+
+    def _save_changes(self,path):
+        changes = self._changes
+        self._changes = {}
+        try:
+            n = self._journal(path).append(self._records(changes))
+        except:
+            changes.update(self._changes)
+            self._changes = changes
+            raise
+
+        self._journaled += n
+        log.verbose("Saved %d changes to %s" % (n,self.journal.path))
+
+        if self._journaled > max(JOURNAL_MIN,len(self.byfileid)):
+            self.compact()
+
+    def _save_sqlite(self,path,full):
+        if full:
+            items = self.byfileid.values()  # Before there's a new database to load them from
+        if not isinstance(self._db,CasSqliteMetadata) or self._db.path != path:
+            self._db = CasSqliteMetadata(path)
+
+        changes = self._changes
+        self._changes = {}
+        try:
+            if full:
+                self._db.write(self._header(),items,full=True)
+            else:
+                items = [i for i in changes.itervalues() if i is not None]
+                gone = [k for (k,i) in changes.iteritems() if i is None]
+                self._db.write(self._header(),items,gone)
+        except:
+            changes.update(self._changes)
+            self._changes = changes
+            raise
+
+        self._base = path
+        log.verbose("Saved %d items to %s" % (len(items),path))
+
+    def _save_packed(self,path):
+        items = self.byfileid.values()
+
+        changes = self._changes
+        self._changes = {}
+        try:
+            CasPackedMetadata.write(path,self._header(),items)
+        except:
+            changes.update(self._changes)
+            self._changes = changes
+            raise
+
+        if self._db is not None:
+            self._db.close()
+        self._db = CasPackedMetadata(path)
+        self._base = path
+        log.verbose("Saved %d items to %s" % (len(items),path))
+
+    def _records(self,changes):
+        """Generates the journal records for `changes`"""
+
+        for (fileid,item) in changes.iteritems():
+            self._seq += 1
+            if item is None:
+                yield (self._seq,OP_DEL,fileid)
+            else:
+                yield (self._seq,OP_PUT,item)
+
+        self._seq += 1
+        yield (self._seq,OP_STORE,self._header())
+
+    def _journal(self,path):
+        """The journal for the metadata at `path`"""
+
+        if self.journal is None or self.journal.path != path+JOURNAL_SUFFIX:
+            self.journal = CasJournal(path+JOURNAL_SUFFIX)
+        return self.journal
+
+    def compact(self):
+        """Starts folding the journal into a new full save, in the
+        background; the store can carry on being used, and saved,
+        meanwhile"""
+
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+
+        self._compactor = threading.Thread(target=compact,args=(self._base,self.journal))
+        self._compactor.start()
+        self._journaled = 0
+
+    def wait_compact(self):
+        """Waits for any compaction to finish"""
+
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
         
     def __iter__(self):
-        return self.bypath.itervalues()
+        return self.byfileid.itervalues()
 
     def store(self,s,expiry=None,size=None,cid=None):
         """
@@ -435,138 +1155,662 @@ class CasFileTreeStore(CasStoreBase):
 
         return self._fetch(item)
 
-    def refresh(self,force=False,checkpoint=0):
+    def refresh(self,force=False,checkpoint=0,jobs=1,backend=POOL_THREADS,rehash=True,scanjobs=1,paths=None,order=ORDER_FOUND,resume=True):
         """
         Refresh metadata for this store.
-        
-        Needs to be split up more to enable:
-        
-        1) Checkpointing
-        2) Progress reporting
+
+        A refresh is a pipeline of stages, each of which runs alongside
+        the others: a walker thread scans the tree, the entries it finds
+        are compared with the items already known here, and any that are
+        new or have changed are hashed straight away, so hashing starts as
+        soon as the first stale item is found.   Items that were not found
+        are forgotten once the walk is complete.
+
+        If `rehash` is False, the tree is scanned but no content ids are
+        computed; anything that needs one is left marked as stale.
+
+        Content ids are computed by a pool of `jobs` workers (threads, or
+        processes if `backend` is `POOL_PROCESSES`).   The workers only
+        ever see copies of the items; all the indexes, progress reports
+        and checkpoints are dealt with here, as the results come back.
+
+        If `scanjobs` is more than 1, that many directories are scanned
+        at once (see :func:`statdir`).
+
+        If `checkpoint` is set, the metadata is saved that often (in seconds).
+
+        If `paths` is given, only those parts of the tree (paths relative
+        to the content root, or absolute paths within it) are scanned, and
+        only items in them can be found to have vanished; the rest of the
+        metadata is left as it is.
+
+        `order` says in what order stale items are hashed: as they are
+        found (`ORDER_FOUND`, the default), or, to keep the heads of a
+        spinning disk moving in one direction, by inode number
+        (`ORDER_INODE`) or by where their data is on the disk
+        (`ORDER_EXTENT`, which falls back to inode order for files on
+        filesystems that can't say).   The last two can only start
+        hashing once the scan is complete.
+
+        Items are found again by device and inode number.   The first
+        time a device is seen, its volume id (see :func:`volume_id`) is
+        checked, and if the volume used to have some other device
+        number, its items are renumbered rather than rehashed.
+
+        A refresh can be interrupted and started again without losing
+        anything.   Whether each item still needs hashing is saved with
+        it, and until the scan is complete, so is what the refresh was
+        asked to do (:attr:`pending`).   If `resume` is set, a refresh
+        first finishes the work of any that was interrupted: a forced
+        refresh, or one that changed how files are chunked, marks the
+        items it hadn't got to yet as needing hashing.   Items that were
+        left needing hashing are hashed first, while the tree is scanned.
         """
 
-        newentries = 0
-        newbytes = 0
-        
-        origentries = 0
-        origbytes = 0
+        if order not in HASH_ORDERS:
+            raise ValueError("Unknown hash order '%s'" % (order))
+
+        if paths is not None:
+            paths = subtrees(self.content,paths)
 
         find_time = time.time()
-        
-        log_time = find_time    # crude progress reporting
+        progress = RefreshProgress()
+        self._found = {}
 
-        for (p,s) in statdir(self.content):
-            log.debug("refresh found %s" % (p))
-            fileid = (s.st_dev,s.st_ino)
-            
-            item = self.byfileid.get(fileid,None)
-            if item is None:
-                item = CasFSItem(p,s)
-                
-                self.byfileid[item.fileid] = item
-                self.bypath[item.path] = item
-                newentries += 1
-                newbytes += s.st_size
-                log.debug("New item %s" % (item.path))
-            elif item.update(p,s,force):
+        if resume and self.pending:
+            self._resume(self.pending)
+        self.pending = CasJson(started=find_time,force=force,rechunk=self._rechunk,paths=paths)
+
+        if checkpoint:
+            log.info("Doing first checkpoint save")
+            if not self.save():
+                log.error("Cannot save metadata - giving up")
+                return
+        cp_time = time.time()
+
+        events = Queue.Queue()
+        feed = Throttle(SCAN_AHEAD)
+        walker = threading.Thread(target=_walk,args=(self.content,scanjobs,events,feed,paths,self.load_ignore()))
+        walker.daemon = True
+        walker.start()
+
+        pool = None
+        if rehash:
+            jobs = max(jobs,1)
+            log.verbose("Refreshing with %d %s" % (jobs,backend))
+            pool = worker_pool(jobs,backend)
+
+        waiting = collections.deque()   # Stale items, in the order they'll be hashed
+        held = []                       # ... or waiting to be put in order
+        queued = set()                  # ... and those being hashed
+        running = {}                    # Being hashed: (item, old id, old chunks) by job number
+        jobno = 0
+        scanning = True
+
+        if rehash:
+            left = [i for i in self._scope(paths) if i.stale]
+            if left:
+                log.verbose("Hashing %d items left from before" % (len(left)))
+            left.sort(key=lambda i: i.path)
+            queued.update(left)
+            waiting.extend(self._hash_order(left,order))
+
+        try:
+            while scanning or waiting or running:
+                while waiting and len(running) < jobs*HASH_AHEAD:
+                    item = waiting.popleft()
+                    running[jobno] = (item,item.cid,item.chunks)
+                    pool.apply_async(_refresh_one,((jobno,copy.copy(item),self.content,self._refresh_opts()),),
+                        callback=lambda r: events.put((EV_HASHED,r)))
+                    jobno += 1
+
+                progress.waiting = len(waiting)+len(held)
+                progress.running = len(running)
+                progress.report()
+
+                (event,data) = events.get()
+
+                if event == EV_FOUND:
+                    feed.release()
+                    (p,s) = data
+                    item = self._scan_one(p,s,force,find_time,progress)
+                    if rehash and item.stale and item not in queued:
+                        queued.add(item)
+                        if order == ORDER_FOUND:
+                            waiting.append(item)
+                        else:
+                            held.append(item)
+
+                elif event == EV_SCANNED:
+                    scanning = False
+                    self._rechunk = False   # Anything that needs it is now stale
+                    self.pending = None     # ... and saved as such
+                    self._forget_vanished(find_time,progress,paths)
+                    progress.scan_done()
+                    waiting.extend(self._hash_order(held,order))
+                    held = []
+
+                elif event == EV_HASHED:
+                    (n,done) = data
+                    (item,oldid,oldchunks) = running.pop(n)
+                    queued.discard(item)
+                    self._refreshed(item,done,oldid,oldchunks,progress)
+
+                elif event == EV_FAILED:
+                    raise data
+
+                if checkpoint > 0 and (time.time()-cp_time) > checkpoint:
+                    log.info("Doing checkpoint save")
+                    if not self.save():
+                        log.error("Cannot save metadata - giving up")
+                        return
+                    cp_time = time.time()
+        finally:
+            feed.close()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if not rehash:
+            return
+
+        self.update_dirids()
+
+        log.info("Refresh completed.")
+
+    def _resume(self,pending):
+        """ Marks the items that the interrupted refresh described by
+        `pending` hadn't got to yet as stale, if it would have """
+
+        if not (pending.force or pending.rechunk):
+            return
+
+        log.info("Resuming the refresh started at %s" % (timestr(pending.started)))
+
+        n = 0
+        for item in self._scope(pending.paths):
+            if getattr(item,'find_time',0) >= pending.started or item.stale:
+                continue
+            if pending.force or item.chunks is not None:
+                item.stale = True
+                self._record(item)
+                n += 1
+
+        log.verbose("%d items still to be rehashed" % (n))
+
+    def _scope(self,paths):
+        """ Generates the items at or below `paths`, or all of them """
+
+        if paths is None:
+            return self.byfileid.itervalues()
+
+        items = set(i for p in paths for (_,i) in self._subtree(p))
+        return iter(items)
+
+    def load_ignore(self):
+        """ (Re)reads the exclude rules for this store: those that keep
+        its own metadata out of it, then those in :data:`IGNORE_FILE`,
+        then those given to the constructor.   Returns a :class:`CasIgnore`.
+        """
+
+        names = set([self.metadata or DEFAULT_METADATA,DEFAULT_METADATA,DEFAULT_METADATA+SQLITE_SUFFIX,DEFAULT_METADATA+PACKED_SUFFIX])
+        own = ['/'+escape(m+x) for m in sorted(names) for x in ('',)+METADATA_EXTRAS]
+        self.ignore = CasIgnore.from_file(os.path.join(self.content,IGNORE_FILE),own+list(self.exclude or []))
+        return self.ignore
+
+    def _hash_order(self,items,order):
+        """ Returns `items` sorted into `order` (see :meth:`refresh`) """
+
+        if order == ORDER_FOUND:
+            return items
+
+        def key(item):
+            (dev,ino) = item.fileid
+            if order == ORDER_EXTENT and item.otype == OTYPE_FILE:
+                offset = None
+                try:
+                    f = os.open(os.path.join(self.content,item.path),os.O_RDONLY)
+                    try:
+                        offset = physical_offset(f)
+                    finally:
+                        os.close(f)
+                except OSError:
+                    pass
+                if offset is not None:
+                    return (dev,0,offset)
+            return (dev,1,ino)
+
+        t = time.time()
+        items = sorted(items,key=key)
+        log.verbose("Put %d items in %s order in %ds" % (len(items),order,time.time()-t))
+        return items
+
+    def _scan_one(self,p,s,force,find_time,progress):
+        """ The compare stage of :meth:`refresh`: bring the item for
+        path `p` up to date with its stat `s`, and return it.
+        """
+
+        log.debug("refresh found %s" % (p))
+        if s.st_dev not in self._checked:
+            self._check_volume(p,s.st_dev)
+        fileid = (s.st_dev,s.st_ino)
+
+        item = self.byfileid.get(fileid,None)
+        if item is None:
+            item = CasFSItem(p,s)
+
+            self.byfileid[item.fileid] = item
+            self._link(item,p)
+            self._changed(item)
+            self._record(item)
+            progress.newentries += 1
+            progress.newbytes += s.st_size
+            log.debug("New item %s" % (item.path))
+        elif item in self._found:
+            # Another link to an item this scan has already seen:
+            # there's nothing new to learn about its content
+
+            self._found[item].add(p)
+            if p not in item.paths:
+                self._link(item,p)
+                self._dirty.add(parentpath(p))
+                self._record(item)
+                log.debug("New link %s to %s" % (p,item.path))
+            return item
+        else:
+            entry = item.entry()[1:]
+            ctime = item.ctime
+
+            if item.update(p,s,force or self._outdated(item)):
                 # If the item needs a reread...
-                origentries += 1
-                origbytes += s.st_size
+                progress.origentries += 1
+                progress.origbytes += s.st_size
                 log.debug("Updated item %s" % (item.path))
-            
-            item.find_time = find_time
-            t = time.time()
-            if (t-log_time) > 1:
-                log.verbose("Scanning: found %d/%s new %d/%s changed" % (newentries,sizestr(newbytes),origentries,sizestr(origbytes)))
-                log_time = t
 
-        # Clobber all items that have not been touched
-        
-        lostentries = 0
-        lostbytes = 0
-        
-        for item in [i for i in self.byfileid.itervalues() if i.find_time != find_time]:
+            if p not in item.paths:
+                self._link(item,p)
+                self._dirty.add(parentpath(p))
+                self._record(item)
+            if item.stale or entry != item.entry()[1:]:
+                self._changed(item)
+            if item.stale or item.ctime != ctime:
+                self._record(item)
+
+        self._found[item] = set([p])
+        item.find_time = find_time
+        return item
+
+    def _check_volume(self,p,dev):
+        """ Checks which volume device `dev` (holding path `p`) is,
+        renumbering items if it used to be known by another number """
+
+        self._checked.add(dev)
+        vid = volume_id(os.path.join(self.content,p),dev)
+        if vid is None:
+            return
+
+        was = self.volumes.get(dev,None)
+        if was == vid:
+            return
+
+        # Items that were on some other volume that used to have this
+        # number can't be told apart from those on this one, so they
+        # are forgotten, and whatever is there now is found as new
+
+        if was is not None:
+            gone = [i for i in self.byfileid.itervalues() if i.fileid[0] == dev]
+            log.info("Device %s is no longer %s - forgetting %d items" % (dev,was,len(gone)))
+            for item in gone:
+                self._changed(item)
+                self._unindex(item)
+                self._record_gone(item)
+
+        moves = {}
+        for (d,v) in self.volumes.items():
+            if v == vid and d != dev:
+                moves[d] = dev
+                del self.volumes[d]
+        self.volumes[dev] = vid
+
+        if not moves:
+            return
+
+        for (d,to) in moves.iteritems():
+            log.info("Items on device %s are now on %s" % (d,to))
+
+        items = [i for i in self.byfileid.itervalues() if i.fileid[0] in moves]
+        for item in items:
             del self.byfileid[item.fileid]
-            del self.bypath[item.path]
-            del self.byid[item.cid]
+        for item in items:
+            self._record_gone(item)
+            item.fileid = (moves[item.fileid[0]],item.fileid[1])
+            self.byfileid[item.fileid] = item
+            self._record(item)
+
+    def _forget_vanished(self,find_time,progress,paths=None):
+        """ Clobber all paths that were not found by the scan that
+        started at `find_time`, or only those at or below `paths`,
+        and all items that are left with no paths at all """
+
+        found = self._found
+        self._found = {}
+
+        if paths is None:
+            links = [(p,i) for i in self.byfileid.itervalues() for p in i.paths]
+        else:
+            links = [l for p in paths for l in self._subtree(p)]
+
+        for (p,item) in links:
+            if p in found.get(item,()):
+                continue
+            self._unlink(item,p)
+            self._dirty.add(parentpath(p))
+            if item.paths:
+                self._record(item)
+                log.debug("Vanished link %s to %s" % (p,item.paths[0]))
+                continue
+
+            self._unindex(item)
+            self._changed(item)
+            self._record_gone(item)
+            log.debug("Vanished item %s" % (p))
+            progress.lostentries += 1
+            progress.lostbytes += item.size or 0
+
+        # Forget volumes that no longer hold anything
+
+        if paths is None:
+            used = set(fileid[0] for fileid in self.byfileid)
+            for dev in self.volumes.keys():
+                if dev not in used:
+                    del self.volumes[dev]
+
+        # Each item that is still here is known by its first path
+
+        for item in found:
+            if item.paths:
+                item.paths.sort()
+                if item.path != item.paths[0]:
+                    item.path = item.paths[0]
+                    self._record(item)
+
+    def _refreshed(self,item,done,oldid,oldchunks,progress):
+        """ The index stage of :meth:`refresh`: `done` is a refreshed
+        copy of `item`, which had id `oldid` and chunks `oldchunks` """
+
+        if done is None:
+            return      # The worker has already complained
+
+        if self.byfileid.get(item.fileid,None) is not item:
+            return      # Vanished while it was being hashed
+
+        if done.fileid is None:
+            # The copy was cleared: the file has gone since the scan
+            # found it, or couldn't be read, or kept changing, so
+            # there's nothing to keep
+
+            if any(os.path.lexists(os.path.join(self.content,p)) for p in item.paths):
+                log.warning("Failed to refresh %s - leaving it stale" % (item.path))
+                return
+
+            self._changed(item)
+            self._unindex(item)
+            self._record_gone(item)
             log.debug("Vanished item %s" % (item.path))
-            lostentries += 1
-            lostbytes += item.size
-            
-            t = time.time()
-            if (t-log_time) > 1:
-                log.verbose("Scanning: found %d/%s deleted" % (lostentries,sizestr(lostbytes)))
-                log_time = t
-                
-            # del item
-        
-        log.verbose("Scan found %d/%s new %d/%s changed %d/%s deleted" % (
-                newentries, sizestr(newbytes),
-                origentries, sizestr(origbytes),
-                lostentries,sizestr(lostbytes)))
+            progress.lostentries += 1
+            progress.lostbytes += item.size or 0
+            return
 
-        # refresh phase
-        
-        refentries = 0
-        refbytes = 0
-        staleentries = origentries + newentries
-        stalebytes = origbytes + newbytes
-        
-        refstart = time.time()
+        if done.fileid != item.fileid:
+            # The file was replaced while it was being read, so the item
+            # is now known by the id of the new one, unless some other
+            # item already is
 
-        if checkpoint:
-            log.info("Doing first checkpoint save")
-            if not self.save():
-                log.error("Cannot save metadata - giving up")
+            if done.fileid in self.byfileid:
+                log.warning("%s was replaced while it was being read - leaving it stale" % (item.path))
                 return
-            cp_time = refstart
 
-        for item in self.byfileid.itervalues():
-            if not item.stale:
+            del self.byfileid[item.fileid]
+            self._record_gone(item)
+            self.byfileid[done.fileid] = item
+
+        # The scan may have found more links to the item, or lost some,
+        # while the copy was being hashed
+
+        (path,paths) = (item.path,item.paths)
+        item.__setstate__(done.__getstate__())
+        (item.path,item.paths) = (path,paths)
+
+        log.info("Refreshed item %s" % (item.path))
+
+        progress.refentries += 1
+        progress.refbytes += item.size or 0
+
+        self._reindex(item,oldid,oldchunks)
+        self._record(item)
+        if item.stale or oldid != item.cid or item.otype == OTYPE_DIR:
+            self._changed(item)
+
+    def refresh_item(self,item,progress=None):
+        """
+        Compute the content id of a single stale item now.   As in
+        :meth:`refresh`, a copy of the item is refreshed: if that fails,
+        the item is left stale, or forgotten if it has gone.
+        """
+
+        (_,done) = _refresh_one((0,copy.copy(item),self.content,self._refresh_opts()))
+        self._refreshed(item,done,item.cid,item.chunks,progress or RefreshProgress())
+        return item
+
+    def _refresh_opts(self):
+        """ The options for :meth:`CasFSItem.refresh` that this store uses """
+
+        return dict(hasher=self.hasher,algorithm=self.algorithm,chunker=self.chunker,tree=self.tree,xattrs=self.xattrs)
+
+    def _outdated(self,item):
+        """Returns True if the content id of `item` was made in a way
+        this store no longer uses: by another hash algorithm, or chunked
+        when it shouldn't be (or the other way round), or chunked differently,
+        or a tree hash when it shouldn't be (or the other way round).
+        Literal and empty ids never need remaking.
+        """
+
+        if item.otype == OTYPE_FILE and item.cid is not None:
+            chunked = self.chunker is not None and self.chunker.wants(item.size)
+            if chunked != (item.chunks is not None):
+                return True
+            if chunked:
+                return self._rechunk or self._outdated_id(item.cid)
+            if cas_id_algorithm(item.cid) and item.cid.startswith(CAS_ID_TREE) != self.tree:
+                return True
+
+        return self._outdated_id(item.cid)
+
+    def _outdated_id(self,cid):
+        a = cas_id_algorithm(cid)
+        return a is not None and a.name != self.algorithm
+
+    def _reindex(self,item,oldid,oldchunks=None):
+        """Update :attr:`byid` and :attr:`bychunk` after the content id of
+        `item` has changed from `oldid`, and its chunks from `oldchunks`.
+        """
+
+        if oldid == item.cid:
+            return
+
+        if self.byid.get(oldid,None) is item:
+            del self.byid[oldid]
+        if item.cid is not None:
+            self.byid[item.cid] = item
+
+        self._count_chunks(oldchunks,-1)
+        self._count_chunks(item.chunks,1)
+
+    def _unindex(self,item):
+        """Forget all about `item`"""
+
+        del self.byfileid[item.fileid]
+        for p in list(item.paths):
+            self._unlink(item,p)
+        if self.byid.get(item.cid,None) is item:
+            del self.byid[item.cid]
+        self._count_chunks(item.chunks,-1)
+
+    def _link(self,item,path):
+        """Record that `item` is at `path`"""
+
+        if path not in item.paths:
+            item.paths.append(path)
+        self.bypath[path] = item
+        try:
+            self.bydir[parentpath(path)][os.path.basename(path)] = item
+        except KeyError:
+            self.bydir[parentpath(path)] = {os.path.basename(path): item}
+
+    def _unlink(self,item,path):
+        """Record that `item` is no longer at `path`"""
+
+        if path in item.paths:
+            item.paths.remove(path)
+        if self.bypath.get(path,None) is item:
+            del self.bypath[path]
+
+        d = parentpath(path)
+        entries = self.bydir.get(d,None)
+        if entries is not None and entries.get(os.path.basename(path),None) is item:
+            del entries[os.path.basename(path)]
+            if not entries:
+                del self.bydir[d]
+
+    def _subtree(self,p):
+        """Generates (path, item) for the paths at `p` and below it"""
+
+        item = self.bypath.get(p,None)
+        if item is not None:
+            yield (p,item)
+
+        q = [p]
+        while q:
+            d = q.pop()
+            for (name,item) in self.bydir.get(d,{}).items():
+                path = os.path.join(d,name)
+                yield (path,item)
+                q.append(path)
+
+    def _record(self,item):
+        """Note that `item` needs saving by the next :meth:`save`"""
+
+        self._changes[item.fileid] = item
+
+    def _record_gone(self,item):
+        """Note that the next :meth:`save` needs to drop `item`"""
+
+        self._changes[item.fileid] = None
+
+    def _changed(self,item):
+        """Note that the id of the directory containing `item` needs
+        remaking, and if `item` is a directory, so does its own.
+        """
+
+        self._dirty.update(parentpath(p) for p in item.paths)
+        if item.otype == OTYPE_DIR:
+            self._dirty.add(item.path)
+
+    def update_dirids(self):
+        """
+        Remake the ids of the directories that have changed, and of
+        all the directories above them.
+        """
+
+        heap = [(-pathdepth(d),d) for d in self._dirty]
+        heapq.heapify(heap)
+        self._dirty = set()
+
+        done = set()
+        while heap:
+            (_,d) = heapq.heappop(heap)
+            if d in done:
                 continue
-                
-            log.info("Refresh item %s" % (item.path))
-            
+            done.add(d)
+
+            entries = self._dir_entries(d)
+            cid = cas_dir_to_id(((name,i.otype,i.mode,i.cid) for (name,i) in sorted(entries.iteritems())),self.algorithm)
+
+            if d == '':
+                self.rootid = cid
+                continue
+
+            item = self.bypath.get(d,None)
+            if item is None or item.otype != OTYPE_DIR or item.cid == cid:
+                continue
+
             oldid = item.cid
-            item.refresh(self.content)
-            refentries += 1
-            refbytes += item.size
+            item.cid = cid
+            self._reindex(item,oldid)
+            self._record(item)
+            p = parentpath(d)
+            heapq.heappush(heap,(-pathdepth(p),p))
 
-            if oldid != item.cid:
-                try:
-                    del self.byid[oldid]
-                except:
-                    pass
-                self.byid[item.cid] = item
-            # FIXME: track path changes too?
+        log.verbose("Remade %d directory ids" % (len(done)))
 
-            t = time.time()
-            if (t-log_time) > 1:
-                countpc = int(refentries*100./staleentries)    # percent done by count
-                bytespc = int(refbytes*100./stalebytes)        # percent done by bytes
-        
-                reftogo = ((t-refstart)*(stalebytes-refbytes))/refbytes  #
-                eta = t+reftogo
-                
-                eta = time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(eta))
-                
-                log.verbose("Refreshing: done %d/%d=%d%% %s/%s=%d%% in %ds, %ds to go ETA %s" % (
-                            refentries, staleentries, countpc,
-                                sizestr(refbytes),sizestr(stalebytes),bytespc,
-                                t-refstart,reftogo,eta))
-                if (checkpoint > 0) and ((t-cp_time) > checkpoint):
-                    log.info("Doing checkpoint save")
-                    if not self.save():
-                        log.error("Cannot save metadata - giving up")
-                        return
-                    cp_time = t
-                else:
-                    log.verbose("No checkpoint this time %d %d" % (checkpoint,t-cp_time))
-                    
-                log_time = t
+    def _dir_entries(self,d):
+        """The entries of directory `d`, leaving out the metadata of
+        the store itself"""
+
+        entries = self.bydir.get(d,{})
+        if d == '' and self.metadata in entries:
+            entries = dict(entries)
+            del entries[self.metadata]
+        return entries
+
+    def diff(self,other,path=''):
+        """
+        Generates a (path, item, other item) tuple for each path that
+        differs between this store and `other`, either of the items being
+        None if there is nothing at that path.   Directories with matching
+        ids are not examined any further.
+        """
+
+        if path == '' and self.rootid is not None and self.rootid == other.rootid:
+            return
+
+        mine = self._dir_entries(path)
+        theirs = other._dir_entries(path)
+
+        for name in sorted(set(mine) | set(theirs)):
+            a = mine.get(name,None)
+            b = theirs.get(name,None)
+            p = os.path.join(path,name)
+
+            if a is not None and b is not None and a.cid is not None and a.entry()[1:] == b.entry()[1:]:
+                continue
+
+            yield (p,a,b)
+
+            if a is not None and b is not None and a.otype == OTYPE_DIR and b.otype == OTYPE_DIR:
+                for d in self.diff(other,p):
+                    yield d
+
+    def _count_chunks(self,chunks,n):
+        if not chunks:
+            return
+
+        for (cid,size) in chunks:
+            uses = self.bychunk.get(cid,0) + n
+            if uses > 0:
+                self.bychunk[cid] = uses
+            else:
+                self.bychunk.pop(cid,None)
+
+    def missing_chunks(self,chunks):
+        """
+        Returns the chunks in the manifest `chunks` that aren't in any
+        file in this store: the only parts of a chunked file that would
+        need to be transferred to recreate it here.
+        """
+
+        return [c for c in chunks if c[0] not in self.bychunk]
 
-        log.info("Refresh completed.")
-            
     def _fetch(self,item):
         """ Fetch content of an item and ensure that it
         matches the id we expect.  If not, update for the
@@ -580,22 +1824,65 @@ class CasFileTreeStore(CasStoreBase):
         
         log.info("__getstate__ saving %d items" % (len(items)))
         
-        return dict(version=self.version,item=items)
+        return dict(self._header(),item=items)
+
+    def _header(self):
+        """The state of this store, apart from its items"""
+
+        chunker = self.chunker and self.chunker.__getstate__()
+        volumes = sorted(self.volumes.items())
+
+        return dict(version=self.version,algorithm=self.algorithm,chunker=chunker,tree=self.tree,rootid=self.rootid,exclude=self.exclude,volumes=volumes,seq=self._seq,pending=self.pending)
     
     def __setstate__(self,state):
+        self._set_header(state)
+        self._add_items(state.item)
+
+    def _set_header(self,state):
+        """Restores the state of the store, apart from its items"""
+
         assert state.version == self.version
 
+        # Metadata from before algorithms were recorded only has sha512 ids
+
+        if self.algorithm is None:
+            self.algorithm = state.algorithm or DEFAULT_ALGORITHM
+
+        if self.tree is None:
+            self.tree = bool(state.tree)
+
+        if self.exclude is None:
+            self.exclude = state.exclude or []
+
+        chunker = state.chunker and CasChunker(**state.chunker)
+        if self.chunker is None:
+            self.chunker = chunker
+        else:
+            self._rechunk = (self.chunker != chunker)
+
+        self.rootid = state.rootid
+        self.volumes = dict(state.volumes or [])
+        self.pending = state.pending
+        self._checked = set()
+
+    def _add_items(self,items):
+        """Indexes the saved `items`"""
+
+        self.byfileid = {}
         self.byid = {}
         self.bypath = {}
+        self.bychunk = {}
+        self.bydir = {}
         
-        log.info("__setstate__ loading %d items" % (len(state.item)))
-        
-        for i in state.item:
+        for i in items:
 #            print "Load %s" % (i)
             ci = CasFSItem(saved=i)
-            self.byid[ci.cid] = ci
-            self.bypath[ci.path] = ci
+            if ci.cid is not None:
+                self.byid[ci.cid] = ci
+            for p in list(ci.paths):
+                self._link(ci,p)
             self.byfileid[ci.fileid] = ci
+            self._count_chunks(ci.chunks,1)
         
         log.info("loaded %d ids, %d paths, %d fileids" % (len(self.byid),len(self.bypath),len(self.byfileid)))
         
@@ -0,0 +1,181 @@
+#
+# exclude rules
+#
+
+"""
+
+Excluding content
+-----------------
+
+Some of what lives under a content root isn't worth having in a store:
+build output, caches, version control internals, and the store's own
+metadata.   Rules for what to leave out are written like those of a
+``.gitignore`` file, and are read from a :data:`IGNORE_FILE` at the top
+of the content and from the command line.
+
+- Blank lines, and lines starting with ``#``, are ignored.
+- A pattern that ends with ``/`` only matches directories.
+- A pattern with a ``/`` anywhere else is matched against the whole path,
+  relative to the top of the content; otherwise it is matched against
+  the last part of the path, at any depth.
+- ``*`` matches anything except ``/``, ``?`` matches any one character
+  except ``/``, and ``[...]`` matches any one character in the set.
+- ``**/`` at the start matches any number of directories, ``/**/``
+  in the middle matches zero or more, and ``/**`` at the end matches
+  everything inside.
+- A pattern that starts with ``!`` includes again what an earlier
+  pattern excluded.   The last pattern that matches a path decides.
+
+Rules are applied while the tree is being walked, so an excluded
+directory is never listed, and nothing inside it is ever statted;
+as with git, nothing inside an excluded directory can be included again.
+
+Unlike git, only the one :data:`IGNORE_FILE` at the top of the content
+is read.
+
+.. autoclass:: CasIgnore
+
+"""
+
+import os
+import re
+
+IGNORE_FILE='.casignore'
+
+def _translate(pat):
+    """Translates a glob to a regular expression"""
+
+    i = 0
+    n = len(pat)
+    res = ''
+    while i < n:
+        if pat.startswith('**/',i):
+            res += '(?:.*/)?'
+            i += 3
+        elif pat.startswith('**',i):
+            res += '.*'
+            i += 2
+        else:
+            c = pat[i]
+            i += 1
+            if c == '*':
+                res += '[^/]*'
+            elif c == '?':
+                res += '[^/]'
+            elif c == '\\' and i < n:
+                res += re.escape(pat[i])
+                i += 1
+            elif c == '[':
+                j = pat.find(']',i+1)
+                if j < 0:
+                    res += '\\['
+                    continue
+                cls = pat[i:j].replace('\\','\\\\')
+                if cls.startswith('!'):
+                    cls = '^'+cls[1:]
+                res += '['+cls+']'
+                i = j+1
+            else:
+                res += re.escape(c)
+    return res
+
+def _compile(pattern):
+    """Returns (regular expression, negated, directories only) for a
+    pattern, or None for a comment or blank line."""
+
+    p = pattern.rstrip('\n').rstrip()
+    if not p or p.startswith('#'):
+        return None
+
+    negate = p.startswith('!')
+    if negate:
+        p = p[1:]
+    elif p.startswith('\\'):
+        p = p[1:]
+
+    dironly = p.endswith('/')
+    p = p.rstrip('/')
+    if not p:
+        return None
+
+    if '/' in p:
+        regex = _translate(p.lstrip('/'))
+    else:
+        regex = '(?:.*/)?'+_translate(p)
+
+    return (regex,negate,dironly)
+
+def escape(name):
+    """Returns a pattern that matches exactly `name`"""
+
+    return re.sub(r'([\\*?\[!#])',r'\\\1',name)
+
+class CasIgnore(object):
+    """
+    A compiled list of exclude `patterns`.
+
+    .. automethod:: excluded
+    .. automethod:: excludes_path
+    .. automethod:: from_file
+    """
+
+    def __init__(self,patterns=()):
+        self.patterns = []
+        self._rules = []
+        for p in patterns:
+            r = _compile(p)
+            if r is None:
+                continue
+            (regex,negate,dironly) = r
+            self.patterns.append(p)
+            self._rules.append((re.compile(regex+r'\Z'),negate,dironly))
+
+        self._rules.reverse()    # The last match decides
+
+        # One expression that matches any path that any rule might
+        # match, to make the common case quick
+
+        if self._rules:
+            self._any = re.compile('|'.join('(?:%s)\\Z' % (r[0].pattern[:-2]) for r in self._rules))
+        else:
+            self._any = None
+
+    def __nonzero__(self):
+        return bool(self._rules)
+
+    @classmethod
+    def from_file(cls,path,extra=()):
+        """Reads patterns from file `path`, if it exists, and adds `extra`
+        patterns after them"""
+
+        try:
+            with open(path) as f:
+                patterns = f.read().splitlines()
+        except IOError:
+            patterns = []
+        return cls(patterns+list(extra))
+
+    def excluded(self,path,isdir):
+        """Returns True if `path` (relative to the top of the content, with
+        `/` separators) is excluded; `isdir` says whether it is a
+        directory."""
+
+        if self._any is None or not self._any.match(path):
+            return False
+
+        for (regex,negate,dironly) in self._rules:
+            if dironly and not isdir:
+                continue
+            if regex.match(path):
+                return not negate
+        return False
+
+    def excludes_path(self,path,isdir):
+        """Like :meth:`excluded`, but also True if any directory above
+        `path` is excluded."""
+
+        parts = path.split('/')
+        for n in range(1,len(parts)):
+            if self.excluded('/'.join(parts[:n]),True):
+                return True
+        return self.excluded(path,isdir)
@@ -0,0 +1,207 @@
+#
+# an append-only log of changes to a store
+#
+
+"""
+
+Metadata journal
+----------------
+
+Saving the whole of a big store's metadata takes as long as there are
+items, however few of them have changed, which makes frequent
+checkpoints cost more than the hashing they protect.   So after the
+first save, a :class:`CasFileTreeStore` only appends the items that have
+changed to a journal next to its metadata file (see
+:data:`JOURNAL_SUFFIX`), and a load reads the last full save and then
+replays the journal.
+
+Each line of the journal is one JSON record, ``[seq, op, data]``:
+
++---------+------------------------------------------------------------+
+| op      | data                                                       |
++=========+============================================================+
+| put     | The state of an item, replacing any with the same fileid   |
++---------+------------------------------------------------------------+
+| del     | The fileid of an item that has gone                        |
++---------+------------------------------------------------------------+
+| store   | The state of the store itself, without any items           |
++---------+------------------------------------------------------------+
+
+Sequence numbers only ever increase.   A full save records the number of
+the last record it includes, and replaying skips anything up to that.
+Records are written in batches of :data:`JOURNAL_BATCH`, each of which is
+flushed to disk before the next is written; anything after the last
+complete line (left by a crash) is ignored, and cut off before anything
+else is appended.
+
+Once the journal has more records than the store has items (or
+:data:`JOURNAL_MIN`, whichever is more), it is folded into a new full
+save by :meth:`CasFileTreeStore.compact`, in a thread of its own, while
+the store carries on appending to it.
+
+.. autoclass:: CasJournal
+.. autofunction:: replay
+
+"""
+
+import os
+import threading
+import collections
+
+from _base import cas_to_json, cas_from_json
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+JOURNAL_SUFFIX='.log'
+JOURNAL_BATCH=1000      # Records written between flushes
+JOURNAL_MIN=10000       # Records worth keeping before compacting
+
+OP_PUT='put'
+OP_DEL='del'
+OP_STORE='store'
+
+class CasJournal(object):
+    """
+    The journal at `path`.   Appending and truncating are done under
+    :attr:`lock`, so one thread can compact the journal while another
+    appends to it.
+
+    .. automethod:: append
+    .. automethod:: read
+    .. automethod:: truncate
+    .. automethod:: remove
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self,records):
+        """Appends `records`, each a (seq, op, data) tuple; returns how many
+        there were"""
+
+        n = 0
+        with self.lock:
+            with open(self.path,'ab+') as f:
+                self._repair(f)
+                batch = []
+                for r in records:
+                    batch.append(cas_to_json(r))
+                    if len(batch) >= JOURNAL_BATCH:
+                        n += self._write(f,batch)
+                        batch = []
+                n += self._write(f,batch)
+        return n
+
+    def _repair(self,f):
+        """Cuts off any incomplete record at the end of `f`"""
+
+        f.seek(0,os.SEEK_END)
+        size = f.tell()
+        if not size:
+            return
+        f.seek(-1,os.SEEK_END)
+        if f.read(1) == '\n':
+            return
+
+        f.seek(0)
+        data = f.read()
+        keep = data.rfind('\n')+1
+        log.warning("Dropping %d bytes of incomplete record from %s" % (size-keep,self.path))
+        f.truncate(keep)
+        f.seek(0,os.SEEK_END)
+
+    def _write(self,f,batch):
+        if not batch:
+            return 0
+        f.write('\n'.join(batch)+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+        return len(batch)
+
+    def read(self,after=0):
+        """Generates the (seq, op, data) records with sequence numbers
+        above `after`"""
+
+        try:
+            f = open(self.path,'rb')
+        except IOError:
+            return
+
+        with f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break       # Incomplete
+                try:
+                    (seq,op,data) = cas_from_json(line)
+                except ValueError:
+                    log.warning("Bad record in %s: stopping there" % (self.path))
+                    break
+                if seq > after:
+                    yield (seq,op,data)
+
+    def truncate(self,after):
+        """Drops the records with sequence numbers up to `after`"""
+
+        tmp = self.path+'.tmp'
+        with self.lock:
+            records = [cas_to_json(r) for r in self.read(after)]
+            if not records:
+                self._remove()
+                return
+            with open(tmp,'wb') as f:
+                self._write(f,records)
+            os.rename(tmp,self.path)
+
+    def remove(self):
+        """Drops every record"""
+
+        with self.lock:
+            self._remove()
+
+    def _remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def replay(state,records):
+    """Applies journal `records` to `state`, the state of a whole store
+    as loaded from a full save; returns the number applied.
+
+    The items of `state` may be read as they are used (see
+    :func:`gzipload`): the changes to them are made as they go by.
+    """
+
+    changes = collections.OrderedDict()     # New state of each item, or None
+
+    n = 0
+    for (seq,op,data) in records:
+        if op == OP_PUT and data.fileid is None:
+            log.warning("Ignoring journal record %d: an item with no fileid" % (seq))
+        elif op == OP_PUT:
+            changes[tuple(data.fileid)] = data
+        elif op == OP_DEL:
+            changes[tuple(data)] = None
+        elif op == OP_STORE:
+            state.update(data)
+        state.seq = seq
+        n += 1
+
+    if changes:
+        state.item = _replayed(state.item or [],changes)
+    return n
+
+def _replayed(items,changes):
+    for i in items:
+        fileid = tuple(i.fileid)
+        if fileid in changes:
+            i = changes.pop(fileid)
+        if i is not None:
+            yield i
+
+    for i in changes.itervalues():
+        if i is not None:
+            yield i
@@ -0,0 +1,415 @@
+#
+# store metadata in a compact binary file
+#
+
+"""
+
+Packed metadata
+---------------
+
+Compressed JSON repeats every field name, and the version, user and
+group of every item, and loading it parses all of it.   A store whose
+metadata file is named with :data:`PACKED_SUFFIX` (say ``.cas.pack``)
+keeps it in a binary file instead, laid out so that it can be mapped
+into memory and read where it lies: opening one reads only the state
+of the store itself, and an item is decoded only when it is asked for,
+so both the time taken and the memory used grow with what is actually
+looked at.   As for SQLite metadata (see :class:`CasSqliteMetadata`),
+:meth:`CasFileTreeStore.item_at`, :meth:`CasFileTreeStore.items_in` and
+:meth:`CasFileTreeStore.items_with_id` don't need the rest of the items.
+
+The file starts with :data:`PACKED_MAGIC` and the format number
+(:data:`PACKED_FORMAT`), then the width of the digest column, the numbers
+of items, paths, content ids and strings, and the offset of each of the
+arrays that follow.   Everything is little-endian.
+
+Each field of the items is a column: an array with one fixed-width entry
+per item.   Numbers are stored as they are, with a bitmap of those that
+are None; strings (users, groups, paths, and so on) are numbers of
+entries in a table of strings, each stored once however often it is
+used.   A content id made by a hash algorithm is stored as its prefix
+(a string) and its digest, in binary; any other id is just a string.
+Fields that only some items have (such as chunks) are kept as a JSON
+string per item.
+
+The paths are in an array of their own, sorted by directory and name,
+and so are the items that have content ids, sorted by id, so that
+lookups are binary searches.   String 0 is the state of the store, as
+JSON.
+
+A packed file is always written whole (to a temporary file, which then
+replaces it), so it suits stores that are read far more often than they
+are saved; for frequent checkpoints, SQLite is better.   To change the
+format of a store, see :class:`ConvertCommand`.
+
+.. autoclass:: CasPackedMetadata
+
+"""
+
+import os
+import mmap
+import struct
+import base64
+import binascii
+
+from _base import cas_to_json, cas_from_json, cas_id_algorithm, CAS_ID_QUALIFIED, CasJson, _b64
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+PACKED_SUFFIX='.pack'
+PACKED_MAGIC='CASPACK\0'
+PACKED_FORMAT=1
+
+NONE=0xffffffff         # The string number of None
+
+# Numeric fields of each item, any of which may be None
+
+_NUMBERS = (
+    ('dev','Q'),
+    ('ino','Q'),
+    ('size','Q'),
+    ('mtime','d'),
+    ('atime','d'),
+    ('ctime','d'),
+    ('stime','d'),
+    ('mode','I'),
+    ('uid','I'),
+    ('gid','I'),
+)
+
+# String fields
+
+_STRINGS = ('version','uname','gname')
+
+# Fields that are often missing, and what they are then
+
+_DEFAULTS = dict(expiry=None,pcid=None,chunks=None)
+
+# The fields that have columns of their own
+
+_COLUMNS = set([name for (name,_) in _NUMBERS]+list(_STRINGS)+['fileid','otype','stale','cid','path','paths'])
+
+# The arrays in the file, in order; the width of 'digest' depends
+# on the digests in it, and 'strdata' is just bytes
+
+_ARRAYS = [(name,fmt) for (name,fmt) in _NUMBERS]+[(name,'I') for name in _STRINGS]+[
+    ('nulls','I'),      # Bitmap of _NUMBERS that are None
+    ('otype','c'),
+    ('stale','B'),
+    ('cidp','I'),       # Prefix of the content id, or all of it
+    ('cidn','B'),       # Length of the digest, or 0
+    ('digest',None),
+    ('first','I'),      # First entry of 'pathlist' for this item
+    ('npaths','I'),     # ... and how many there are
+    ('extra','I'),      # JSON of other fields
+    ('pathlist','I'),   # Path rows of each item, in order
+    ('pdir','I'),       # Directory of each path row
+    ('pname','I'),      # ... name
+    ('pitem','I'),      # ... and item
+    ('cids','I'),       # Items with content ids, in order of id
+    ('stroff','Q'),     # Offset of each string, and of the end
+    ('strdata','s'),
+]
+
+_HEAD = struct.Struct('<8sIIQQQQ')
+
+def is_packed(path):
+    """True if metadata at `path` is kept in a packed file"""
+
+    return path.endswith(PACKED_SUFFIX)
+
+def _text(s):
+    return s.decode('utf-8') if isinstance(s,str) else s
+
+def _split_cid(cid):
+    """Returns (prefix, digest) for content id `cid`, or (cid, '')
+    if it isn't a digest"""
+
+    if cas_id_algorithm(cid) is None:
+        return (cid,'')
+
+    n = 2 if cid[0] in CAS_ID_QUALIFIED else 1
+    try:
+        digest = base64.b64decode(cid[n:],'._')
+    except (TypeError,binascii.Error):
+        return (cid,'')
+    if _b64(digest) != cid[n:]:
+        return (cid,'')
+    return (cid[:n],digest)
+
+class _Strings(object):
+    """The string table of a file being written"""
+
+    def __init__(self):
+        self.index = {}
+        self.offsets = [0]
+        self.data = []
+
+    def add(self,s):
+        if s is None:
+            return NONE
+        k = self.index.get(s,None)
+        if k is None:
+            b = _text(s).encode('utf-8')
+            k = self.index[s] = len(self.data)
+            self.data.append(b)
+            self.offsets.append(self.offsets[-1]+len(b))
+        return k
+
+class CasPackedMetadata(object):
+    """
+    The metadata of a store, in the packed file at `path`, which is
+    mapped into memory.
+
+    Items are written as :class:`CasFSItem` objects, and read back out
+    as their saved state.
+
+    .. automethod:: header
+    .. automethod:: items
+    .. automethod:: item_at
+    .. automethod:: items_in
+    .. automethod:: items_with_id
+    .. automethod:: write
+    """
+
+    def __init__(self,path):
+        self.path = path
+        with open(path,'rb') as f:
+            self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+        (magic,fmt,width,self.n,self.npaths,self.ncids,self.nstrings) = _HEAD.unpack_from(self.map,0)
+        if magic != PACKED_MAGIC:
+            raise ValueError("%s is not packed metadata" % (path))
+        if fmt != PACKED_FORMAT:
+            raise ValueError("%s is packed format %d, not %d" % (path,fmt,PACKED_FORMAT))
+
+        offsets = struct.unpack_from('<%dQ' % (len(_ARRAYS)),self.map,_HEAD.size)
+        self.arrays = {}
+        for ((name,fmt),offset) in zip(_ARRAYS,offsets):
+            if name == 'digest':
+                fmt = '%ds' % (width)
+            self.arrays[name] = (offset,struct.Struct('<'+fmt))
+
+    def close(self):
+        self.map.close()
+
+    def _get(self,name,k):
+        (offset,s) = self.arrays[name]
+        return s.unpack_from(self.map,offset+k*s.size)[0]
+
+    def _string(self,k):
+        if k == NONE:
+            return None
+        (offset,s) = self.arrays['stroff']
+        (a,b) = struct.unpack_from('<QQ',self.map,offset+k*s.size)
+        base = self.arrays['strdata'][0]
+        return self.map[base+a:base+b].decode('utf-8')
+
+    def _path(self,r):
+        d = self._string(self._get('pdir',r))
+        return os.path.join(d,self._string(self._get('pname',r)))
+
+    def _cid(self,k):
+        p = self._string(self._get('cidp',k))
+        n = self._get('cidn',k)
+        if p is None or not n:
+            return p
+        return p+_b64(self._get('digest',k)[:n])
+
+    def header(self):
+        """The saved state of the store, without its items"""
+
+        return cas_from_json(self._string(0))
+
+    def item(self,k):
+        """The saved state of item number `k`"""
+
+        state = CasJson(_DEFAULTS)
+        nulls = self._get('nulls',k)
+        for (bit,(name,_)) in enumerate(_NUMBERS):
+            state[name] = None if nulls & (1<<bit) else self._get(name,k)
+        for name in _STRINGS:
+            state[name] = self._string(self._get(name,k))
+
+        state.fileid = (state.pop('dev'),state.pop('ino'))
+        otype = self._get('otype',k)
+        state.otype = otype if otype != '\0' else None
+        state.stale = bool(self._get('stale',k))
+        state.cid = self._cid(k)
+
+        first = self._get('first',k)
+        state.paths = [self._path(self._get('pathlist',first+j)) for j in range(self._get('npaths',k))]
+        state.path = state.paths[0] if state.paths else None
+
+        extra = self._string(self._get('extra',k))
+        if extra is not None:
+            state.update(cas_from_json(extra))
+        return state
+
+    def items(self):
+        """Generates the saved state of every item"""
+
+        for k in xrange(self.n):
+            yield self.item(k)
+
+    def __len__(self):
+        return self.n
+
+    def _path_key(self,r):
+        return (self._string(self._get('pdir',r)),self._string(self._get('pname',r)))
+
+    def _first_path(self,key):
+        """The first path row that isn't before `key`"""
+
+        (lo,hi) = (0,self.npaths)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._path_key(mid) < key:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    def item_at(self,path):
+        """The item at `path`, or None"""
+
+        path = _text(path)
+        key = (os.path.dirname(path),os.path.basename(path))
+        r = self._first_path(key)
+        if r < self.npaths and self._path_key(r) == key:
+            return self.item(self._get('pitem',r))
+        return None
+
+    def items_in(self,d):
+        """Generates (name, item) for the entries of directory `d`"""
+
+        d = _text(d)
+        r = self._first_path((d,u''))
+        while r < self.npaths:
+            (pd,name) = self._path_key(r)
+            if pd != d:
+                break
+            yield (name,self.item(self._get('pitem',r)))
+            r += 1
+
+    def items_with_id(self,cid):
+        """Generates the items with content id `cid`"""
+
+        (lo,hi) = (0,self.ncids)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._cid(self._get('cids',mid)) < cid:
+                lo = mid+1
+            else:
+                hi = mid
+
+        while lo < self.ncids:
+            k = self._get('cids',lo)
+            if self._cid(k) != cid:
+                break
+            yield self.item(k)
+            lo += 1
+
+    @staticmethod
+    def write(path,header,items):
+        """
+        Writes `header`, the state of a store apart from its items, and
+        all of its `items`, to a packed file at `path`.
+        """
+
+        strings = _Strings()
+        strings.add(cas_to_json(header))
+
+        columns = dict((name,[]) for (name,_) in _ARRAYS)
+        digests = []
+        rows = []
+        cids = []
+
+        for (k,item) in enumerate(items):
+            state = dict(item.__getstate__())
+            (state['dev'],state['ino']) = state['fileid']
+
+            nulls = 0
+            for (bit,(name,_)) in enumerate(_NUMBERS):
+                v = state.get(name,None)
+                if v is None:
+                    nulls |= 1<<bit
+                    v = 0
+                columns[name].append(v)
+            columns['nulls'].append(nulls)
+
+            for name in _STRINGS:
+                columns[name].append(strings.add(state.get(name,None)))
+
+            columns['otype'].append(str(state.get('otype',None) or '\0'))
+            columns['stale'].append(1 if state.get('stale',False) else 0)
+
+            cid = state.get('cid',None)
+            (prefix,digest) = _split_cid(cid) if cid is not None else (None,'')
+            columns['cidp'].append(strings.add(prefix))
+            columns['cidn'].append(len(digest))
+            digests.append(digest)
+            if cid is not None:
+                cids.append((cid,k))
+
+            paths = state.get('paths',None) or []
+            extra = dict((name,v) for (name,v) in state.iteritems()
+                if name not in _COLUMNS and v != _DEFAULTS.get(name,NONE))
+            if state.get('path',None) != (paths[0] if paths else None):
+                extra['path'] = state['path']
+
+            columns['first'].append(len(columns['pathlist']))
+            columns['npaths'].append(len(paths))
+            for p in paths:
+                p = _text(p)
+                columns['pathlist'].append(len(rows))
+                rows.append((os.path.dirname(p),os.path.basename(p),k,len(rows)))
+            columns['extra'].append(strings.add(cas_to_json(extra)) if extra else NONE)
+
+        # The path rows are numbered in the order they were found, but
+        # stored in order of directory and name
+
+        rows.sort()
+        where = [0]*len(rows)
+        for (r,(d,name,k,found)) in enumerate(rows):
+            where[found] = r
+            columns['pdir'].append(strings.add(d))
+            columns['pname'].append(strings.add(name))
+            columns['pitem'].append(k)
+        columns['pathlist'] = [where[found] for found in columns['pathlist']]
+
+        cids.sort()
+        columns['cids'] = [k for (_,k) in cids]
+        columns['stroff'] = strings.offsets
+
+        width = max([len(d) for d in digests] or [0])
+
+        arrays = []
+        for (name,fmt) in _ARRAYS:
+            if name == 'digest':
+                data = ''.join(d.ljust(width,'\0') for d in digests)
+            elif name == 'strdata':
+                data = ''.join(strings.data)
+            else:
+                v = columns[name]
+                data = struct.pack('<%d%s' % (len(v),fmt),*v)
+            arrays.append(data)
+
+        offset = _HEAD.size+8*len(arrays)
+        offsets = []
+        for data in arrays:
+            offsets.append(offset)
+            offset += len(data)
+
+        tmp = path+'.tmp'
+        with open(tmp,'wb') as f:
+            f.write(_HEAD.pack(PACKED_MAGIC,PACKED_FORMAT,width,len(columns['nulls']),len(rows),len(cids),len(strings.data)))
+            f.write(struct.pack('<%dQ' % (len(offsets)),*offsets))
+            for data in arrays:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp,path)
+        log.verbose("Packed %d items into %d bytes" % (len(columns['nulls']),offset))
@@ -0,0 +1,169 @@
+#
+# store metadata in an SQLite database
+#
+
+"""
+
+SQLite metadata
+---------------
+
+A store whose metadata file is named with :data:`SQLITE_SUFFIX` (say
+``.cas.sqlite``) keeps it in an SQLite database rather than a
+compressed JSON file.   Opening the store only reads the state of the
+store itself: the items are indexed by path, directory, content id and
+fileid in the database, so that looking up a few of them
+(:meth:`CasFileTreeStore.item_at`, :meth:`CasFileTreeStore.items_in`,
+:meth:`CasFileTreeStore.items_with_id`) doesn't need the rest.   Anything
+that needs the whole store, such as a refresh, loads all the items the
+first time it looks at them.
+
+Each save writes what has changed since the last one, in a single
+transaction, so checkpoints are cheap.   The database is in
+write-ahead-log mode, so the store can be read while it is being
+refreshed.
+
+To change the format of a store, load it and save it under the other
+name (see :class:`ConvertCommand`).
+
+.. autoclass:: CasSqliteMetadata
+
+"""
+
+import os
+import sqlite3
+
+from _base import cas_to_json, cas_from_json
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+SQLITE_SUFFIX='.sqlite'
+SQLITE_TIMEOUT=60       # Seconds to wait for another process
+SQLITE_BATCH=10000      # Rows written per statement
+
+_SCHEMA = """
+create table if not exists store (
+    state text not null
+);
+create table if not exists items (
+    dev not null,
+    ino integer not null,
+    cid text,
+    state text not null,
+    primary key (dev,ino)
+);
+create index if not exists items_cid on items (cid);
+create table if not exists paths (
+    path text primary key,
+    dir text not null,
+    dev not null,
+    ino integer not null
+);
+create index if not exists paths_dir on paths (dir);
+create index if not exists paths_fileid on paths (dev,ino);
+"""
+
+def is_sqlite(path):
+    """True if metadata at `path` is kept in SQLite"""
+
+    return path.endswith(SQLITE_SUFFIX)
+
+def _batches(seq,n=SQLITE_BATCH):
+    batch = []
+    for x in seq:
+        batch.append(x)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class CasSqliteMetadata(object):
+    """
+    The metadata of a store, in the SQLite database at `path`.
+
+    Items are passed in as :class:`CasFSItem` objects, and come back
+    out as their saved state.
+
+    .. automethod:: header
+    .. automethod:: items
+    .. automethod:: item_at
+    .. automethod:: items_in
+    .. automethod:: items_with_id
+    .. automethod:: write
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.db = sqlite3.connect(path,timeout=SQLITE_TIMEOUT,check_same_thread=False)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def header(self):
+        """The saved state of the store, without its items, or None"""
+
+        r = self.db.execute("select state from store").fetchone()
+        return r and cas_from_json(r[0])
+
+    def _states(self,cursor):
+        for (state,) in cursor:
+            yield cas_from_json(state)
+
+    def items(self):
+        """Generates the saved state of every item"""
+
+        return self._states(self.db.execute("select state from items"))
+
+    def __len__(self):
+        return self.db.execute("select count(*) from items").fetchone()[0]
+
+    def item_at(self,path):
+        """The item at `path`, or None"""
+
+        r = self.db.execute("select i.state from paths p join items i on i.dev=p.dev and i.ino=p.ino where p.path=?",(path,)).fetchone()
+        return r and cas_from_json(r[0])
+
+    def items_in(self,d):
+        """Generates (name, item) for the entries of directory `d`"""
+
+        c = self.db.execute("select p.path,i.state from paths p join items i on i.dev=p.dev and i.ino=p.ino where p.dir=? order by p.path",(d,))
+        for (path,state) in c:
+            yield (os.path.basename(path),cas_from_json(state))
+
+    def items_with_id(self,cid):
+        """Generates the items with content id `cid`"""
+
+        return self._states(self.db.execute("select state from items where cid=?",(cid,)))
+
+    def write(self,header,items=(),gone=(),full=False):
+        """
+        Saves the state of the store (`header`), and of `items`, and
+        forgets the items with fileids `gone`, all in one transaction.
+        If `full` is set, anything else already saved is forgotten.
+        """
+
+        with self.db:
+            if full:
+                self.db.execute("delete from items")
+                self.db.execute("delete from paths")
+
+            for batch in _batches(gone):
+                self.db.executemany("delete from items where dev=? and ino=?",batch)
+                self.db.executemany("delete from paths where dev=? and ino=?",batch)
+
+            for batch in _batches(items):
+                fileids = [i.fileid for i in batch]
+                if not full:
+                    self.db.executemany("delete from paths where dev=? and ino=?",fileids)
+                self.db.executemany("insert or replace into items values (?,?,?,?)",
+                    ((i.fileid[0],i.fileid[1],i.cid,cas_to_json(i)) for i in batch))
+                self.db.executemany("insert or replace into paths values (?,?,?,?)",
+                    ((p,os.path.dirname(p),i.fileid[0],i.fileid[1]) for i in batch for p in i.paths))
+
+            self.db.execute("delete from store")
+            self.db.execute("insert into store values (?)",(cas_to_json(header),))
@@ -0,0 +1,163 @@
+#
+# stable identities for filesystems
+#
+
+"""
+
+Volume identity
+---------------
+
+Items are found again by device and inode number, but the device number
+of a filesystem is only an accident of the order in which things were
+mounted: it can change on a reboot, a remount, or when a USB disk or
+LVM volume comes back, and then every inode looks new.
+
+:func:`volume_id` names a filesystem in a way that survives that: by the
+UUID of the block device it is on, if there is one, and otherwise by
+its remote source or its ``statfs`` filesystem id.   A store records the
+volume id of each device it has seen, and when a device number turns
+out to belong to a volume it used to know by another number, it just
+renumbers its items (see :meth:`CasFileTreeStore.refresh`).
+
+.. autofunction:: volume_id
+
+"""
+
+import os
+import re
+import ctypes
+import ctypes.util
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+MOUNTINFO='/proc/self/mountinfo'
+UUID_DIR='/dev/disk/by-uuid'
+
+def _unescape(s):
+    """Undoes the octal escapes in a field of :data:`MOUNTINFO`"""
+
+    return re.sub(r'\\([0-7]{3})',lambda m: chr(int(m.group(1),8)),s)
+
+def mounts(path=MOUNTINFO):
+    """Generates (device number, root, mount point, fstype, source)
+    for each line of `path`"""
+
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return
+
+    for line in lines:
+        fields = line.split(' ')
+        try:
+            sep = fields.index('-',6)
+            (major,minor) = fields[2].split(':')
+            yield (os.makedev(int(major),int(minor)),_unescape(fields[3]),_unescape(fields[4]),
+                fields[sep+1],_unescape(fields[sep+2]))
+        except (ValueError,IndexError):
+            continue
+
+def _uuid(source):
+    """Returns the UUID of the block device `source`, or None"""
+
+    if not source.startswith('/dev/'):
+        return None
+
+    try:
+        names = os.listdir(UUID_DIR)
+    except OSError:
+        return None
+
+    dev = os.path.realpath(source)
+    for name in names:
+        if os.path.realpath(os.path.join(UUID_DIR,name)) == dev:
+            return name
+    return None
+
+def _is_remote(source):
+    return ':' in source or source.startswith('//')
+
+class _Statfs(ctypes.Structure):
+    """``struct statfs`` as Linux has it"""
+
+    _fields_ = [
+        ('f_type',ctypes.c_long),
+        ('f_bsize',ctypes.c_long),
+        ('f_blocks',ctypes.c_ulong),
+        ('f_bfree',ctypes.c_ulong),
+        ('f_bavail',ctypes.c_ulong),
+        ('f_files',ctypes.c_ulong),
+        ('f_ffree',ctypes.c_ulong),
+        ('f_fsid',ctypes.c_int*2),
+        ('f_namelen',ctypes.c_long),
+        ('f_frsize',ctypes.c_long),
+        ('f_flags',ctypes.c_long),
+        ('f_spare',ctypes.c_long*4),
+    ]
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        libc.statfs
+    except Exception:
+        return None
+
+    libc.statfs.argtypes = (ctypes.c_char_p,ctypes.POINTER(_Statfs))
+    libc.statfs.restype = ctypes.c_int
+    libc.fstatfs.argtypes = (ctypes.c_int,ctypes.POINTER(_Statfs))
+    libc.fstatfs.restype = ctypes.c_int
+    return libc
+
+_statfs = _libc()
+
+def fsid(path):
+    """Returns the ``statfs`` filesystem id of the filesystem holding
+    `path` (or open file descriptor) as a string, or None if it isn't known"""
+
+    if _statfs is None:
+        return None
+
+    buf = _Statfs()
+    if isinstance(path,(int,long)):
+        r = _statfs.fstatfs(path,ctypes.byref(buf))
+    else:
+        if isinstance(path,unicode):
+            path = path.encode('utf-8')
+        r = _statfs.statfs(path,ctypes.byref(buf))
+    if r != 0:
+        return None
+
+    (a,b) = buf.f_fsid
+    if not a and not b:
+        return None
+    return "%x:%08x%08x" % (buf.f_type & 0xffffffff,a & 0xffffffff,b & 0xffffffff)
+
+def volume_id(path,dev):
+    """
+    Returns a name for the filesystem holding `path` (or open file
+    descriptor), whose device number is `dev`, that stays the same
+    when it is remounted, or None if there's nothing better than the
+    device number.
+    """
+
+    found = sorted((len(root),root,fstype,source) for (d,root,_,fstype,source) in mounts() if d == dev)
+    if found:
+        (_,root,fstype,source) = found[0]
+        uuid = _uuid(source)
+        if uuid is not None:
+            return "uuid:%s:%s" % (uuid,root)
+        if _is_remote(source):
+            return "%s:%s:%s" % (fstype,source,root)
+
+    # Many filesystems make their fsid from their UUID; for the
+    # others it will change along with the device number, which is
+    # no worse than using that.
+
+    fs = fsid(path)
+    if fs is not None:
+        return "fsid:%s" % (fs)
+
+    return None
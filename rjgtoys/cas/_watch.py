@@ -0,0 +1,408 @@
+#
+# keeping a store fresh with inotify
+#
+
+"""
+
+Watching a store
+----------------
+
+A full :meth:`CasFileTreeStore.refresh` has to look at everything in the
+tree, however little has changed.   A :class:`CasWatcher` asks Linux to
+report changes as they happen, using inotify, and brings just the items
+that changed up to date.
+
+inotify is not recursive, so every directory in the tree is watched
+separately; big trees may need a larger
+``/proc/sys/fs/inotify/max_user_watches``.
+
+A file that is being written produces a stream of events; nothing is
+done about a path until it has been quiet for `settle` seconds (or the
+file has been closed).   The metadata is saved every `interval` seconds
+if anything has changed.
+
+A watcher can be limited to some parts of the tree (`paths`); only the
+directories at and below those are watched.
+
+If the kernel's event queue overflows, some changes have been lost and
+there is no way to tell which, so everything being watched is refreshed;
+that only rehashes what actually changed, but it does stat everything.
+Directories that arrived or went while events were being lost are then
+watched, or not, as they should be.
+
+.. autoclass:: CasWatcher
+.. autoclass:: Inotify
+.. autoexception:: InotifyError
+
+"""
+
+import os
+import stat
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from _xc import CasErrorXC
+from _files import statdir, subtrees, parentpath, RefreshProgress
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+# From <sys/inotify.h>
+
+IN_ACCESS=0x00000001
+IN_MODIFY=0x00000002
+IN_ATTRIB=0x00000004
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_FROM=0x00000040
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_DELETE=0x00000200
+IN_DELETE_SELF=0x00000400
+IN_MOVE_SELF=0x00000800
+IN_Q_OVERFLOW=0x00004000
+IN_IGNORED=0x00008000
+IN_ONLYDIR=0x01000000
+IN_DONT_FOLLOW=0x02000000
+IN_EXCL_UNLINK=0x04000000
+IN_ISDIR=0x40000000
+
+IN_NONBLOCK=0o4000
+IN_CLOEXEC=0o2000000
+
+# What a watcher needs to know about
+
+WATCH_MASK=(IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|
+    IN_CREATE|IN_DELETE|IN_DELETE_SELF|IN_MOVE_SELF|
+    IN_ONLYDIR|IN_DONT_FOLLOW|IN_EXCL_UNLINK)
+
+# Events that mean a whole subtree may have appeared
+
+IN_ARRIVED=IN_CREATE|IN_MOVED_TO
+
+EVENT_HEADER=struct.Struct('iIII')
+
+# Defaults
+
+WATCH_SETTLE=2          # Seconds a path must be quiet before it is looked at
+WATCH_INTERVAL=300      # Seconds between saves
+
+class InotifyError(CasErrorXC):
+    """Raised when inotify can't be used"""
+
+    params=('op','error')
+    oneline = "inotify {op} failed: {error}"
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        libc.inotify_init1
+    except Exception:
+        return None
+
+    libc.inotify_init1.argtypes = (ctypes.c_int,)
+    libc.inotify_init1.restype = ctypes.c_int
+    libc.inotify_add_watch.argtypes = (ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32)
+    libc.inotify_add_watch.restype = ctypes.c_int
+    libc.inotify_rm_watch.argtypes = (ctypes.c_int,ctypes.c_int)
+    libc.inotify_rm_watch.restype = ctypes.c_int
+    return libc
+
+_inotify = _libc()
+
+def _fsencode(p):
+    if isinstance(p,unicode):
+        return p.encode('utf-8')
+    return p
+
+class Inotify(object):
+    """
+    A minimal interface to Linux inotify, through :mod:`ctypes`.
+
+    .. automethod:: add_watch
+    .. automethod:: rm_watch
+    .. automethod:: read
+    .. automethod:: close
+    """
+
+    def __init__(self):
+        if _inotify is None:
+            raise InotifyError(op='init',error='not available on this system')
+
+        self.fd = _inotify.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyError(op='init',error=os.strerror(ctypes.get_errno()))
+
+    def add_watch(self,path,mask=WATCH_MASK):
+        """Starts watching `path`; returns the watch descriptor, which is
+        the same for every path to the same directory."""
+
+        wd = _inotify.inotify_add_watch(self.fd,_fsencode(path),mask)
+        if wd < 0:
+            raise InotifyError(op='watch %s' % (path),error=os.strerror(ctypes.get_errno()))
+        return wd
+
+    def rm_watch(self,wd):
+        """Stops a watch; it doesn't matter if it has already gone"""
+
+        _inotify.inotify_rm_watch(self.fd,wd)
+
+    def read(self,timeout=None):
+        """Returns a list of (wd, mask, cookie, name) tuples, waiting up to
+        `timeout` seconds (forever if None) for there to be any."""
+
+        (r,_,_) = select.select([self.fd],[],[],timeout)
+        if not r:
+            return []
+
+        try:
+            data = os.read(self.fd,64*1024)
+        except OSError,e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            (wd,mask,cookie,n) = EVENT_HEADER.unpack_from(data,pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos+n].rstrip('\0')
+            pos += n
+            events.append((wd,mask,cookie,unicode(name,'utf-8','replace')))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class CasWatcher(object):
+    """
+    Keeps `store` (a :class:`CasFileTreeStore`) up to date by watching
+    its content for changes; or only the parts of it at or below `paths`,
+    if given.
+
+    Call :meth:`start` once, and then :meth:`step` over and over again, or
+    just call :meth:`run`.
+
+    .. automethod:: start
+    .. automethod:: step
+    .. automethod:: run
+    .. automethod:: stop
+    """
+
+    def __init__(self,store,settle=WATCH_SETTLE,interval=WATCH_INTERVAL,paths=None):
+        self.store = store
+        self.settle = settle
+        self.interval = interval
+        self.paths = subtrees(store.content,paths) if paths else None
+
+        self.inotify = None
+        self.bywd = {}          # Relative path of each watched directory
+        self.pending = {}       # Paths to look at, and when they're due
+        self.arrived = set()    # ... those that may be whole new subtrees
+        self.changed = False    # Anything to save?
+        self.saved = time.time()
+
+    def start(self):
+        """Starts watching, and then brings the store up to date; any
+        changes that happen during the refresh will be seen afterwards."""
+
+        self.inotify = Inotify()
+        self.store.load_ignore()
+        self._rewatch()
+
+        log.verbose("Watching %d directories" % (len(self.bywd)))
+
+        self.store.refresh(paths=self.paths)
+        self.changed = True
+
+    def stop(self):
+        """Stops watching, saving any changes"""
+
+        self.save()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.bywd = {}
+
+    def save(self):
+        if self.changed and self.store.save():
+            self.changed = False
+        self.saved = time.time()
+
+    def run(self):
+        """Watches until interrupted"""
+
+        self.start()
+        try:
+            while True:
+                self.step()
+        except KeyboardInterrupt:
+            log.info("Interrupted")
+        finally:
+            self.stop()
+
+    def step(self,timeout=None):
+        """
+        Waits for events (for up to `timeout` seconds, or until
+        something is due) and deals with everything that is due.
+        """
+
+        if timeout is None:
+            timeout = self._due_in()
+
+        for (wd,mask,cookie,name) in self.inotify.read(timeout):
+            self._event(wd,mask,name)
+
+        now = time.time()
+        due = [p for (p,t) in self.pending.iteritems() if t <= now]
+        if due:
+            self._update(due)
+
+        if (now-self.saved) > self.interval:
+            self.save()
+
+    def _due_in(self):
+        """Seconds until something needs doing"""
+
+        due = self.saved+self.interval
+        if self.pending:
+            due = min(due,min(self.pending.itervalues()))
+        return max(due-time.time(),0)
+
+    def _rewatch(self):
+        """Watches every directory that is to be watched and isn't yet,
+        and stops watching any that have gone"""
+
+        content = self.store.content
+        dirs = set()
+        for root in self.paths or [u'']:
+            if not os.path.isdir(os.path.join(content,root)):
+                continue
+            dirs.add(root)
+            for (p,s) in statdir(os.path.join(content,root),ignore=self.store.ignore,base=root):
+                if stat.S_ISDIR(s.st_mode):
+                    dirs.add(os.path.join(root,p))
+
+        for (wd,p) in self.bywd.items():
+            if p not in dirs:
+                self.inotify.rm_watch(wd)
+                del self.bywd[wd]
+
+        watched = set(self.bywd.itervalues())
+        for p in sorted(dirs-watched):
+            self._watch(p)
+
+    def _watch(self,p):
+        try:
+            wd = self.inotify.add_watch(os.path.join(self.store.content,p))
+        except InotifyError,e:
+            log.error("%s" % (e))
+            return
+        self.bywd[wd] = p
+
+    def _ignored(self,p,isdir):
+        """Returns True for paths the store excludes, including its
+        own metadata files"""
+
+        return self.store.ignore.excludes_path(p,isdir)
+
+    def _event(self,wd,mask,name):
+
+        if mask & IN_Q_OVERFLOW:
+            log.warning("Lost track of changes - refreshing everything watched")
+            self.pending = {}
+            self.arrived = set()
+            self.store.refresh(paths=self.paths)
+            self._rewatch()
+            self.changed = True
+            return
+
+        d = self.bywd.get(wd,None)
+        if d is None:
+            return
+
+        if mask & IN_IGNORED:
+            del self.bywd[wd]
+            return
+
+        if mask & (IN_DELETE_SELF|IN_MOVE_SELF):
+            # Dealt with as an entry of its parent
+            return
+
+        p = os.path.join(d,name) if name else d
+        if self._ignored(p,bool(mask & IN_ISDIR)):
+            return
+
+        if mask & IN_CLOSE_WRITE:
+            due = 0             # Finished with, so no need to wait
+        else:
+            due = time.time()+self.settle
+
+        self.pending[p] = due
+        if mask & IN_ARRIVED:
+            self.arrived.add(p)
+
+    def _update(self,paths):
+        """Brings the items at `paths` up to date"""
+
+        store = self.store
+        content = store.content
+        find_time = time.time()
+        progress = RefreshProgress()
+        stale = []
+
+        # Deal with the paths that exist first, so that anything that
+        # has been moved is found before its old path is forgotten
+
+        for p in paths:
+            del self.pending[p]
+
+        # The directories containing the paths have changed too
+
+        paths = set(paths)
+        paths.update(parentpath(p) for p in list(paths))
+        paths.discard('')
+
+        found = []
+        gone = []
+        for p in sorted(paths):
+            try:
+                s = os.lstat(os.path.join(content,p))
+            except OSError:
+                gone.append(p)
+                continue
+            found.append((p,s))
+
+        for (p,s) in found:
+            stale.append(store._scan_one(p,s,False,find_time,progress))
+
+            if stat.S_ISDIR(s.st_mode) and p in self.arrived:
+                self._watch(p)
+                for (q,qs) in statdir(os.path.join(content,p),ignore=store.ignore,base=p):
+                    q = os.path.join(p,q)
+                    stale.append(store._scan_one(q,qs,False,find_time,progress))
+                    if stat.S_ISDIR(qs.st_mode):
+                        self._watch(q)
+            self.arrived.discard(p)
+
+        for p in gone:
+            self.arrived.discard(p)
+        store._forget_vanished(find_time,progress,gone)
+
+        for item in stale:
+            if item.stale:
+                store.refresh_item(item,progress)
+
+        store.update_dirids()
+
+        log.verbose("Updated %d paths: %d new %d changed %d deleted" % (
+            len(paths),progress.newentries,progress.origentries,progress.lostentries))
+
+        self.changed = True
@@ -0,0 +1,83 @@
+#
+# worker pools for cas
+#
+
+"""
+
+Worker pools
+------------
+
+Computing content ids is by far the most expensive thing a store does,
+and it is easy to spread across several cores: :mod:`hashlib` releases
+the GIL while it digests large buffers, so threads are usually enough.
+A process pool is available for the cases where they are not.
+
+All the results of a pool are consumed by a single coordinator (the thread
+that created it), so nothing other than the coordinator needs to know
+about locking.
+
+.. autofunction:: worker_pool
+.. autoclass:: Throttle
+
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool, Pool
+
+# Pool backends
+
+POOL_THREADS='threads'
+POOL_PROCESSES='processes'
+
+def worker_pool(jobs,backend=POOL_THREADS):
+    """Returns a pool of `jobs` workers, either threads (the default)
+    or processes.
+    """
+
+    if backend == POOL_PROCESSES:
+        return Pool(jobs)
+    if backend == POOL_THREADS:
+        return ThreadPool(jobs)
+
+    raise ValueError("Unknown worker pool backend '%s'" % (backend))
+
+class Throttle(object):
+    """
+    Limits the number of jobs a pool has been given but whose results have
+    not yet been collected.
+
+    A pool will happily read its whole input before doing any work, which
+    for a big store means a copy of every item in memory at once.   Pass the
+    input through :meth:`feed` and call :meth:`release` once for each result
+    collected to keep no more than `limit` jobs in flight.
+
+    .. automethod:: feed
+    .. automethod:: release
+    .. automethod:: close
+    """
+
+    def __init__(self,limit):
+        self._sem = threading.Semaphore(limit)
+        self._closed = False
+
+    def feed(self,seq):
+        """Generates the items of `seq`, waiting for a slot before each"""
+
+        for x in seq:
+            self._sem.acquire()
+            if self._closed:
+                return
+            yield x
+
+    def release(self):
+        """Releases the slot held by one job"""
+
+        self._sem.release()
+
+    def close(self):
+        """Stops :meth:`feed`; needed before a pool can be terminated early
+        because the pool's feeder thread may be waiting for a slot.
+        """
+
+        self._closed = True
+        self._sem.release()
@@ -0,0 +1,127 @@
+#
+# content ids kept with the files themselves
+#
+
+"""
+
+Content ids in extended attributes
+----------------------------------
+
+Content ids are normally only kept in the metadata of a store, so a
+second store that covers the same files, or one made again after its
+metadata has been lost, has to hash everything again.   A store can
+also write the id of each file it hashes into an extended attribute of
+the file (see :func:`xattr_name`), along with the size, mtime and ctime
+that it was computed for, and trust the id it finds there as long as
+the file still matches.
+
+Writing the attribute changes the ctime of the file, so the ctime that
+is saved is the one from before, and the attribute is only trusted if
+the ctime is no later than when it was written.   Anything that
+changes the file's metadata afterwards (even renaming it, on some
+filesystems) means it is hashed again.
+
+Files that can't be written, and filesystems that don't support
+``user.`` attributes, are just hashed as usual.
+
+.. autofunction:: xattr_name
+.. autofunction:: read_cid
+.. autofunction:: write_cid
+
+"""
+
+import os
+import time
+import json
+import errno
+import ctypes
+import ctypes.util
+
+from rjgtoys import logs
+
+log = logs.getLogger(__name__)
+
+XATTR_PREFIX='user.cas.'
+XATTR_SIZE=1024         # Largest value that is ever read
+XATTR_SLACK=1.0         # Seconds between writing the attribute and the ctime it leaves
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        libc.lgetxattr
+    except Exception:
+        return None
+
+    libc.lgetxattr.argtypes = (ctypes.c_char_p,ctypes.c_char_p,ctypes.c_void_p,ctypes.c_size_t)
+    libc.lgetxattr.restype = ctypes.c_ssize_t
+    libc.lsetxattr.argtypes = (ctypes.c_char_p,ctypes.c_char_p,ctypes.c_char_p,ctypes.c_size_t,ctypes.c_int)
+    libc.lsetxattr.restype = ctypes.c_int
+    return libc
+
+_xattr = _libc()
+
+def _fsencode(p):
+    if isinstance(p,unicode):
+        return p.encode('utf-8')
+    return p
+
+def getxattr(path,name):
+    """Returns the value of attribute `name` of `path` (not following
+    symbolic links), or None if it can't be read"""
+
+    if _xattr is None:
+        return None
+
+    buf = ctypes.create_string_buffer(XATTR_SIZE)
+    n = _xattr.lgetxattr(_fsencode(path),name,buf,XATTR_SIZE)
+    if n < 0:
+        return None
+    return buf.raw[:n]
+
+def setxattr(path,name,value):
+    """Sets attribute `name` of `path` to `value`; returns False if
+    that can't be done"""
+
+    if _xattr is None:
+        return False
+
+    if _xattr.lsetxattr(_fsencode(path),name,value,len(value),0) != 0:
+        e = ctypes.get_errno()
+        if e not in (errno.ENOTSUP,errno.EPERM,errno.EACCES,errno.EROFS):
+            log.debug("Can't set %s on %s: %s" % (name,path,os.strerror(e)))
+        return False
+    return True
+
+def xattr_name(algorithm,tree=False):
+    """The name of the attribute that holds a content id made with
+    `algorithm`, or a tree hash id if `tree` is set"""
+
+    return XATTR_PREFIX+algorithm+('.tree' if tree else '')
+
+def read_cid(path,name,size,mtime,ctime):
+    """Returns the content id kept in attribute `name` of `path`, if it
+    was computed for a file of the same `size` and `mtime`, and `ctime`
+    shows nothing has changed since, or None"""
+
+    value = getxattr(path,name)
+    if value is None:
+        return None
+
+    try:
+        v = json.loads(value)
+        if v['size'] != size or v['mtime'] != mtime:
+            return None
+        if not (v['ctime'] <= ctime <= v['set']+XATTR_SLACK):
+            return None
+        return v['cid']
+    except Exception:
+        log.debug("Ignoring bad %s on %s" % (name,path))
+        return None
+
+def write_cid(path,name,cid,size,mtime,ctime):
+    """Keeps content id `cid` in attribute `name` of `path`, which it was
+    computed for when `path` had that `size`, `mtime` and `ctime`.
+    Returns False if that couldn't be done."""
+
+    value = json.dumps(dict(cid=cid,size=size,mtime=mtime,ctime=ctime,set=time.time()))
+    return setxattr(path,name,value)
@@ -19,6 +19,10 @@ setup(
         "Development Status :: 2 - Pre-Alpha",
         "License :: OSI Approved :: GNU General Public License v2 or later (GPLv2+)"
         ],
+    extras_require={
+        'chunking': ['numpy'],      # Much faster chunk boundary search
+        'scandir': ['scandir'],     # Faster directory scans before Python 3.5
+        },
     tests_require=['pytest'],
     # The following configures testing the way I like it
     cmdclass = {'test':PyTest},
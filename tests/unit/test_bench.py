@@ -0,0 +1,68 @@
+#
+# Tests for the hashing benchmarks
+#
+
+import os
+import json
+import shutil
+
+from rjgtoys.cas._cmdbench import BenchCommand, parse_size, CACHE_COLD, CACHE_WARM
+from rjgtoys.cas._base import READ_MMAP, READ_STREAM
+
+def test_parse_size():
+    assert parse_size('100') == 100
+    assert parse_size('64K') == 64*1024
+    assert parse_size('1m') == 1024*1024
+    assert parse_size('1.5G') == 3*512*1024*1024
+    assert parse_size('2MB') == 2*1024*1024
+
+def test_bench():
+    out = os.tmpnam()
+    try:
+        c = BenchCommand()
+        opts = c.parse_args(['-o',out,'--methods','mmap,read','--blocksizes','4K,64K',
+            '--algorithms','sha256','--sizes','10,100K','--threads','1,2','--repeat','1'])
+        c.run(opts)
+
+        with open(out) as f:
+            results = [json.loads(l) for l in f]
+    finally:
+        os.unlink(out)
+
+    # 2 sizes x 2 thread counts x (1 mmap + 2 read) x 2 caches
+    assert len(results) == 24
+
+    for r in results:
+        assert r['algorithm'] == 'sha256'
+        assert r['cache'] in (CACHE_COLD,CACHE_WARM)
+        assert r['bytes'] == r['size']*r['threads']
+        assert r['seconds'] >= 0
+        assert 'host' in r
+
+    assert set(r['blocksize'] for r in results if r['method'] == READ_STREAM) == set((4096,65536))
+    assert set(r['size'] for r in results) == set((10,100*1024))
+
+from rjgtoys.cas._files import HASH_ORDERS
+
+def test_bench_refresh():
+    out = os.tmpnam()
+    d = os.tmpnam()
+    os.makedirs(os.path.join(d,'sub'))
+    try:
+        for n in range(0,10):
+            with open(os.path.join(d,'sub' if n % 2 else '','f%d' % (n)),'w') as f:
+                f.write('file %d ' % (n) * 1000)
+
+        c = BenchCommand()
+        c.run(c.parse_args(['-o',out,'--refresh',d,'--repeat','1','--threads','1,2']))
+
+        with open(out) as f:
+            results = [json.loads(l) for l in f]
+    finally:
+        os.unlink(out)
+        shutil.rmtree(d)
+
+    assert len(results) == 2*len(HASH_ORDERS)*2
+    assert set(r['order'] for r in results) == set(HASH_ORDERS)
+    assert set(r['bytes'] for r in results) == set([sum(len('file %d ' % (n))*1000 for n in range(0,10))])
+    assert not os.path.exists(os.path.join(d,'.casbench'))
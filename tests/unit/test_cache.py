@@ -0,0 +1,97 @@
+#
+# Tests for the shared hash cache
+#
+
+import os
+import sqlite3
+
+from rjgtoys.cas._base import CasFileHasher, cas_file_to_id, cas_string_to_id
+from rjgtoys.cas._cache import CasHashCache
+from rjgtoys.cas._files import CasFileTreeStore, OTYPE_FILE
+from rjgtoys.cas._workers import POOL_PROCESSES
+
+from test_cas_filetree import tempdir, create_file, tree_ids, parallel_tree
+
+def cached(cache):
+    return sqlite3.connect(cache.path).execute("select count(*) from hashes").fetchone()[0]
+
+def test_cache():
+    with tempdir() as d:
+        data = 'some content that is worth caching '*10
+        create_file(d,'a',data)
+        p = os.path.join(d,'a')
+
+        cache = CasHashCache(os.path.join(d,'cache','hashes'))
+        hasher = CasFileHasher(cache=cache)
+        assert cas_file_to_id(p,hasher=hasher) == cas_string_to_id(data)
+        assert cached(cache) == 1
+
+        # Show that the cached id is used
+
+        db = sqlite3.connect(cache.path)
+        with db:
+            db.execute("update hashes set cid='I-cached'")
+        assert cas_file_to_id(p,hasher=hasher) == 'I-cached'
+        assert cas_file_to_id(p,hasher=hasher,tree=True) != 'I-cached'
+        assert cas_file_to_id(p,hasher=hasher,algorithm='sha256') != 'I-cached'
+
+        # ... unless the file has changed
+
+        create_file(d,'a',data+'more')
+        assert cas_file_to_id(p,hasher=hasher) == cas_string_to_id(data+'more')
+
+def test_cache_evict():
+    with tempdir() as d:
+        cache = CasHashCache(os.path.join(d,'hashes'),limit=3)
+        hasher = CasFileHasher(cache=cache)
+        for n in range(0,5):
+            create_file(d,str(n),'content for file %d ' % (n) * 10)
+            cas_file_to_id(os.path.join(d,str(n)),hasher=hasher)
+        assert cached(cache) == 5
+        cache.evict()
+        assert cached(cache) == 3
+
+def test_cache_used():
+    """Lookups note uses, and write them a batch at a time"""
+
+    with tempdir() as d:
+        cache = CasHashCache(os.path.join(d,'hashes'),limit=3)
+        hasher = CasFileHasher(cache=cache)
+        for n in range(0,5):
+            create_file(d,str(n),'content for file %d ' % (n) * 10)
+            cas_file_to_id(os.path.join(d,str(n)),hasher=hasher)
+
+        db = sqlite3.connect(cache.path)
+        with db:
+            db.execute("update hashes set used=ino")
+
+        # The oldest, once used again, survives eviction
+
+        oldest = min(range(0,5),key=lambda n: os.lstat(os.path.join(d,str(n))).st_ino)
+        cas_file_to_id(os.path.join(d,str(oldest)),hasher=hasher)
+        assert db.execute("select count(*) from hashes where used > ino").fetchone()[0] == 0
+
+        cache.evict()
+        assert cached(cache) == 3
+        ino = os.lstat(os.path.join(d,str(oldest))).st_ino
+        assert db.execute("select count(*) from hashes where ino=?",(ino,)).fetchone()[0] == 1
+
+def test_cache_stores():
+    with tempdir() as d:
+        parallel_tree(d)
+        cache = os.path.join(d,'hashes')
+        s = CasFileTreeStore(content=d,refresh=True,hasher=CasFileHasher(cache=CasHashCache(cache)),exclude=['/hashes*'])
+        n = cached(s.hasher.cache)
+        assert n > 0
+
+        # Another store, with workers in other processes, uses them all
+
+        db = sqlite3.connect(cache)
+        with db:
+            db.execute("update hashes set cid='X'||cid")
+
+        t = CasFileTreeStore(content=d,refresh=False,hasher=CasFileHasher(cache=CasHashCache(cache)),exclude=['/hashes*'])
+        t.refresh(jobs=2,backend=POOL_PROCESSES)
+        ids = [i.cid for i in t if i.otype == OTYPE_FILE and i.size]
+        assert len(ids) == n
+        assert all(cid.startswith('X') for cid in ids)
@@ -4,11 +4,14 @@
 
 
 import os
+import json
 import subprocess
+import pytest
 from contextlib import contextmanager
+from gzip import GzipFile
 
 from rjgtoys.cas._base import cas_to_json
-from rjgtoys.cas._files import CasFileTreeStore, OTYPE_FILE, OTYPE_LINK, OTYPE_DIR, DEFAULT_METADATA, gzipread, gzipwrite
+from rjgtoys.cas._files import CasFileTreeStore, OTYPE_FILE, OTYPE_LINK, OTYPE_DIR, DEFAULT_METADATA, gzipread, gzipwrite, gzipdump, gzipload, SAVE_BATCH
 
 import rjgtoys.cas
 
@@ -47,7 +50,7 @@ def create_link(d,p,s):
 
 def item_by_path(s,p):
     for i in s:
-        if i.path == p:
+        if p in i.paths:
             return i
     return None
     
@@ -136,5 +139,615 @@ def test_gzipio():
     os.unlink(path)         # must exist by now
     
     assert not os.path.exists(path+'.tmp')
+
+def test_gzipdump():
+    with tempdir() as d:
+        path = os.path.join(d,'state')
+        header = dict(version='1',rootid=None,exclude=['x, '])
+
+        for n in (0,1,SAVE_BATCH,2*SAVE_BATCH+1):
+            items = [dict(fileid=[1,k],path=u'file %d\n' % (k)) for k in range(n)]
+            gzipdump(path,header,iter(items))
+
+            # Still just JSON...
+
+            assert json.loads(gzipread(path)) == dict(header,item=items)
+
+            # ... read an item at a time
+
+            state = gzipload(path)
+            assert not isinstance(state.item,list)
+            assert list(state.item) == items
+            del state['item']
+            assert state == header
+
+        # Whole-file saves can still be read
+
+        gzipwrite(path,json.dumps(dict(header,item=items)))
+        assert gzipload(path) == dict(header,item=items)
+
+        # A save that was cut short is noticed
+
+        with GzipFile(path,'wb') as f:
+            f.write(''.join(list(gzipread(path+'.bak').splitlines(True))[:3]))
+        with pytest.raises(ValueError):
+            list(gzipload(path).item)
     
     
+#
+# Parallel refresh should produce exactly what a serial one does
+#
+
+from rjgtoys.cas._workers import POOL_THREADS, POOL_PROCESSES
+
+def parallel_tree(d):
+    for n in range(0,20):
+        create_file(d,'file%d' % (n),'content for file %d ' % (n) * (n+1))
+    ds = os.path.join(d,'sub')
+    os.makedirs(ds)
+    create_file(ds,'empty','')
+    create_link(ds,'link','destination')
+
+def tree_ids(s):
+    return dict((i.path,i.cid) for i in s)
+
+def test_refresh_parallel():
+    with tempdir() as d:
+        parallel_tree(d)
+
+        serial = CasFileTreeStore(content=d)
+
+        for backend in (POOL_THREADS,POOL_PROCESSES):
+            s = CasFileTreeStore(content=d,refresh=False)
+            s.refresh(jobs=4,backend=backend)
+
+            assert tree_ids(s) == tree_ids(serial)
+            assert set(s.byid.keys()) == set(serial.byid.keys())
+            assert not [i for i in s if i.stale]
+
+def test_refresh_vanished():
+    """Files that go between being found and being hashed don't stop
+    a refresh"""
+
+    with tempdir() as d:
+        parallel_tree(d)
+
+        for jobs in (1,4):
+            name = 'file%d' % (jobs)
+            s = CasFileTreeStore(content=d,refresh=False)
+            scan_one = s._scan_one
+            def vanish(p,st,*args):
+                item = scan_one(p,st,*args)
+                if p == name:
+                    remove_file(d,name)
+                return item
+            s._scan_one = vanish
+            s.refresh(jobs=jobs)
+
+            assert name not in s.bypath
+            assert not [i for i in s if i.stale]
+            assert tree_ids(s) == tree_ids(CasFileTreeStore(content=d))
+            assert s.rootid == CasFileTreeStore(content=d).rootid
+
+def test_refresh_replaced():
+    """A file that is replaced between being found and being hashed
+    is known by its new fileid"""
+
+    for jobs in (1,4):
+        with tempdir() as d:
+            parallel_tree(d)
+
+            name = 'file%d' % (jobs)
+            s = CasFileTreeStore(content=d,refresh=False)
+            scan_one = s._scan_one
+            def replace(p,st,*args):
+                item = scan_one(p,st,*args)
+                if p == name:
+                    create_file(d,'new','replaced')
+                    os.rename(os.path.join(d,'new'),os.path.join(d,name))
+                return item
+            s._scan_one = replace
+            s.refresh(jobs=jobs)
+
+            item = s.bypath[name]
+            st = os.lstat(os.path.join(d,name))
+            assert item.fileid == (st.st_dev,st.st_ino)
+            assert s.byfileid[item.fileid] is item
+            assert len(s.byfileid) == len(s.bypath)
+            assert tree_ids(s) == tree_ids(CasFileTreeStore(content=d))
+            assert s.save()
+            assert tree_ids(CasFileTreeStore(content=d)) == tree_ids(s)
+
+            remove_file(d,name)
+            s._scan_one = scan_one
+            s.refresh()
+            assert name not in s.bypath
+
+def test_refresh_item_vanished():
+    """An item that goes before it can be hashed is forgotten"""
+
+    with tempdir() as d:
+        parallel_tree(d)
+        s = CasFileTreeStore(content=d,refresh=True)
+
+        create_file(d,'new','new')
+        s.refresh(rehash=False)
+        item = s.bypath['new']
+        assert item.stale
+        remove_file(d,'new')
+        s.refresh_item(item)
+
+        assert 'new' not in s.bypath
+        assert item.fileid not in s.byfileid
+        assert s.save()
+        assert tree_ids(CasFileTreeStore(content=d)) == tree_ids(s)
+
+#
+# The quick duplicate finder should only hash what it has to
+#
+
+from rjgtoys.cas._cmddups import DupsCommand
+
+def test_dups_quick():
+    with tempdir() as d:
+        create_file(d,'a','same content '*1000)
+        create_file(d,'b','same content '*1000)
+        create_file(d,'c','SAME content '*1000)     # same size, different head
+        create_file(d,'d','a different size')
+
+        s = CasFileTreeStore(content=d,refresh=False)
+
+        found = DupsCommand().candidates(s)
+
+        assert set(i.path for i in found) == set(('a','b'))
+        assert item_by_path(s,'a').cid == item_by_path(s,'b').cid
+
+        c = item_by_path(s,'c')
+        assert c.stale and c.cid is None and c.pcid is not None
+
+        assert item_by_path(s,'d').pcid is None
+
+        # What's still to do, and the partial ids, survive a save
+
+        assert s.save()
+        t = CasFileTreeStore(content=d,refresh=False)
+        t.refresh(rehash=False)
+        c = item_by_path(t,'c')
+        assert c.stale and c.pcid is not None
+
+        t.refresh()
+        assert not [i for i in t if i.stale]
+        assert item_by_path(t,'c').cid is not None
+
+#
+# Changing a store's hash algorithm
+#
+
+def test_change_algorithm():
+    with tempdir() as d:
+        create_file(d,'long','long content '*100)
+        create_file(d,'short','short')
+
+        s = CasFileTreeStore(content=d)
+        assert s.algorithm == 'sha512'
+        assert item_by_path(s,'long').cid.startswith('I')
+        assert s.save()
+
+        # The algorithm sticks...
+
+        t = CasFileTreeStore(content=d,refresh=False)
+        assert t.algorithm == 'sha512'
+
+        # ... until changed, when ids are remade as needed
+
+        t = CasFileTreeStore(content=d,refresh=False,algorithm='sha256')
+        old = tree_ids(t)
+        t.refresh()
+        assert item_by_path(t,'long').cid.startswith('S')
+        assert item_by_path(t,'short').cid == old['short']
+        assert item_by_path(t,'long') is t.byid[item_by_path(t,'long').cid]
+        assert old['long'] not in t.byid
+        assert t.save()
+
+        u = CasFileTreeStore(content=d,refresh=False)
+        assert u.algorithm == 'sha256'
+        assert tree_ids(u) == tree_ids(t)
+
+def test_tree_store():
+    with tempdir() as d:
+        create_file(d,'big','x'*(3*1024*1024+5))
+        create_file(d,'short','short')
+
+        s = CasFileTreeStore(content=d,tree=True)
+        assert item_by_path(s,'big').cid.startswith('TI')
+        assert s.save()
+
+        t = CasFileTreeStore(content=d,refresh=False)
+        assert t.tree
+
+        t = CasFileTreeStore(content=d,refresh=False,tree=False)
+        t.refresh()
+        assert item_by_path(t,'big').cid.startswith('I')
+        assert item_by_path(t,'short').cid == item_by_path(s,'short').cid
+
+def test_dir_ids():
+    with tempdir() as d:
+        os.makedirs(os.path.join(d,'a','b'))
+        os.makedirs(os.path.join(d,'c'))
+        create_file(d,'a/b/x','x')
+        create_file(d,'c/y','y')
+
+        s = CasFileTreeStore(content=d)
+        ids = dict((i.path,i.cid) for i in s)
+        assert ids['a'].startswith('DI')
+        assert ids['a'] != ids['a/b']
+        assert s.rootid.startswith('DI')
+        assert s.save()
+
+        # Same content, same ids
+
+        with tempdir() as e:
+            subprocess.check_call(('/bin/cp','-a',d+'/.',e))
+            os.unlink(os.path.join(e,DEFAULT_METADATA))
+            t = CasFileTreeStore(content=e)
+            assert t.rootid == s.rootid
+            assert list(s.diff(t)) == []
+
+        create_file(d,'a/b/x','changed')
+        os.utime(os.path.join(d,'a/b/x'),(0,0))
+        t = CasFileTreeStore(content=d,refresh=True)
+        assert t.rootid != s.rootid
+
+        after = dict((i.path,i.cid) for i in t)
+        assert after['a/b'] != ids['a/b']
+        assert after['a'] != ids['a']
+        assert after['c'] == ids['c']
+
+        assert [p for (p,a,b) in t.diff(s)] == ['a','a/b','a/b/x']
+
+        # Ids survive a reload
+
+        assert t.save()
+        u = CasFileTreeStore(content=d,refresh=False)
+        assert u.rootid == t.rootid
+        assert item_by_path(u,'a').cid == after['a']
+
+def test_dir_ids_empty():
+    with tempdir() as d:
+        os.makedirs(os.path.join(d,'a'))
+        os.makedirs(os.path.join(d,'b'))
+        create_file(d,'b/x','')
+
+        s = CasFileTreeStore(content=d)
+        assert item_by_path(s,'a').cid != item_by_path(s,'b').cid
+
+        remove_file(d,'b/x')
+        os.utime(os.path.join(d,'b'),(0,0))
+        s.refresh()
+        assert item_by_path(s,'a').cid == item_by_path(s,'b').cid
+
+from rjgtoys.cas._files import statdir
+
+def test_statdir_parallel():
+    with tempdir() as d:
+        for i in range(0,5):
+            for j in range(0,4):
+                os.makedirs(os.path.join(d,'d%d' % i,'e%d' % j))
+                create_file(d,'d%d/e%d/f' % (i,j),'%d %d' % (i,j))
+            create_link(d,'d%d/link' % i,'e0')
+
+        expected = sorted(p for (p,s) in statdir(d))
+        assert len(expected) == 5*(1+4+4+1)
+
+        found = [p for (p,s) in statdir(d,4)]
+        assert sorted(found) == expected
+
+        ordered = [p for (p,s) in statdir(d,1,ordered=True)]
+        assert sorted(ordered) == expected
+        assert [p for (p,s) in statdir(d,4,ordered=True)] == ordered
+        assert ordered[:5] == ['d%d' % i for i in range(0,5)]
+
+        # Every entry comes after its directory
+
+        for r in (found, ordered):
+            seen = set([''])
+            for p in r:
+                assert os.path.dirname(p) in seen
+                seen.add(p)
+
+        s = CasFileTreeStore(content=d,refresh=False)
+        s.refresh(scanjobs=4)
+        assert tree_ids(s) == tree_ids(CasFileTreeStore(content=d,refresh=True))
+
+def test_refresh_pipeline():
+    with tempdir() as d:
+        parallel_tree(d)
+        s = CasFileTreeStore(content=d,refresh=False)
+        s.refresh(jobs=3,scanjobs=2)
+        assert not [i for i in s if i.stale]
+
+        remove_file(d,'file1')
+        create_file(d,'sub/new','new content '*100)
+        create_file(d,'file2','changed '*100)
+        os.utime(os.path.join(d,'file2'),(0,0))
+
+        s.refresh(jobs=3,scanjobs=2)
+        assert item_by_path(s,'file1') is None
+        assert tree_ids(s) == tree_ids(CasFileTreeStore(content=d,refresh=True))
+
+        # A scan without hashing leaves new items stale
+
+        create_file(d,'sub/newer','newer')
+        s.refresh(rehash=False)
+        assert item_by_path(s,'sub/newer').stale
+        s.refresh()
+        assert not item_by_path(s,'sub/newer').stale
+
+from rjgtoys.cas._files import subtrees
+
+def test_subtrees():
+    assert subtrees('/x',['a/b','a','c/','/x/d/e','.']) == ['']
+    assert subtrees('/x',['a/b','a','c/','/x/d/e']) == ['a','c','d/e']
+    assert subtrees('/x',['ab','a']) == ['a','ab']
+    for bad in ('..','../y','/y'):
+        with pytest.raises(ValueError):
+            subtrees('/x',[bad])
+
+def test_refresh_paths():
+    with tempdir() as d:
+        for sub in ('a','b'):
+            os.makedirs(os.path.join(d,sub,'deeper'))
+            create_file(d,sub+'/1','one '*100)
+            create_file(d,sub+'/deeper/2','two '*100)
+
+        s = CasFileTreeStore(content=d,refresh=True)
+        rootid = s.rootid
+
+        for sub in ('a','b'):
+            remove_file(d,sub+'/1')
+            create_file(d,sub+'/deeper/new','new')
+            create_file(d,sub+'/deeper/2','changed '*100)
+            os.utime(os.path.join(d,sub,'deeper/2'),(0,0))
+
+        s.refresh(paths=['a'])
+
+        assert item_by_path(s,'a/1') is None
+        assert item_by_path(s,'a/deeper/new') is not None
+        assert s.rootid != rootid
+
+        # b is untouched
+
+        assert item_by_path(s,'b/1') is not None
+        assert item_by_path(s,'b/deeper/new') is None
+
+        s.refresh(paths=[os.path.join(d,'b','deeper'),'b/1'])
+        assert item_by_path(s,'b/1') is None
+        assert item_by_path(s,'b/deeper/new') is not None
+
+        assert tree_ids(s) == tree_ids(CasFileTreeStore(content=d,refresh=True))
+
+from rjgtoys.cas._ignore import IGNORE_FILE
+
+def test_exclude():
+    with tempdir() as d:
+        for sub in ('src','build','src/build','.git'):
+            os.makedirs(os.path.join(d,sub))
+        create_file(d,'src/a.c','a')
+        create_file(d,'src/a.o','a object')
+        create_file(d,'build/out','out')
+        create_file(d,'src/build/out','out')
+        create_file(d,'.git/HEAD','head')
+        create_file(d,IGNORE_FILE,'# things not worth keeping\n*.o\nbuild/\n')
+
+        s = CasFileTreeStore(content=d,refresh=True,exclude=['/.git'])
+        assert s.save()
+        s.refresh()
+
+        paths = set(i.path for i in s)
+        assert paths == set(('src','src/a.c',IGNORE_FILE))
+
+        # Exclude patterns are remembered, but can be changed
+
+        t = CasFileTreeStore(content=d,refresh=True)
+        assert set(i.path for i in t) == paths
+
+        t = CasFileTreeStore(content=d,refresh=True,exclude=[])
+        assert item_by_path(t,'.git/HEAD') is not None
+        assert item_by_path(t,'build') is None
+
+        # Targeted refreshes obey the rules too
+
+        t = CasFileTreeStore(content=d,refresh=False)
+        t.refresh(paths=['build','src'])
+        assert item_by_path(t,'build/out') is None
+        assert item_by_path(t,'src/build') is None
+        assert item_by_path(t,'src/a.c') is not None
+
+        # Parallel scans likewise
+
+        t.refresh(scanjobs=3)
+        assert set(i.path for i in t) == paths
+
+from rjgtoys.cas._files import HASH_ORDERS, ORDER_INODE
+
+def test_hash_order():
+    with tempdir() as d:
+        parallel_tree(d)
+        expected = tree_ids(CasFileTreeStore(content=d,refresh=True))
+
+        for order in HASH_ORDERS:
+            s = CasFileTreeStore(content=d,refresh=False)
+            s.refresh(jobs=2,order=order)
+            assert tree_ids(s) == expected
+
+        s = CasFileTreeStore(content=d,refresh=False)
+        s.refresh(rehash=False)
+        items = [i for i in s if i.stale]
+        ordered = s._hash_order(items,ORDER_INODE)
+        assert [i.fileid for i in ordered] == sorted(i.fileid for i in items)
+
+        with pytest.raises(ValueError):
+            s.refresh(order='random')
+
+def test_hard_links():
+    with tempdir() as d:
+        os.makedirs(os.path.join(d,'sub'))
+        create_file(d,'a','linked '*100)
+        os.link(os.path.join(d,'a'),os.path.join(d,'b'))
+        os.link(os.path.join(d,'a'),os.path.join(d,'sub/c'))
+        create_file(d,'other','other')
+
+        s = CasFileTreeStore(content=d,refresh=True)
+        item = s.bypath['a']
+        assert s.bypath['b'] is item
+        assert s.bypath['sub/c'] is item
+        assert item.paths == ['a','b','sub/c']
+        assert item.path == 'a'
+        assert len([i for i in s if i.otype == OTYPE_FILE]) == 2
+
+        # The links are all in their directories' ids
+
+        expected = tree_ids(s)
+        assert s.save()
+        t = CasFileTreeStore(content=d)
+        assert t.bypath['sub/c'] is t.bypath['a']
+        assert t.bypath['a'].paths == ['a','b','sub/c']
+        assert tree_ids(t) == expected
+
+        # Refreshing doesn't move the item from path to path,
+        # or rehash it
+
+        rootid = t.rootid
+        t.refresh(force=False)
+        assert t.bypath['a'].path == 'a'
+        assert t.bypath['a'].stale is False
+        assert t.rootid == rootid
+
+        # Removing a link forgets just that path
+
+        remove_file(d,'a')
+        os.rename(os.path.join(d,'sub/c'),os.path.join(d,'sub/d'))
+        t.refresh()
+        item = t.bypath['b']
+        assert item.paths == ['b','sub/d']
+        assert item.path == 'b'
+        assert 'a' not in t.bypath
+        assert 'sub/c' not in t.bypath
+        assert 'c' not in t.bydir['sub']
+        assert t.rootid != rootid
+
+        # ... and so does a refresh of part of the tree
+
+        remove_file(d,'sub/d')
+        t.refresh(paths=['sub'])
+        assert t.bypath['b'].paths == ['b']
+        assert 'sub' not in t.bydir
+
+        assert tree_ids(t) == tree_ids(CasFileTreeStore(content=d,refresh=True))
+
+        # Removing the last link forgets the item
+
+        remove_file(d,'b')
+        t.refresh()
+        assert item_by_path(t,'b') is None
+        assert len(t.byfileid) == 2
+
+from rjgtoys.cas._volume import volume_id
+
+def test_volume_moved():
+    with tempdir() as d:
+        parallel_tree(d)
+        s = CasFileTreeStore(content=d,refresh=True)
+        dev = os.lstat(d).st_dev
+        if volume_id(d,dev) is None:
+            pytest.skip("No volume ids here")
+        assert s.volumes[dev] == volume_id(d,dev)
+        expected = tree_ids(s)
+
+        # Pretend the volume was on another device when it was saved
+
+        vid = s.volumes[dev]
+        for i in s:
+            i.fileid = (dev+1,i.fileid[1])
+        s.volumes = {dev+1: vid}
+        assert s.save()
+        t = CasFileTreeStore(content=d)
+        assert t.volumes == {dev+1: vid}
+
+        t.refresh(rehash=False)
+        assert not [i for i in t if i.stale]
+        assert set(k[0] for k in t.byfileid) == set([dev])
+        assert t.volumes == {dev: vid}
+        assert tree_ids(t) == expected
+
+        # Items of a volume that used to have this number are forgotten,
+        # as are volumes that hold nothing
+
+        t.volumes[dev] = 'elsewhere'
+        t.volumes[dev+7] = 'gone'
+        t._checked = set()
+        t.refresh(rehash=False)
+        assert len([i for i in t if i.stale]) == len(expected)
+        assert t.volumes == {dev: vid}
+        assert len(t.byfileid) == len(expected)
+
+        t.refresh()
+        assert tree_ids(t) == expected
+        assert t.save()
+        assert tree_ids(CasFileTreeStore(content=d)) == expected
+
+class Interrupted(Exception):
+    pass
+
+def test_refresh_resume():
+    with tempdir() as d:
+        parallel_tree(d)
+        s = CasFileTreeStore(content=d,refresh=True)
+        expected = tree_ids(s)
+        assert s.save()
+        assert s.pending is None
+
+        # Interrupt a forced refresh part of the way through the scan
+
+        scan_one = s._scan_one
+        found = []
+        def interrupt(p,st,*args):
+            if len(found) == 5:
+                raise Interrupted()
+            found.append(scan_one(p,st,*args))
+            return found[-1]
+        s._scan_one = interrupt
+
+        with pytest.raises(Interrupted):
+            s.refresh(force=True,rehash=False)
+        assert s.pending.force
+        assert all(i.stale for i in found)
+        assert s.save()
+
+        # Starting again finds all the work still to do
+
+        t = CasFileTreeStore(content=d)
+        assert t.pending.force
+        t._resume(t.pending)
+        assert all(i.stale for i in t if i.otype == OTYPE_FILE)
+
+        t = CasFileTreeStore(content=d)
+        t.refresh()
+        assert t.pending is None
+        assert not [i for i in t if i.stale]
+        assert tree_ids(t) == expected
+
+        # ... unless told to forget it
+
+        s._scan_one = scan_one
+        s.refresh()
+        assert s.pending is None
+        assert not [i for i in s if i.stale]
+        del found[:]
+        s._scan_one = interrupt
+        with pytest.raises(Interrupted):
+            s.refresh(force=True,rehash=False)
+        assert s.save()
+        t = CasFileTreeStore(content=d)
+        t.refresh(resume=False,rehash=False)
+        assert len([i for i in t if i.stale]) == 5
@@ -0,0 +1,149 @@
+#
+# Tests for content-defined chunking
+#
+
+import os
+import random
+import subprocess
+from contextlib import contextmanager
+
+from rjgtoys.cas import _chunks
+from rjgtoys.cas._base import cas_string_to_id, cas_id_algorithm, CasId
+from rjgtoys.cas._chunks import CasChunker, cas_manifest_to_id, cas_manifest_offsets
+from rjgtoys.cas._files import CasFileTreeStore
+
+import pytest
+
+@contextmanager
+def tempdir():
+    n = os.tmpnam()
+    os.makedirs(n)
+    yield n
+    s = subprocess.call(('/bin/rm','-rf', n))
+    assert s == 0
+
+def randomdata(size,seed=42):
+    r = random.Random(seed)
+    return ''.join(chr(r.randint(0,255)) for _ in range(0,size))
+
+def write_file(d,name,content):
+    p = os.path.join(d,name)
+    with open(p,'w') as f:
+        f.write(content)
+    return p
+
+def small_chunker():
+    return CasChunker(minsize=64,avgsize=256,maxsize=1024,threshold=1000)
+
+def test_bad_sizes():
+    with pytest.raises(ValueError):
+        CasChunker(minsize=10,avgsize=5,maxsize=20)
+
+def test_chunk_sizes():
+    c = small_chunker()
+    data = randomdata(50000)
+
+    with tempdir() as d:
+        p = write_file(d,'data',data)
+        m = c.file_to_chunks(p)
+
+    sizes = [size for (cid,size) in m]
+
+    assert sum(sizes) == len(data)
+    assert max(sizes) <= c.maxsize
+    assert min(sizes[:-1]) >= c.minsize
+
+    # Check the ids match the content
+
+    for (cid,offset,size) in cas_manifest_offsets(m):
+        assert cid == cas_string_to_id(data[offset:offset+size])
+
+@pytest.mark.skipif(_chunks.numpy is None,reason="numpy is not available")
+def test_cut_blocks():
+    """ Cutting a block at a time finds the same boundaries as a byte at a time """
+
+    data = bytearray(randomdata(300000))
+
+    for (c,block) in ((small_chunker(),100),(CasChunker(minsize=1000,avgsize=20000,maxsize=200000),_chunks.CUT_BLOCK)):
+        saved = (_chunks.numpy,_chunks.CUT_BLOCK)
+        _chunks.CUT_BLOCK = block
+        try:
+            by_block = [c.cut(data[offset:],len(data)-offset) for offset in range(0,5000,37)]
+            _chunks.numpy = None
+            by_byte = [c.cut(data[offset:],len(data)-offset) for offset in range(0,5000,37)]
+        finally:
+            (_chunks.numpy,_chunks.CUT_BLOCK) = saved
+
+        assert by_block == by_byte
+        assert len(set(by_block)) > 1
+
+def test_insertion():
+    """ An insertion only changes the chunks near it """
+
+    c = small_chunker()
+    data = randomdata(50000)
+    changed = data[:20000]+'inserted'+data[20000:]
+
+    with tempdir() as d:
+        m1 = c.file_to_chunks(write_file(d,'one',data))
+        m2 = c.file_to_chunks(write_file(d,'two',changed))
+
+    ids1 = set(cid for (cid,size) in m1)
+    new = [cid for (cid,size) in m2 if cid not in ids1]
+
+    assert 0 < len(new) <= 3
+
+    id1 = cas_manifest_to_id(m1)
+    assert id1.startswith('CI')
+    assert CasId(id1) == id1
+    assert id1 != cas_manifest_to_id(m2)
+
+    # The id says which algorithm made it
+
+    id256 = cas_manifest_to_id(m1,'sha256')
+    assert id256.startswith('CS')
+    assert cas_id_algorithm(id1).name == 'sha512'
+    assert cas_id_algorithm(id256).name == 'sha256'
+
+def test_chunked_store():
+    with tempdir() as d:
+        data = randomdata(20000)
+        write_file(d,'big',data)
+        write_file(d,'copy',data[:10000]+'changed'+data[10000:])
+        write_file(d,'small','small file')
+
+        s = CasFileTreeStore(content=d,chunker=small_chunker())
+
+        big = s.bypath['big']
+        copy = s.bypath['copy']
+        assert big.cid.startswith('C')
+        assert big.cid == cas_manifest_to_id(big.chunks)
+        assert s.bypath['small'].chunks is None
+
+        # Most chunks are shared
+
+        assert len(s.missing_chunks(copy.chunks)) == 0
+        shared = [cid for (cid,size) in copy.chunks if s.bychunk[cid] == 2]
+        assert len(shared) > len(copy.chunks)/2
+
+        assert s.save()
+
+        # The chunker sticks with the store
+
+        t = CasFileTreeStore(content=d,refresh=False)
+        assert t.chunker == s.chunker
+        assert t.bychunk == s.bychunk
+
+        # A store that changes algorithm rechunks with the new one
+
+        t = CasFileTreeStore(content=d,refresh=False,algorithm='sha256')
+        t.refresh()
+        assert t.bypath['big'].cid == cas_manifest_to_id(t.bypath['big'].chunks,'sha256')
+        assert t.bypath['big'].cid.startswith('CS')
+
+        # and a store that stops chunking rehashes
+
+        t = CasFileTreeStore(content=d,refresh=False,chunker=CasChunker(threshold=10**9))
+        t.refresh()
+        assert t.bypath['big'].cid == cas_string_to_id(data)
+        assert t.bychunk == {}
@@ -129,3 +129,237 @@ def test_dir_item():
             
             assert s.path == p
             assert s.otype == OTYPE_DIR
+
+#
+# All the ways of reading a file must agree on its id
+#
+
+from rjgtoys.cas._base import CasFileHasher, cas_file_to_id, READ_MMAP, READ_STREAM, READ_PIPE, READ_AUTO, CAS_ID_EMPTY
+
+def test_file_hashers():
+
+    hashers = [CasFileHasher(method=m) for m in (READ_MMAP,READ_AUTO)]
+    hashers += [CasFileHasher(method=m,blocksize=b,fadvise=a)
+                    for m in (READ_STREAM,READ_PIPE) for b in (1,7,64,4096) for a in (False,True)]
+    hashers += [CasFileHasher(method=READ_PIPE,blocksize=7,depth=d) for d in (1,2)]
+
+    with tempdir() as d:
+        for size in (1,LITERALSIZE-1,LITERALSIZE,63,64,65,1000,10000):
+            c = ''.join(chr(i % 251) for i in range(0,size))
+            p = create_file(d,'f%d' % (size))
+            with open(p,'w') as f:
+                f.write(c)
+
+            cid = cas_string_to_id(c)
+            for h in hashers:
+                assert cas_file_to_id(p,hasher=h) == cid
+
+        p = create_file(d,'empty')
+        open(p,'w').close()
+        assert cas_file_to_id(p,hasher=CasFileHasher(method=READ_STREAM)) == CAS_ID_EMPTY
+        assert cas_file_to_id(p,hasher=CasFileHasher(method=READ_PIPE)) == CAS_ID_EMPTY
+
+def test_bad_hasher():
+    with pytest.raises(ValueError):
+        CasFileHasher(method='telepathy')
+
+from rjgtoys.cas._base import cas_file_to_partial_id, PARTIALSIZE
+
+def test_partial_id():
+    with tempdir() as d:
+        big = 'x'*(PARTIALSIZE*3)
+        middle = big[:PARTIALSIZE+10]+'y'+big[PARTIALSIZE+11:]
+
+        a = create_file(d,'a')
+        b = create_file(d,'b')
+        c = create_file(d,'c')
+        for (p,content) in ((a,big),(b,big),(c,middle)):
+            with open(p,'w') as f:
+                f.write(content)
+
+        # Only the head and tail count, so a change in the middle isn't seen
+
+        assert cas_file_to_partial_id(a) == cas_file_to_partial_id(b)
+        assert cas_file_to_partial_id(a) == cas_file_to_partial_id(c)
+        assert cas_file_to_partial_id(a,len(big)) == cas_file_to_partial_id(a)
+
+        with open(c,'a') as f:
+            f.write('z')
+        assert cas_file_to_partial_id(a) != cas_file_to_partial_id(c)
+
+        assert cas_file_to_partial_id(os.path.join(d,'missing')) is None
+
+#
+# Hash algorithms
+#
+
+import hashlib
+from rjgtoys.cas._base import CAS_ALGORITHMS, cas_algorithm, cas_id_algorithm, cas_register_algorithm, UnknownAlgorithmError
+
+def test_algorithms():
+
+    s = 'x'*4096
+    assert cas_string_to_id(s) == cas_string_to_id(s,'sha512')
+    assert cas_string_to_id(s).startswith('I')
+
+    ids = set()
+    for name,a in CAS_ALGORITHMS.items():
+        cid = cas_string_to_id(s,name)
+        assert cid.startswith(a.prefix)
+        assert CasId(cid) == cid
+        assert cas_id_algorithm(cid) is a
+        ids.add(cid)
+
+        # Short data gets the same id whatever the algorithm
+
+        assert cas_string_to_id('one',name) == literal_id('one')
+        assert cas_string_to_id('',name) == 'Z'
+
+    assert len(ids) == len(CAS_ALGORITHMS)
+
+    assert cas_string_to_id(s,'sha256')[1:] == base64.b64encode(hashlib.sha256(s).digest(),'._')
+
+    assert cas_id_algorithm(literal_id('one')) is None
+    assert CasId('Z') == 'Z'
+
+def test_bad_algorithms():
+
+    with pytest.raises(UnknownAlgorithmError):
+        cas_algorithm('rot13')
+
+    with pytest.raises(UnknownAlgorithmError):
+        cas_string_to_id('x'*4096,'rot13')
+
+    for prefix in ('I','L','Z'):
+        with pytest.raises(ValueError):
+            cas_register_algorithm('another',prefix,hashlib.md5)
+
+#
+# Tree hashes
+#
+
+import mmap
+from rjgtoys.cas import _base
+from rjgtoys.cas._base import CasTreeBuilder, SEGMENTSIZE, cas_fileno_to_id
+
+class Unmappable(object):
+    """ Stands in for the mmap module, but can't map anything """
+
+    MAP_SHARED = mmap.MAP_SHARED
+    PROT_READ = mmap.PROT_READ
+
+    def mmap(self,*args):
+        raise EnvironmentError("Can't map that")
+
+def mth(segments):
+    """ The RFC 6962 Merkle tree hash, the slow way """
+
+    if len(segments) == 1:
+        return hashlib.sha512('\x00'+segments[0]).digest()
+    k = 1
+    while k*2 < len(segments):
+        k *= 2
+    return hashlib.sha512('\x01'+mth(segments[:k])+mth(segments[k:])).digest()
+
+def test_tree_ids():
+
+    assert CasTreeBuilder('one').cid == literal_id('one')
+    assert CasTreeBuilder('').cid == 'Z'
+
+    for nseg in (1,2,3,5,7):
+        data = os.urandom(SEGMENTSIZE*(nseg-1)+1000)
+        segments = [data[i:i+SEGMENTSIZE] for i in range(0,len(data),SEGMENTSIZE)]
+
+        expected = 'TI'+base64.b64encode(mth(segments),'._')
+
+        assert CasTreeBuilder(data).cid == expected
+
+        # Fed in awkward pieces
+
+        b = CasTreeBuilder()
+        for i in range(0,len(data),300000):
+            b.add(memoryview(data)[i:i+300000])
+        assert b.cid == expected
+        assert b.size == len(data)
+
+        # Fed as segment hashes
+
+        b = CasTreeBuilder()
+        for seg in segments:
+            b.add_leaf(b.leaf(seg),len(seg))
+        assert b.cid == expected
+
+        assert CasId(expected) == expected
+        assert cas_id_algorithm(expected).name == 'sha512'
+        assert expected != cas_string_to_id(data)
+
+        with tempdir() as d:
+            p = create_file(d,'tree')
+            with open(p,'w') as f:
+                f.write(data)
+            for h in (CasFileHasher(method=READ_STREAM),CasFileHasher(method=READ_PIPE),
+                        CasFileHasher(jobs=3),CasFileHasher(method=READ_MMAP)):
+                assert cas_file_to_id(p,hasher=h,tree=True) == expected
+
+            # Several workers read if told to, or if they can't map the file
+
+            for m in (READ_STREAM,READ_PIPE):
+                h = CasFileHasher(method=m,jobs=3,fadvise=True)
+                assert cas_file_to_id(p,hasher=h,tree=True) == expected
+                assert nseg <= 2 or h._pool is not None
+                h.close()
+                assert h._pool is None
+
+            h = CasFileHasher(jobs=3)
+            real = _base.mmap
+            _base.mmap = Unmappable()
+            try:
+                assert cas_file_to_id(p,hasher=h,tree=True) == expected
+            finally:
+                _base.mmap = real
+                h.close()
+
+    assert CasTreeBuilder('x'*4096,'sha256').cid.startswith('TS')
+
+import mmap
+from rjgtoys.cas._base import cas_strings_to_ids
+
+def test_buffers():
+    for s in ('', 'short', 'x'*LITERALSIZE, 'y'*1000):
+        expected = cas_string_to_id(s)
+        assert CasItemBuilder(bytearray(s)).cid == expected
+        assert CasItemBuilder(buffer('--'+s,2)).cid == expected
+        assert CasItemBuilder(memoryview(s)).cid == expected
+
+        b = CasItemBuilder()
+        v = memoryview(s)
+        b.add(v[:3])
+        b.add(v[3:])
+        assert b.cid == expected
+
+    m = mmap.mmap(-1,1000)
+    assert CasItemBuilder(m).cid == cas_string_to_id('\0'*1000)
+
+def test_strings_to_ids():
+    items = ['', 'a', 'x'*(LITERALSIZE-1), 'x'*LITERALSIZE, 'z'*1000, u'unicode', bytearray('b'*100)]
+
+    for a in CAS_ALGORITHMS:
+        expected = [CasItemBuilder(s,a).cid for s in items]
+        assert list(cas_strings_to_ids(items,a)) == expected
+        assert list(cas_strings_to_ids(iter(items),a)) == expected
+
+import array
+
+def test_typed_buffers():
+    """Buffers of items bigger than a byte are hashed as the bytes
+    they hold"""
+
+    for n in (3,20,1000,SEGMENTSIZE/2+100):
+        a = array.array('I',range(n))
+        data = a.tostring()
+        expected = cas_string_to_id(data)
+
+        assert CasItemBuilder(a).cid == expected
+        assert CasItemBuilder(a).size == len(data)
+        assert list(cas_strings_to_ids([a])) == [expected]
+        assert CasTreeBuilder(a).cid == CasTreeBuilder(data).cid
@@ -0,0 +1,50 @@
+#
+# Tests for exclude rules
+#
+
+from rjgtoys.cas._ignore import CasIgnore, escape
+
+def check(patterns,excluded,included):
+    i = CasIgnore(patterns)
+    for p in excluded:
+        isdir = p.endswith('/')
+        assert i.excluded(p.rstrip('/'),isdir), p
+    for p in included:
+        isdir = p.endswith('/')
+        assert not i.excluded(p.rstrip('/'),isdir), p
+
+def test_basename():
+    check(['*.o','build/','# comment','','core'],
+        excluded=['a.o','x/y/b.o','build/','x/build/','core','x/core','core/'],
+        included=['a.c','a.o.c','build','x/build','x/core.c','xcore'])
+
+def test_anchored():
+    check(['/top','a/b','/c/*.tmp'],
+        excluded=['top','top/','a/b','c/x.tmp'],
+        included=['x/top','x/a/b','a/b/c','c/d/x.tmp','c/x.tmpl'])
+
+def test_stars():
+    check(['**/cache','a/**/z','logs/**','?.x','[ab]*.y','[!c]*.w'],
+        excluded=['cache','p/q/cache','a/z','a/b/z','a/b/c/z','logs/1','logs/1/2','q.x','ab.y','b.y','d.w'],
+        included=['cachex','a/z/q','logs','qq.x','c.y','c.w','a/b/cc.x'])
+
+def test_negation():
+    check(['*.log','!keep.log','tmp/','!tmp/'],
+        excluded=['a.log','x/b.log'],
+        included=['keep.log','x/keep.log','tmp/'])
+
+def test_excludes_path():
+    i = CasIgnore(['build/','!build/keep'])
+    assert i.excludes_path('build/keep',False)      # Can't include inside an excluded dir
+    assert i.excludes_path('x/build/y/z',False)
+    assert not i.excludes_path('x/builder/y',False)
+
+def test_escape():
+    check([escape('odd*name[1]'),escape('!bang'),escape('#hash')],
+        excluded=['odd*name[1]','!bang','#hash'],
+        included=['oddname1','odd-name[1]','bang','hash'])
+
+def test_empty():
+    i = CasIgnore()
+    assert not i
+    assert not i.excluded('anything',False)
@@ -0,0 +1,98 @@
+#
+# Tests for the metadata journal
+#
+
+import os
+
+from rjgtoys.cas._files import CasFileTreeStore, DEFAULT_METADATA
+from rjgtoys.cas._journal import CasJournal, JOURNAL_SUFFIX, OP_PUT
+
+from test_cas_filetree import tempdir, create_file, remove_file, tree_ids, parallel_tree
+
+def test_journal():
+    with tempdir() as d:
+        parallel_tree(d)
+        s = CasFileTreeStore(content=d,refresh=True)
+        assert s.save()
+
+        meta = os.path.join(d,DEFAULT_METADATA)
+        log = meta+JOURNAL_SUFFIX
+        full = os.stat(meta)
+        assert not os.path.exists(log)
+
+        create_file(d,'file1','changed')
+        os.utime(os.path.join(d,'file1'),(0,0))
+        create_file(d,'new','new')
+        remove_file(d,'file2')
+        s.refresh()
+        assert s.save()
+
+        # Only the changes were written
+
+        assert os.stat(meta).st_mtime == full.st_mtime
+        records = list(CasJournal(log).read())
+        assert 3 < len(records) < 10
+
+        assert tree_ids(CasFileTreeStore(content=d)) == tree_ids(s)
+
+        # Nothing changed, nothing much to write
+
+        s.save()
+        assert len(list(CasJournal(log).read())) == len(records)+1
+
+        # A torn record is ignored, and cut off by the next save
+
+        with open(log,'a') as f:
+            f.write('[99999,"put",{"fileid":')
+        t = CasFileTreeStore(content=d)
+        assert tree_ids(t) == tree_ids(s)
+        create_file(d,'another','another')
+        t.refresh()
+        assert t.save()
+        assert tree_ids(CasFileTreeStore(content=d)) == tree_ids(t)
+
+        # Compacting folds the journal into the full save
+
+        t.compact()
+        t.wait_compact()
+        assert not os.path.exists(log)
+        assert os.stat(meta).st_mtime != full.st_mtime or os.stat(meta).st_size != full.st_size
+        assert tree_ids(CasFileTreeStore(content=d)) == tree_ids(t)
+
+        # A full save does too
+
+        remove_file(d,'another')
+        t.refresh()
+        assert t.save()
+        assert os.path.exists(log)
+        assert t.save(full=True)
+        assert not os.path.exists(log)
+        assert tree_ids(CasFileTreeStore(content=d)) == tree_ids(t)
+
+def test_truncate():
+    with tempdir() as d:
+        j = CasJournal(os.path.join(d,'j'))
+        assert j.append((n,OP_PUT,{'n': n}) for n in range(1,6)) == 5
+        j.truncate(3)
+        assert [r[0] for r in j.read()] == [4,5]
+        assert [r[0] for r in j.read(4)] == [5]
+        j.truncate(5)
+        assert list(j.read()) == []
+        assert not os.path.exists(j.path)
+
+def test_replay_no_fileid():
+    """A put record with no fileid, as left by an older version whose
+    refresh of an item failed, is skipped"""
+
+    with tempdir() as d:
+        parallel_tree(d)
+        s = CasFileTreeStore(content=d,refresh=True)
+        assert s.save()
+        create_file(d,'new','new')
+        s.refresh()
+        assert s.save()
+
+        with open(os.path.join(d,DEFAULT_METADATA)+JOURNAL_SUFFIX,'a') as f:
+            f.write('[99999,"put",{"version":"1","fileid":null,"path":"lost","paths":["lost"]}]\n')
+        t = CasFileTreeStore(content=d,refresh=False)
+        assert tree_ids(t) == tree_ids(s)
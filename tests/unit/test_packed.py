@@ -0,0 +1,86 @@
+#
+# Tests for metadata kept in a packed file
+#
+
+import os
+
+from rjgtoys.cas._files import CasFileTreeStore, CasFSItem, DEFAULT_METADATA
+from rjgtoys.cas._packed import CasPackedMetadata, PACKED_SUFFIX
+from rjgtoys.cas._cmdconvert import ConvertCommand
+
+from test_cas_filetree import tempdir, create_file, remove_file, tree_ids, parallel_tree
+
+PACKED_METADATA=DEFAULT_METADATA+PACKED_SUFFIX
+
+def test_packed():
+    with tempdir() as d:
+        parallel_tree(d)
+        os.link(os.path.join(d,'file3'),os.path.join(d,'sub','file3'))
+        s = CasFileTreeStore(content=d,refresh=True)
+        expected = tree_ids(s)
+        assert s.save()
+
+        assert ConvertCommand().main([d,DEFAULT_METADATA,PACKED_METADATA]) == 0
+
+        # Looking things up doesn't load everything
+
+        t = CasFileTreeStore(content=d,metadata=PACKED_METADATA)
+        assert t.rootid == s.rootid
+        assert t.item_at('file1').__dict__ == s.bypath['file1'].__dict__
+        assert t.item_at('nothing') is None
+        assert t.item_at('sub').otype == 'D'
+        assert [name for (name,i) in t.items_in('sub')] == ['empty','file3','link']
+        assert [name for (name,i) in t.items_in('file1')] == []
+        assert [i.paths for i in t.items_with_id(s.bypath['file3'].cid)] == [['file3','sub/file3']]
+        assert list(t.items_with_id('Inothing')) == []
+        assert sorted(i.path for i in t.items()) == sorted(i.path for i in s)
+        assert not t._loaded()
+
+        # ... but anything that needs it all gets it all
+
+        assert tree_ids(t) == expected
+        assert t._loaded()
+        for i in s:
+            assert t.byfileid[i.fileid].__dict__ == i.__dict__
+
+        # Saves rewrite the file
+
+        create_file(d,'file1','changed')
+        os.utime(os.path.join(d,'file1'),(0,0))
+        remove_file(d,'file2')
+        t.refresh()
+        assert t.save()
+        expected = tree_ids(t)
+
+        u = CasFileTreeStore(content=d,metadata=PACKED_METADATA)
+        assert u.item_at('file2') is None
+        assert u.item_at('file1').cid == t.bypath['file1'].cid
+        assert tree_ids(u) == expected
+
+        # A store with only a packed file uses it
+
+        os.unlink(os.path.join(d,DEFAULT_METADATA))
+        v = CasFileTreeStore(content=d)
+        assert v.metadata == PACKED_METADATA
+        assert tree_ids(v) == expected
+
+def test_packed_fields():
+    """Fields without columns of their own, and ids that aren't digests,
+    survive packing"""
+
+    with tempdir() as d:
+        a = CasFSItem(saved=dict(version=CasFSItem.version,fileid=(1,2),path=u'x/b',paths=[u'x/a',u'x/b'],
+            cid='Lc29tZQ..',chunks=[[0,10,'Iabc']],expiry=12,otype='F',size=10,mtime=1.5))
+        b = CasFSItem(saved=dict(version=CasFSItem.version,fileid=(1,3),path=u'é',paths=[u'é'],
+            cid=None,stale=True,expiry=None))
+
+        path = os.path.join(d,'m'+PACKED_SUFFIX)
+        CasPackedMetadata.write(path,dict(version='1',x=1),[a,b])
+
+        m = CasPackedMetadata(path)
+        assert m.header() == dict(version='1',x=1)
+        assert len(m) == 2
+        assert [CasFSItem(saved=i).__dict__ for i in m.items()] == [a.__dict__,b.__dict__]
+        assert [name for (name,i) in m.items_in('x')] == ['a','b']
+        assert m.item_at(u'é').stale
+        assert [i.fileid for i in m.items_with_id('Lc29tZQ..')] == [(1,2)]
@@ -0,0 +1,68 @@
+#
+# Tests for metadata kept in SQLite
+#
+
+import os
+
+from rjgtoys.cas._files import CasFileTreeStore, DEFAULT_METADATA
+from rjgtoys.cas._sqlite import SQLITE_SUFFIX
+from rjgtoys.cas._cmdconvert import ConvertCommand
+
+from test_cas_filetree import tempdir, create_file, remove_file, tree_ids, parallel_tree
+
+SQLITE_METADATA=DEFAULT_METADATA+SQLITE_SUFFIX
+
+def test_sqlite():
+    with tempdir() as d:
+        parallel_tree(d)
+        os.link(os.path.join(d,'file3'),os.path.join(d,'sub','file3'))
+        s = CasFileTreeStore(content=d,refresh=True)
+        expected = tree_ids(s)
+        assert s.save()
+
+        assert ConvertCommand().main([d,DEFAULT_METADATA,SQLITE_METADATA]) == 0
+
+        # Looking things up doesn't load everything
+
+        t = CasFileTreeStore(content=d,metadata=SQLITE_METADATA)
+        assert t.rootid == s.rootid
+        assert t.item_at('file1').cid == s.bypath['file1'].cid
+        assert t.item_at('nothing') is None
+        assert [name for (name,i) in t.items_in('sub')] == ['empty','file3','link']
+        assert [i.paths for i in t.items_with_id(s.bypath['file3'].cid)] == [['file3','sub/file3']]
+        assert not t._loaded()
+
+        # ... but anything that needs it all gets it all
+
+        assert tree_ids(t) == expected
+        assert t._loaded()
+        assert t.item_at('file1') is t.bypath['file1']
+
+        # Changes are saved as they are made
+
+        create_file(d,'file1','changed')
+        os.utime(os.path.join(d,'file1'),(0,0))
+        create_file(d,'new','new')
+        remove_file(d,'file2')
+        remove_file(d,'sub/file3')
+        t.refresh()
+        assert t.save()
+        expected = tree_ids(t)
+
+        u = CasFileTreeStore(content=d,metadata=SQLITE_METADATA)
+        assert u.item_at('file2') is None
+        assert u.item_at('new') is not None
+        assert u.item_at('file3').paths == ['file3']
+        assert u.item_at('file1').cid == t.bypath['file1'].cid
+        assert tree_ids(u) == expected
+        assert tree_ids(CasFileTreeStore(content=d,refresh=True)) == expected
+
+        # A store with only an SQLite database uses it; and it can be
+        # turned back into JSON
+
+        os.unlink(os.path.join(d,DEFAULT_METADATA))
+        v = CasFileTreeStore(content=d)
+        assert v.metadata == SQLITE_METADATA
+        assert v.item_at('new') is not None
+        assert v.save(DEFAULT_METADATA)
+        assert tree_ids(CasFileTreeStore(content=d,metadata=DEFAULT_METADATA)) == expected
@@ -0,0 +1,116 @@
+#
+# Tests for watching a store
+#
+
+import os
+import time
+
+import pytest
+
+from rjgtoys.cas._files import CasFileTreeStore, DEFAULT_METADATA
+from rjgtoys.cas._watch import CasWatcher, Inotify, InotifyError, IN_Q_OVERFLOW
+
+from test_cas_filetree import tempdir, create_file, remove_file, item_by_path, tree_ids
+
+def inotify_works():
+    try:
+        Inotify().close()
+        return True
+    except InotifyError:
+        return False
+
+needs_inotify = pytest.mark.skipif(not inotify_works(),reason="inotify is not available")
+
+def settle(w):
+    """Deal with everything that has happened so far"""
+
+    for i in range(0,5):
+        w.step(0.05)
+    while w.pending:
+        w.step(0.05)
+
+@needs_inotify
+def test_watch():
+    with tempdir() as d:
+        create_file(d,'a','a file with some content in it '*10)
+        os.makedirs(os.path.join(d,'sub'))
+        create_file(d,'sub/b','b')
+
+        s = CasFileTreeStore(content=d,refresh=False)
+        w = CasWatcher(s,settle=0,interval=3600)
+        w.start()
+        try:
+            assert item_by_path(s,'sub/b') is not None
+
+            create_file(d,'sub/c','a new file '*20)
+            create_file(d,'a','a changed file '*20)
+            remove_file(d,'sub/b')
+            settle(w)
+
+            assert item_by_path(s,'sub/b') is None
+            assert not item_by_path(s,'sub/c').stale
+            assert tree_ids(s) == tree_ids(CasFileTreeStore(content=d,metadata='other',refresh=True))
+
+            # Whole trees can arrive, move and go
+
+            os.makedirs(os.path.join(d,'new','deeper'))
+            create_file(d,'new/deeper/x','x')
+            settle(w)
+            create_file(d,'new/deeper/y','y')
+            settle(w)
+            assert item_by_path(s,'new/deeper/y') is not None
+
+            os.rename(os.path.join(d,'new'),os.path.join(d,'moved'))
+            settle(w)
+            assert item_by_path(s,'new/deeper/x') is None
+            assert item_by_path(s,'moved/deeper/x') is not None
+
+            create_file(d,'moved/deeper/z','z')
+            settle(w)
+            assert item_by_path(s,'moved/deeper/z') is not None
+
+            assert tree_ids(s) == tree_ids(CasFileTreeStore(content=d,metadata='other',refresh=True))
+        finally:
+            w.stop()
+
+        assert os.path.exists(os.path.join(d,DEFAULT_METADATA))
+
+@needs_inotify
+def test_watch_overflow():
+    """Changes lost when the event queue overflows are found again"""
+
+    with tempdir() as d:
+        os.makedirs(os.path.join(d,'sub','old'))
+        os.makedirs(os.path.join(d,'other'))
+        create_file(d,'sub/a','a')
+        create_file(d,'other/b','b')
+
+        s = CasFileTreeStore(content=d)
+        w = CasWatcher(s,settle=0,interval=3600,paths=['sub'])
+        w.start()
+        try:
+            assert sorted(w.bywd.values()) == ['sub','sub/old']
+
+            # Lose the events for some changes
+
+            os.makedirs(os.path.join(d,'sub','new'))
+            create_file(d,'sub/new/c','c')
+            os.rmdir(os.path.join(d,'sub','old'))
+            create_file(d,'other/b','changed')
+            os.utime(os.path.join(d,'other','b'),(0,0))
+            while w.inotify.read(0.1):
+                pass
+            w._event(-1,IN_Q_OVERFLOW,u'')
+
+            assert item_by_path(s,'sub/new/c') is not None
+            assert item_by_path(s,'sub/old') is None
+            assert sorted(w.bywd.values()) == ['sub','sub/new']
+            assert item_by_path(s,'other/b').size == 1      # Not watched
+
+            # What happens in new directories is seen
+
+            create_file(d,'sub/new/e','e')
+            settle(w)
+            assert item_by_path(s,'sub/new/e') is not None
+        finally:
+            w.stop()
@@ -0,0 +1,61 @@
+#
+# Tests for content ids kept in extended attributes
+#
+
+import os
+import json
+import time
+
+import pytest
+
+from rjgtoys.cas._base import cas_string_to_id
+from rjgtoys.cas._files import CasFileTreeStore
+from rjgtoys.cas._xattr import xattr_name, getxattr, setxattr
+
+from test_cas_filetree import tempdir, create_file, tree_ids
+
+def xattrs_work():
+    with tempdir() as d:
+        create_file(d,'x','x')
+        return setxattr(os.path.join(d,'x'),'user.cas.test','x')
+
+needs_xattrs = pytest.mark.skipif(not xattrs_work(),reason="user extended attributes are not available")
+
+@needs_xattrs
+def test_xattrs():
+    with tempdir() as d:
+        data = 'some content that is too long to be a literal id '*10
+        create_file(d,'a',data)
+        a = os.path.join(d,'a')
+        create_file(d,'small','tiny')
+
+        s = CasFileTreeStore(content=d,refresh=True,xattrs=True)
+        expected = tree_ids(s)
+        name = xattr_name(s.algorithm)
+
+        v = json.loads(getxattr(a,name))
+        assert v['cid'] == cas_string_to_id(data) == s.bypath['a'].cid
+        assert getxattr(os.path.join(d,'small'),name) is None
+
+        # Another store (nothing has been saved) takes the id on trust;
+        # show that it does
+
+        v['cid'] = 'I-not-really'
+        setxattr(a,name,json.dumps(v))
+
+        t = CasFileTreeStore(content=d,refresh=True,xattrs=True)
+        assert t.bypath['a'].cid == 'I-not-really'
+
+        # ... unless the file has been changed since
+
+        v['set'] = time.time()-100
+        setxattr(a,name,json.dumps(v))
+
+        t = CasFileTreeStore(content=d,refresh=True,xattrs=True)
+        assert tree_ids(t) == expected
+
+        # Stores that don't use them leave them alone
+
+        t = CasFileTreeStore(content=d,refresh=True,tree=True)
+        assert json.loads(getxattr(a,name))['cid'] == cas_string_to_id(data)
+        assert getxattr(a,xattr_name(s.algorithm,True)) is None